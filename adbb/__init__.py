@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with adbb.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import os
 import multiprocessing
 import netrc
@@ -27,7 +28,14 @@ import urllib.request
 
 import adbb.db
 import adbb.errors
+import adbb.outbox
+import adbb.writebehind
+from adbb.identitymap import IdentityMap
+from adbb.planner import RefreshPlanner
 from adbb.link import AniDBLink
+from adbb.ratelimit import RateLimiter, SharedRateLimiter, DEFAULT_LIMITS
+from adbb.workers import WorkerPool
+from adbb.transport import UDPTransport, RecordingTransport, ReplayTransport
 
 from adbb.animeobjs import Anime, AnimeTitle, Episode, File, Group
 
@@ -40,6 +48,10 @@ anidb_api_version = 3
 log = None
 _anidb = None
 _sessionmaker = None
+_update_pool = None
+_object_cache = None
+_refresh_planner = None
+stale_while_revalidate = False
 fanart_key = None
 
 def init(
@@ -53,7 +65,25 @@ def init(
         outgoing_udp_port=random.randrange(9000, 10000),
         api_key=None,
         fanart_api_key=None,
-        db_only=False):
+        db_only=False,
+        rate_limits=None,
+        rate_budget_file=None,
+        broker_socket=None,
+        callback_workers=4,
+        update_workers=4,
+        aging_interval=300,
+        state_file=None,
+        api_host='api.anidb.net',
+        api_port=9000,
+        record_file=None,
+        replay_file=None,
+        mylist_merge_window=2,
+        object_cache_size=0,
+        stale_while_revalidate=False,
+        refresh_budget=None,
+        write_batch_size=100,
+        write_interval=1.0,
+        db_pool=None):
 
     if logger is None:
         logger = logging.getLogger(__name__)
@@ -72,37 +102,56 @@ def init(
             'adbb %(filename)s/%(funcName)s:%(lineno)d - %(message)s'))
         logger.addHandler(lh)
 
-    global log, _anidb, _sessionmaker, fanart_key
+    global log, _anidb, _sessionmaker, _update_pool, _object_cache, _refresh_planner, fanart_key
     log = logger
+    adbb.stale_while_revalidate = stale_while_revalidate
     fanart_key = fanart_api_key
+    if _update_pool:
+        _update_pool.stop()
+    _update_pool = WorkerPool('update', workers=update_workers)
+    # objects hold a reference to the link, so they are not reused across init()
+    _object_cache = IdentityMap(lru_size=object_cache_size)
 
     try:
         nrc = netrc.netrc(netrc_file)
     except FileNotFoundError:
         nrc = None
 
-    # unless both username and password is given; look for credentials in netrc
-    if not (api_user and api_pass) or db_only:
-        if not nrc:
-            raise Exception("User and passwords are required if no netrc file exists")
-        for host in ['api.anidb.net', 'api.anidb.info', 'anidb.net']:
-            try:
-                username, account, password = nrc.authenticators(host)
-            except TypeError:
-                continue
-            if username and password:
-                api_user = username
-                api_pass = password
-                if account and not api_key:
-                    api_key = account
-                break
+    if not db_only and not broker_socket:
+        api_user, api_pass, api_key = _api_credentials(nrc, api_user, api_pass, api_key)
 
-    if not db_only:
+    if broker_socket and not db_only:
+        # all AniDB traffic goes through the broker, which owns the session
+        from adbb.broker import BrokerLink
+        _anidb = BrokerLink(broker_socket, callback_workers=callback_workers)
+    elif not db_only:
+        if not rate_limits:
+            rate_limits = DEFAULT_LIMITS
+        if replay_file:
+            # nothing is sent to AniDB, so there is nothing to limit
+            rate_limiter = RateLimiter(())
+        elif rate_budget_file:
+            rate_limiter = SharedRateLimiter(rate_budget_file, rate_limits)
+        else:
+            rate_limiter = RateLimiter(rate_limits)
+        if replay_file:
+            transport = ReplayTransport(replay_file)
+        else:
+            transport = UDPTransport((api_host, api_port), myport=outgoing_udp_port)
+            if record_file:
+                transport = RecordingTransport(transport, record_file)
         _anidb = adbb.link.AniDBLink(
             api_user,
             api_pass,
+            host=api_host,
+            port=api_port,
             myport=outgoing_udp_port,
-            api_key=api_key)
+            api_key=api_key,
+            rate_limiter=rate_limiter,
+            callback_workers=callback_workers,
+            aging_interval=aging_interval,
+            state_file=state_file,
+            transport=transport)
 
     if nrc:
         # if no password is given in sql-url we try to look it up
@@ -138,11 +187,94 @@ def init(
 
             
 
-    _sessionmaker = adbb.db.init_db(sql_db_url)
+    _sessionmaker = adbb.db.init_db(sql_db_url, pool=db_pool)
+
+    adbb.outbox.merge_window = mylist_merge_window
+    adbb.writebehind.batch_size = write_batch_size
+    adbb.writebehind.interval = write_interval
+    if not db_only:
+        # resend mylist changes that earlier processes didn't get an answer to
+        adbb.outbox.drain()
+    if refresh_budget and not db_only:
+        # refresh the cache while the link is idle instead of when objects
+        # happen to be used
+        _refresh_planner = RefreshPlanner(daily_budget=refresh_budget)
+        _refresh_planner.start()
+
+
+def _api_credentials(nrc, api_user, api_pass, api_key):
+    # unless both username and password is given; look for credentials in netrc
+    if api_user and api_pass:
+        return api_user, api_pass, api_key
+    if not nrc:
+        raise Exception("User and passwords are required if no netrc file exists")
+    for host in ['api.anidb.net', 'api.anidb.info', 'anidb.net']:
+        try:
+            username, account, password = nrc.authenticators(host)
+        except TypeError:
+            continue
+        if username and password:
+            api_user = username
+            api_pass = password
+            if account and not api_key:
+                api_key = account
+            break
+    return api_user, api_pass, api_key
+
+
+def time_until_next_slot():
+    """Seconds until the UDP link is allowed to send its next packet"""
+    if not _anidb or not _anidb.rate_limiter:
+        return 0
+    return _anidb.rate_limiter.time_until_next_slot()
+
+
+def worker_stats():
+    """Queue depth and latency metrics for the response callback workers and
+    the background update workers"""
+    stats = {}
+    if _anidb:
+        stats['callback'] = _anidb.callback_stats()
+    if _update_pool:
+        stats['update'] = _update_pool.stats()
+    if _object_cache:
+        stats['objects'] = _object_cache.stats()
+    return stats
+
+
+def update_many(objs, priority=None):
+    """Queue updates of all objs (Anime, Episode, File or Group objects) at
+    once. Returns a list of concurrent.futures.Future, see wait_all()."""
+    return [obj.update(priority=priority) for obj in objs]
+
+
+def wait_all(futures, timeout=None):
+    """Generator yielding the updated objects from update_many() as each
+    update finishes. Failed updates (illegal objects, for example) are
+    logged and skipped; the exception is available from the future."""
+    for future in concurrent.futures.as_completed(futures, timeout=timeout):
+        e = future.exception()
+        if e:
+            log.warning("Update failed: {}".format(e))
+            continue
+        yield future.result()
 
 
 def get_session():
-    return _sessionmaker()
+    # reads should see changes still waiting to be written
+    if adbb.writebehind.pending():
+        adbb.writebehind.flush()
+    return adbb.db.thread_session(_sessionmaker)
+
+
+def session_scope():
+    """Context manager making everything in this thread inside the with block
+    use the same database session, instead of every object and property
+    using its own. The session is yielded, and closed at the end of the
+    outermost block."""
+    if adbb.writebehind.pending():
+        adbb.writebehind.flush()
+    return adbb.db.session_scope(_sessionmaker)
 
 
 def close_session(session):
@@ -177,6 +309,15 @@ def download_fanart(filehandle, url, preview=False):
         filehandle.write(f.read())
 
 def close():
-    global _anidb
+    global _anidb, _refresh_planner, _update_pool
+    if _refresh_planner:
+        _refresh_planner.stop()
+        _refresh_planner = None
     if _anidb:
+        adbb.outbox.flush()
+        adbb.outbox.stop()
         _anidb.stop()
+    if _update_pool:
+        _update_pool.stop()
+        _update_pool = None
+    adbb.writebehind.flush()
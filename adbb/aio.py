@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import functools
+import hashlib
+import netrc
+import random
+from time import time
+
+import adbb
+import adbb.commands
+import adbb.outbox
+import adbb.writebehind
+from adbb.errors import AniDBError, IllegalAnimeObject
+from adbb.link import RttEstimator
+from adbb.ratelimit import RateLimiter, SharedRateLimiter, DEFAULT_LIMITS
+from adbb.responses import ResponseResolver
+from adbb.scheduler import RequestScheduler
+from adbb.transport import encode, decode
+
+from Crypto.Cipher import AES
+
+# Commands that can be sent without a session
+_SESSION_COMMANDS = ('AUTH', 'ENCRYPT', 'PING')
+
+
+class _SessionLost(Exception):
+    pass
+
+
+class _AniDBProtocol(asyncio.DatagramProtocol):
+    def __init__(self, link):
+        self._link = link
+
+    def datagram_received(self, data, addr):
+        self._link._datagram_received(data)
+
+    def error_received(self, exc):
+        adbb.log.warning("Error from AniDB socket: {}".format(exc))
+
+
+class AsyncAniDBLink:
+    """AniDB UDP client running on an asyncio event loop.
+
+    Commands are sent with `await link.execute(command)`, which returns the
+    parsed response. Like AniDBLink, the link logs in when needed, sends
+    commands in priority order through the rate limiter, and resends
+    commands using an RTT based timeout. No threads are used for waiting on
+    responses.
+
+    The link also implements the thread based request() interface, so that
+    the object API (used from worker threads, see adbb.aio.fetch()) can
+    share the session."""
+
+    def __init__(
+            self,
+            user,
+            pwd,
+            host='api.anidb.net',
+            port=9000,
+            myport=9876,
+            timeout=20,
+            api_key=None,
+            rate_limiter=None,
+            nat_ping_interval=600,
+            aging_interval=300):
+        self._user = user
+        self._pwd = pwd
+        self._server = (host, port)
+        self._myport = myport
+        self.timeout = timeout
+        self._api_key = api_key
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.rate_limiter = rate_limiter
+        self.rtt = RttEstimator(initial_rto=timeout, max_rto=max(timeout, 60))
+        self._nat_ping_interval = nat_ping_interval
+
+        self._queue = RequestScheduler(aging_interval=aging_interval)
+        self._pending = {}
+        self._current_tag = 0
+        self._session = None
+        self._cipher = None
+        self._do_ping = False
+        self._banned = 0
+        self._ban_until = 0
+        self._last_packet = 0
+        self._last_receive = 0
+
+        self._loop = None
+        self._transport = None
+        self._wakeup = None
+        self._auth_lock = None
+        self._tasks = []
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._auth_lock = asyncio.Lock()
+        self._transport, _protocol = await self._loop.create_datagram_endpoint(
+                lambda: _AniDBProtocol(self),
+                local_addr=('0.0.0.0', self._myport),
+                remote_addr=self._server)
+        self._tasks = [
+                self._loop.create_task(self._sender()),
+                self._loop.create_task(self._keepalive())]
+
+    async def stop(self):
+        if self._session:
+            try:
+                await asyncio.wait_for(
+                        self.execute(adbb.commands.LogoutCommand(), priority='interactive'),
+                        self.timeout)
+                adbb.log.info("Logged out from AniDB")
+            except (asyncio.TimeoutError, AniDBError):
+                pass
+        for task in self._tasks:
+            task.cancel()
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+    def _new_tag(self):
+        if self._current_tag >= 999:
+            self._current_tag = 0
+        self._current_tag += 1
+        return "T{:03d}".format(self._current_tag)
+
+    async def _sender(self):
+        while True:
+            item = self._queue.pop()
+            if item is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            command, sent = item
+            if sent.cancelled():
+                continue
+            delay = self._ban_until - time()
+            if delay > 0:
+                adbb.log.warning(f"API not available, will wait for {delay/60:.0f} minutes")
+                await asyncio.sleep(delay)
+            # reserve() may block, waiting for the lock of a shared budget
+            delay = await self._loop.run_in_executor(None, self.rate_limiter.reserve)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            command.authorize(self._session)
+            command.started = time()
+            if not command.first_started:
+                command.first_started = command.started
+            command.transmissions += 1
+            self._last_packet = command.started
+            data = encode(self._cipher, command, command.raw_data().encode('utf-8'))
+            self._transport.sendto(data)
+            if not sent.done():
+                sent.set_result(None)
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(60)
+            idle = time() - self._last_packet
+            if not self._session:
+                continue
+            try:
+                if self._do_ping and idle > self._nat_ping_interval:
+                    await self.execute(adbb.commands.PingCommand(), priority='background')
+                elif idle >= 1800:
+                    await self.execute(adbb.commands.UptimeCommand(), priority='background')
+            except AniDBError as e:
+                adbb.log.warning("Failed to keep AniDB session alive: {}".format(e))
+
+    def _datagram_received(self, data):
+        self._last_receive = time()
+        data = decode(self._cipher, data)
+        resp = ResponseResolver(data)
+        if not resp.restag:
+            try:
+                code = int(data[:3])
+            except ValueError:
+                adbb.log.error(f"Unparseable response from API: {repr(data)}")
+                return
+            if code in (600, 601, 602, 604):
+                self._set_banned(reason=resp.resstr)
+            elif code == 598:
+                adbb.log.warning('Lost encrypted session with AniDB; attempting to reauthenticate')
+                self._lose_session()
+            else:
+                adbb.log.error(f'Unhandled response from API: {repr(data)}')
+            return
+        pending = self._pending.pop(resp.restag, None)
+        if not pending:
+            return
+        command, future = pending
+        if command.transmissions == 1 and command.started:
+            self.rtt.sample(time() - command.started)
+        resp = resp.resolve(command)
+        resp.parse()
+        if future.done():
+            return
+        if resp.rescode in ('501', '506', '403') and command.command != 'LOGOUT':
+            future.set_exception(_SessionLost())
+        else:
+            future.set_result(resp)
+
+    def _set_banned(self, reason=None):
+        adbb.log.error("Backing off: {}".format(reason))
+        self._banned = self._banned*2 if self._banned else 1
+        self._ban_until = time() + 1800*self._banned
+        self._lose_session()
+
+    def _lose_session(self):
+        self._session = None
+        self._cipher = None
+        for tag, (command, future) in list(self._pending.items()):
+            if command.command not in _SESSION_COMMANDS and not future.done():
+                self._pending.pop(tag)
+                future.set_exception(_SessionLost())
+
+    async def _login(self):
+        async with self._auth_lock:
+            if self._session:
+                return
+            if self._api_key:
+                req = adbb.commands.EncryptCommand(self._user, self._api_key, "1")
+                resp = await self._exchange(req, 'interactive')
+                if resp.rescode != '209':
+                    raise AniDBError("Failed to start encrypted session: {} {}".format(
+                        resp.rescode, resp.resstr))
+                key = hashlib.md5(bytes(self._api_key + resp.attrs['salt'], 'utf-8')).digest()
+                self._cipher = AES.new(key, AES.MODE_ECB)
+                adbb.log.info('Encrypted session established')
+            req = adbb.commands.AuthCommand(
+                    self._user,
+                    self._pwd,
+                    adbb.anidb_api_version,
+                    adbb.anidb_client_name,
+                    adbb.anidb_client_version,
+                    nat=1)
+            resp = await self._exchange(req, 'interactive')
+            if resp.rescode not in ('200', '201'):
+                raise AniDBError("Login to AniDB failed: {} {}".format(resp.rescode, resp.resstr))
+            self._session = resp.attrs['sesskey']
+            self._banned = 0
+            _ip, port = resp.attrs['address'].split(':')
+            self._do_ping = int(port) != self._myport
+            adbb.log.info(f"Logged in to AniDB with session {self._session}")
+
+    async def _exchange(self, command, priority):
+        """Send command until a response arrives"""
+        command.priority_class = priority
+        requeue = False
+        while True:
+            command.tag = self._new_tag()
+            future = self._loop.create_future()
+            sent = self._loop.create_future()
+            self._pending[command.tag] = (command, future)
+            if requeue:
+                self._queue.push_front((command, sent), priority, command.queued)
+            else:
+                command.queued = time()
+                self._queue.push((command, sent), priority, command.queued)
+            self._wakeup.set()
+            try:
+                await sent
+                return await asyncio.wait_for(future, self.rtt.rto)
+            except asyncio.TimeoutError:
+                self._pending.pop(command.tag, None)
+                self.rtt.backoff()
+                requeue = True
+                if command.started < self._last_receive \
+                        or time() - command.first_started < self.timeout:
+                    # API isn't dead yet, or we haven't waited the full
+                    # timeout yet; send it again.
+                    adbb.log.debug("No response to {}; resending".format(command.tag))
+                    continue
+                adbb.log.warning("Command {} timed out".format(command.tag))
+                if command.command == 'ENCRYPT' or command.retries <= 0:
+                    command.retries = 2
+                    self._set_banned(reason=b'API not responding')
+                else:
+                    command.retries -= 1
+                command.first_started = None
+            except asyncio.CancelledError:
+                self._pending.pop(command.tag, None)
+                sent.cancel()
+                raise
+
+    async def execute(self, command, priority='interactive'):
+        """Send command to AniDB and return the response"""
+        while True:
+            if command.command not in _SESSION_COMMANDS + ('LOGOUT',):
+                await self._login()
+            try:
+                return await self._exchange(command, priority)
+            except _SessionLost:
+                adbb.log.warning('Lost session with AniDB; attempting to reauthenticate')
+                self._session = None
+
+    def request(self, command, callback, prio=False, priority=None):
+        """Thread based interface used by the object API; callback is called
+        in a worker thread with the response. Must not be called from the
+        event loop thread."""
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            # the caller would block the loop waiting for the response
+            raise AniDBError("Blocking AniDB request from the event loop; use fetch() instead")
+        if not priority:
+            priority = 'interactive' if prio else 'normal'
+        command.callback = callback
+
+        async def _request():
+            resp = await self.execute(command, priority)
+            await self._loop.run_in_executor(None, resp.handle)
+        asyncio.run_coroutine_threadsafe(_request(), self._loop)
+
+    def callback_stats(self):
+        return {
+                'queue_depth': len(self._queue),
+                'pending': len(self._pending),
+                }
+
+
+async def _in_thread(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+
+async def update(obj, priority='interactive', **kwargs):
+    """Update obj from AniDB; the AniDB requests are sent from the event loop
+    and the responses are handled (and saved to the database) in worker
+    threads."""
+    link = adbb._anidb
+    if not isinstance(link, AsyncAniDBLink):
+        raise AniDBError("adbb.aio.init() must be used to fetch objects asynchronously")
+    locked = obj._updating.acquire(False)
+    if not locked:
+        # someone else is updating; wait for them to finish
+        await _in_thread(obj._updating.acquire)
+        obj._updating.release()
+        return obj
+    steps = obj._update_steps(**kwargs)
+    try:
+        while True:
+            # building the next request may need database lookups
+            item = await _in_thread(next, steps, None)
+            if item is None:
+                break
+            req, callback, event = item
+            event.clear()
+            resp = await link.execute(req, priority)
+            await _in_thread(callback, resp)
+    finally:
+        await _in_thread(steps.close)
+        obj._updating.release()
+    if object.__getattribute__(obj, '_illegal_object'):
+        raise IllegalAnimeObject("{} is not a valid AniDB object".format(obj))
+    if adbb._object_cache is not None:
+        # the update may have taught us more ids (eid, fid, lid...)
+        adbb._object_cache.add(obj)
+    return obj
+
+
+async def fetch(cls, *args, **kwargs):
+    """Create an adbb object (Anime, Episode, File or Group) without blocking
+    the event loop, and fetch it from AniDB unless it's already in the
+    database."""
+    obj = await _in_thread(cls, *args, **kwargs)
+    if not obj.db_data:
+        await update(obj)
+    else:
+        await _in_thread(obj.update_if_old)
+    return obj
+
+
+async def init(
+        sql_db_url,
+        api_user=None,
+        api_pass=None,
+        netrc_file=None,
+        outgoing_udp_port=None,
+        api_key=None,
+        rate_limits=None,
+        rate_budget_file=None,
+        api_host='api.anidb.net',
+        api_port=9000,
+        timeout=20,
+        **kwargs):
+    """Like adbb.init(), but the AniDB link runs on the current event loop.
+    Extra keyword arguments are passed to adbb.init()."""
+    adbb.init(sql_db_url, netrc_file=netrc_file, db_only=True, **kwargs)
+    try:
+        nrc = netrc.netrc(netrc_file)
+    except FileNotFoundError:
+        nrc = None
+    api_user, api_pass, api_key = adbb._api_credentials(nrc, api_user, api_pass, api_key)
+
+    if not rate_limits:
+        rate_limits = DEFAULT_LIMITS
+    if rate_budget_file:
+        rate_limiter = SharedRateLimiter(rate_budget_file, rate_limits)
+    else:
+        rate_limiter = RateLimiter(rate_limits)
+    if outgoing_udp_port is None:
+        outgoing_udp_port = random.randrange(9000, 10000)
+    link = AsyncAniDBLink(
+            api_user,
+            api_pass,
+            host=api_host,
+            port=api_port,
+            myport=outgoing_udp_port,
+            timeout=timeout,
+            api_key=api_key,
+            rate_limiter=rate_limiter)
+    await link.start()
+    adbb._anidb = link
+    await _in_thread(adbb.outbox.drain)
+    return link
+
+
+async def close():
+    link = adbb._anidb
+    if isinstance(link, AsyncAniDBLink):
+        await _in_thread(adbb.outbox.flush)
+        adbb.outbox.stop()
+        await link.stop()
+        adbb._anidb = None
+    if adbb._update_pool:
+        adbb._update_pool.stop()
+        adbb._update_pool = None
+    await _in_thread(adbb.writebehind.flush)
@@ -15,11 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with adbb.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import datetime
+import functools
 import json
-import math
 import os
-import random
 import re
 import threading
 import time
@@ -30,20 +30,68 @@ import sqlalchemy
 
 import adbb
 import adbb.anames
+import adbb.db
 import adbb.mapper
+import adbb.negcache
 import adbb.fileinfo
+import adbb.outbox
+import adbb.ttl
+import adbb.writebehind
 from adbb.db import *
 from adbb.commands import *
 from adbb.errors import *
 
 
-
-class AniDBObj(object):
+def _scoped(func):
+    # run func in a session_scope(), so that everything it (and the objects
+    # it creates) reads from the database shares one session. Queued writes
+    # are still flushed by the reads themselves, not when the scope starts.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with adbb.db.session_scope(adbb._sessionmaker):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class _IdentityMapped(type):
+    """Metaclass returning the already existing object when an AniDBObj is
+    created with the same key (aid, eid, fid...) as a live object."""
+    def __call__(cls, *args, **kwargs):
+        # creating an object creates (and looks up) its anime and episodes
+        # too, let them share a database session
+        with adbb.session_scope():
+            return cls._create(*args, **kwargs)
+
+    def _create(cls, *args, **kwargs):
+        cache = adbb._object_cache
+        if cache is None:
+            return super(_IdentityMapped, cls).__call__(*args, **kwargs)
+        key = cls._identity_key(*args, **kwargs)
+        if key:
+            obj = cache.get(cls, key)
+            if obj is not None:
+                if obj._identity_valid():
+                    return obj
+                cache.discard(obj)
+        obj = super(_IdentityMapped, cls).__call__(*args, **kwargs)
+        return cache.add(obj)
+
+
+class AniDBObj(object, metaclass=_IdentityMapped):
     def __init__(self):
         self._anidb_link = adbb._anidb
         self._illegal_object = False
         self._updated = threading.Event()
         self._updating = threading.Lock()
+        self._update_future = None
+        # (kind, key) in the negative cache, see adbb.negcache
+        self._negative_key = None
+        # AniDB requests sent to update this object
+        self._sent_requests = 0
+        # the request of the running update waiting to be sent, and whether
+        # someone is waiting for the update
+        self._update_command = None
+        self._update_promoted = False
         self._timezone = datetime.timezone(datetime.timedelta(hours=0))
         self.db_data = None
 
@@ -52,79 +100,180 @@ class AniDBObj(object):
             return obj.replace(tzinfo=self._timezone)
         return obj
 
-    def _fetch_anidb_data(self, block):
+    def _fetch_anidb_data(self, block, priority=None):
         adbb.log.debug("Seding anidb request for {}".format(self))
-        thread = threading.Thread(
-            target=self._send_anidb_update_req,
-            kwargs={'prio': block})
-        thread.start()
         if block:
-            thread.join()
+            self._run_update(prio=True)
             if self._illegal_object:
                 raise IllegalAnimeObject("{} is not a valid AniDB object".format(self))
+        else:
+            adbb._update_pool.submit(self._run_update, priority=priority)
+
+    def _run_update(self, **kwargs):
+        future = self._update_future
+        try:
+            self._send_anidb_update_req(**kwargs)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        if super(AniDBObj, self).__getattribute__('_illegal_object'):
+            future.set_exception(IllegalAnimeObject("{} is not a valid AniDB object".format(self)))
+        else:
+            if adbb._object_cache is not None:
+                # the update may have taught us more ids (eid, fid, lid...)
+                adbb._object_cache.add(self)
+            future.set_result(self)
+
+    def _promote_update(self):
+        # someone is about to wait for the running update; don't have them
+        # wait behind all other requests if it was queued as background work
+        self._update_promoted = True
+        command = self._update_command
+        promote = getattr(self._anidb_link, 'promote', None)
+        if command is not None and promote:
+            promote(command)
+
+    def _wait_for_update(self):
+        self._updating.acquire()
+        self._updating.release()
+        return self
 
-    def update(self, block=False):
+    def update(self, block=False, priority=None):
+        """Fetch fresh data for this object from AniDB. Returns a
+        concurrent.futures.Future that resolves to this object when the
+        update is done, or raises IllegalAnimeObject. If an update is already
+        running its future is returned."""
         locked = self._updating.acquire(False)
         if not locked:
+            future = self._update_future
+            if future is None or future.done():
+                # not started by update(); wait for whoever holds the lock
+                future = adbb._update_pool.submit(self._wait_for_update)
             if block:
-                self._updating.acquire(True)
-                self._updating.release()
-            return
-        self._fetch_anidb_data(block=block)
+                self._promote_update()
+                concurrent.futures.wait([future])
+            return future
+        self._update_future = concurrent.futures.Future()
+        self._update_future.set_running_or_notify_cancel()
+        future = self._update_future
+        self._fetch_anidb_data(block=block, priority=priority)
+        return future
+
+    @classmethod
+    async def fetch(cls, *args, **kwargs):
+        """Awaitable constructor; requires adbb.aio.init(). Arguments are the
+        same as for the class itself."""
+        import adbb.aio
+        return await adbb.aio.fetch(cls, *args, **kwargs)
+
+    @classmethod
+    def _identity_key(cls, *args, **kwargs):
+        """Key identifying the object created from these constructor
+        arguments, or None if it can't be known before the object is
+        created."""
+        return None
 
-    def _extra_refresh_probability(self):
-        return 0
+    def _identity_keys(self):
+        """All keys currently identifying this object"""
+        return []
+
+    def _identity_valid(self):
+        return True
 
     def update_if_old(self, block=False):
         if not self.db_data:
             self.update(block=True)
         else:
-            age = datetime.datetime.now(self._timezone) - self._to_timezoneaware(self.db_data.updated)
-            ref = datetime.timedelta()
+            updated = self._to_timezoneaware(self.db_data.updated)
+            age = datetime.datetime.now(self._timezone) - updated
             # never update twice the same day...
             if age < datetime.timedelta(days=1):
                 return
-            # also, if we've already calculated the update probability recently
-            # we should not re-cacluclate it. Timeout is 20 hours which should
+            # the refresh planner decides what to refresh when it's running
+            if adbb._refresh_planner:
+                return
+            # also, if we've already checked if this object is stale recently
+            # we should not check again. Timeout is 20 hours which should
             # be enough for not triggering often, but still allow a daily
             # cronjob to update the cache every day.
             time_since_dice = datetime.datetime.now(self._timezone) - self._to_timezoneaware(self.db_data.last_update_dice)
             if  time_since_dice < datetime.timedelta(hours=20):
                 return
 
-            # probability is in percent
-            # start with any extra refresh probability-parameters this class
-            # implements. Default is 0, meaning it will never request the same
-            # data twice the first week.
-            # 
-            # add 2% probability the second week and than raise probability
-            # ~50% each comming week (rounded up to closest whole percent)
-            class_probability = self._extra_refresh_probability()
-            refresh_probability = 0
-            while refresh_probability < 100:
-                age -= datetime.timedelta(weeks=1)
-                if age < ref:
-                    break
-                if not refresh_probability:
-                    refresh_probability = 2
-                else:
-                    refresh_probability = math.ceil(refresh_probability*1.5)
-            refresh_probability += class_probability
-            refresh_probability = min(100, refresh_probability)
-            adbb.log.debug("Probability of updating {}: {}% ({}% from class rules)".format(
-                self, refresh_probability, class_probability))
+            staleness = self.ttl_policy.staleness(self.db_data)
+            adbb.log.debug("Staleness of {}: {:.2f}".format(self, staleness))
 
-            sess = self._get_db_session()
-            self.db_data = sess.merge(self.db_data)
             self.db_data.last_update_dice = datetime.datetime.now(self._timezone)
-            self._db_commit(sess)
-            self._close_db_session(sess)
+            self._save(self.db_data)
+
+            if staleness >= 1:
+                if adbb.stale_while_revalidate:
+                    block = False
+                self.update(block=block, priority='background')
+
+    def _update_requests(self):
+        """Generator yielding (command, callback, event) for each AniDB
+        request needed to update this object. The next request is not built
+        until callback has handled the response to the previous one, and
+        event is set by callback when it's done."""
+        raise Exception("Not implemented")
 
-            if random.randint(0, 100) <= refresh_probability:
-                self.update(block=block)
+    def _update_steps(self, **kwargs):
+        """_update_requests() with the bookkeeping every update needs, for
+        both the threaded and the asyncio link: objects AniDB recently
+        didn't know about are not asked about again, sent requests are
+        counted, and the negative cache is updated when the generator is
+        exhausted or closed."""
+        negative_key = self._negative_key
+        asked = False
+        self._update_promoted = False
+        try:
+            if negative_key and adbb.negcache.check(*negative_key):
+                adbb.log.debug("{} {} recently not found in AniDB; not asking again".format(
+                    *negative_key))
+                self._illegal_object = True
+                return
+            for req, callback, event in self._update_requests(**kwargs):
+                asked = True
+                self._sent_requests += 1
+                self._update_command = req
+                yield req, callback, event
+        finally:
+            self._update_command = None
+            if asked and negative_key:
+                if super(AniDBObj, self).__getattribute__('_illegal_object'):
+                    adbb.negcache.add(*negative_key)
+                else:
+                    adbb.negcache.remove(*negative_key)
 
-    def _send_anidb_update_req(self):
-        raise Exception("Not implemented")
+    def _send_anidb_update_req(self, prio=False, priority=None, **kwargs):
+        steps = self._update_steps(**kwargs)
+        try:
+            for req, callback, event in steps:
+                event.clear()
+                if self._update_promoted:
+                    priority = 'interactive'
+                self._anidb_link.request(req, callback, prio=prio, priority=priority)
+                event.wait()
+        finally:
+            steps.close()
+            self._updating.release()
+
+    def _save(self, row, relations=None):
+        """Queue row (db_data, changed in place, or a new row) to be upserted
+        by adbb.writebehind. If relations is given the stored relations of the
+        row are replaced with them."""
+        if relations is not None:
+            sqlalchemy.orm.attributes.set_committed_value(row, 'relations', relations)
+
+        def _write(sess):
+            # set right away, so that the row is updated rather than inserted
+            # again if it's saved again in the same batch
+            row.pk = adbb.db.upsert_row(sess, row)
+            if relations is not None:
+                adbb.db.replace_relations(sess, type(row), row.pk, relations)
+
+        adbb.writebehind.submit(_write)
 
     def _close_db_session(self, session):
         session.close()
@@ -132,20 +281,9 @@ class AniDBObj(object):
     def _get_db_session(self):
         return adbb.get_session()
 
-    def _db_commit(self, session):
-        try:
-            session.commit()
-            adbb.log.debug("Object saved to database: {}".format(self.db_data))
-        except sqlalchemy.exc.DBAPIError as e:
-            if self.db_data:
-                adbb.log.warning("Failed to update data {}: {}".format(
-                    self.db_data, e))
-            else:
-                adbb.log.warning("Failed to update db: {}".format(e))
-            session.rollback()
-
     def __getattribute__(self, attr):
-        if attr in ['_updated', '_updating', '_anidb_link']:
+        if attr in ['_updated', '_updating', '_update_future', '_anidb_link', '_negative_key',
+                    '_sent_requests', '_update_command', '_update_promoted', '_promote_update']:
             return super(AniDBObj, self).__getattribute__(attr)
         if super(AniDBObj, self).__getattribute__('_illegal_object'):
             raise IllegalAnimeObject("{} is not a valid AniDB object".format(self))
@@ -160,8 +298,14 @@ class AniDBObj(object):
             if local_name in local_vars and local_vars[local_name]:
                 return local_vars[local_name]
 
-        super(AniDBObj, self).__getattribute__('_updating').acquire()
-        super(AniDBObj, self).__getattribute__('_updating').release()
+        # In stale-while-revalidate mode a cached row is returned even if an
+        # update is running; only objects not in the database wait for AniDB.
+        if not (adbb.stale_while_revalidate and \
+                super(AniDBObj, self).__getattribute__('db_data')):
+            if super(AniDBObj, self).__getattribute__('_updating').locked():
+                super(AniDBObj, self).__getattribute__('_promote_update')()
+            super(AniDBObj, self).__getattribute__('_updating').acquire()
+            super(AniDBObj, self).__getattribute__('_updating').release()
         super(AniDBObj, self).__getattribute__('update_if_old')()
         # Not quite sure, but something-something db_data missing-something...
         if name == 'relations':
@@ -173,6 +317,8 @@ class AniDBObj(object):
 
 
 class Anime(AniDBObj):
+    ttl_policy = adbb.ttl.AnimeTTLPolicy()
+
     def __init__(self, init):
         super(Anime, self).__init__()
         self._aid = None
@@ -192,39 +338,37 @@ class Anime(AniDBObj):
 
         self._title = [x.title for x in self.titles
                        if x.lang is None and x.titletype == 'main'][0]
+        self._negative_key = ('anime', str(self._aid))
         self.db_data = None
         self._get_db_data()
 
-    def _extra_refresh_probability(self):
-        now = datetime.datetime.now(self._timezone)
-        ref = datetime.timedelta()
-        # The shorter time there is between when anidb updated this
-        # anime and we fetched our data, the more likely is it that it has
-        # changed again. So we start at 30%, and removes 10% for each week
-        probability = 30
-        data_age = self._to_timezoneaware(self.db_data.updated) - self.db_data.anidb_updated.replace(tzinfo=self._timezone)
-        while probability > 0:
-            data_age -= datetime.timedelta(weeks=1)
-            if data_age < ref:
-                break
-            probability -= 10
-        return max(probability, 0)
+    @classmethod
+    def _identity_key(cls, init):
+        if isinstance(init, int):
+            return ('aid', init)
+        return None
+
+    def _identity_keys(self):
+        return [('aid', self._aid)]
 
-    def _get_db_data(self, close=True):
+    @_scoped
+    def _get_db_data(self):
         sess = self._get_db_session()
-        res = sess.query(AnimeTable).filter_by(aid=self.aid).all()
-        if len(res) > 0:
-            self.db_data = res[0]
-        if close:
+        try:
+            res = sess.query(AnimeTable).filter_by(aid=self.aid).all()
+            if len(res) > 0:
+                self.db_data = res[0]
+        finally:
             self._close_db_session(sess)
 
+    @_scoped
     def _db_data_callback(self, res):
         ainfo = res.datalines[0]
         relations = []
         new = None
         if res.rescode == "330":
             self._illegal_object = True
-            self.log.warning('{} is not a valid Anime object'.format(self))
+            adbb.log.warning('{} is not a valid Anime object'.format(self))
             self._updated.set()
             return
 
@@ -247,63 +391,38 @@ class Anime(AniDBObj):
             if attr in adbb.mapper.anime_map_a_converters:
                 ainfo[attr] = adbb.mapper.anime_map_a_converters[attr](data)
 
-        try:
-            sess = self._get_db_session()
-            if self.db_data:
-                self.db_data = sess.merge(self.db_data)
-                self.db_data.update(**ainfo)
-                self.db_data.updated = datetime.datetime.now(self._timezone)
-                new_relations = []
-                for r in relations:
-                    found = False
-                    for sr in self.db_data.relations:
-                        if r.related_aid == sr.related_aid:
-                            found = True
-                            sr.relation_type = r.relation_type
-                            sr.anime_pk = self.db_data.pk
-                            new_relations.append(sr)
-                    if not found:
-                        r.anime_pk = self.db_data.pk
-                        new_relations.append(r)
-                for r in self.db_data.relations:
-                    if r not in new_relations:
-                        sess.delete(r)
-                self.db_data.relations = new_relations
-            else:
-                new = AnimeTable(**ainfo)
-                new.updated = datetime.datetime.now(self._timezone)
-                new.last_update_dice = datetime.datetime.now(self._timezone)
-                new.relations = relations
-                # commit to sql database
-                sess.add(new)
-
-            if new:
-                self.db_data = new
-            self._db_commit(sess)
-            self._close_db_session(sess)
-        except sqlalchemy.exc.OperationalError:
-            adbb.log.error(f"Failed to update {self} in database")
+        now = datetime.datetime.now(self._timezone)
+        if self.db_data:
+            self.db_data.update(**ainfo)
+            self.db_data.updated = now
+            self._save(self.db_data, relations)
+        else:
+            new = AnimeTable(**ainfo)
+            new.updated = now
+            new.last_update_dice = now
+            self.db_data = new
+            self._save(new, relations)
         self._updated.set()
 
-    def _send_anidb_update_req(self, prio=False):
-        self._updated.clear()
+    def _update_requests(self):
         req = AnimeCommand(
             aid=str(self.aid),
             amask=adbb.mapper.getAnimeBitsA(adbb.mapper.anime_map_a))
-        self._anidb_link.request(req, self._db_data_callback, prio=prio)
-        self._updated.wait()
-        self._updating.release()
+        yield req, self._db_data_callback, self._updated
 
     @property
+    @_scoped
     def in_mylist(self):
         if self._in_mylist != None:
             return self._in_mylist
         try:
             sess = self._get_db_session()
-            res = sess.query(FileTable).filter(
-                FileTable.aid == self._aid,
-                FileTable.lid != None).first()
-            self._close_db_session(sess)
+            try:
+                res = sess.query(FileTable).filter(
+                    FileTable.aid == self._aid,
+                    FileTable.lid != None).first()
+            finally:
+                self._close_db_session(sess)
             self._in_mylist = bool(res)
         except sqlalchemy.exc.OperationalError as e:
             adbb.log.error(f'Failed to get mylist status of {self} from database: {e}')
@@ -311,14 +430,15 @@ class Anime(AniDBObj):
         return self._in_mylist
 
     @property
+    @_scoped
     def relations(self):
         try:
             relations = [(x.relation_type, Anime(x.related_aid)) for x in self.db_data.relations]
         except sqlalchemy.orm.exc.DetachedInstanceError:
-            self._get_db_data(close=False)
-            sess = self._get_db_session()
+            # the row is loaded into the session of the scope, which is open
+            # until this returns
+            self._get_db_data()
             relations = [(x.relation_type, Anime(x.related_aid)) for x in self.db_data.relations]
-            self._close_db_session(sess)
         return relations
 
     def extid(self, source, id_type='tv'):
@@ -415,9 +535,20 @@ class AnimeTitle:
 
 
 class Episode(AniDBObj):
+    ttl_policy = adbb.ttl.EpisodeTTLPolicy()
     _eid = None
     _anime = None
     _episode_number = None
+    # EPISODE fields that aren't in FILE responses; reading one of these
+    # from an episode saved from a FILE response fetches it from AniDB
+    _file_missing_fields = ('aired',)
+
+    def __getattr__(self, name):
+        if name in self._file_missing_fields:
+            db_data = super(AniDBObj, self).__getattribute__('db_data')
+            if db_data is not None and db_data.partial:
+                self.update(block=True)
+        return super(Episode, self).__getattr__(name)
 
     @property
     def episode_number(self):
@@ -480,15 +611,18 @@ class Episode(AniDBObj):
         return self._get_mdbid(self.anime.extid('imdb', 'movie'))
 
     @property
+    @_scoped
     def in_mylist(self):
         if self._in_mylist != None:
             return self._in_mylist
         try:
             sess = self._get_db_session()
-            res = sess.query(FileTable).filter(
-                FileTable.eid == self.eid,
-                FileTable.lid != None).first()
-            self._close_db_session(sess)
+            try:
+                res = sess.query(FileTable).filter(
+                    FileTable.eid == self.eid,
+                    FileTable.lid != None).first()
+            finally:
+                self._close_db_session(sess)
             self._in_mylist = bool(res)
         except sqlalchemy.exc.OperationalError as e:
             adbb.log.error(f'Failed to get mylist status of {self} from database: {e}')
@@ -524,75 +658,97 @@ class Episode(AniDBObj):
             except ValueError:
                 pass
             self._episode_number = epno
+        if eid:
+            self._negative_key = ('episode', str(eid))
+        elif anime:
+            aid = self._anime._aid if isinstance(self._anime, Anime) else self._anime
+            self._negative_key = ('episode', '{}:{}'.format(aid, self._episode_number))
         self.db_data = None
         self._get_db_data()
 
+    @classmethod
+    def _identity_key(cls, anime=None, epno=None, eid=None):
+        if eid:
+            return ('eid', int(eid))
+        if isinstance(anime, Anime):
+            anime = super(AniDBObj, anime).__getattribute__('_aid')
+        if isinstance(anime, int) and epno:
+            try:
+                epno = str(int(epno))
+            except ValueError:
+                pass
+            return ('epno', anime, str(epno).upper())
+        return None
+
+    def _identity_keys(self):
+        keys = []
+        eid = self._eid or (self.db_data and self.db_data.eid)
+        if eid:
+            keys.append(('eid', int(eid)))
+        aid = self._anime
+        if isinstance(aid, Anime):
+            aid = aid._aid
+        if aid and self._episode_number:
+            keys.append(('epno', aid, str(self._episode_number).upper()))
+        return keys
+
+    @_scoped
     def _get_db_data(self):
         sess = self._get_db_session()
-        if self._eid:
-            res = sess.query(EpisodeTable).filter_by(eid=self._eid).all()
-        else:
-            res = sess.query(EpisodeTable).filter(
-                EpisodeTable.aid==self._anime.aid,
-                EpisodeTable.epno.ilike(self.episode_number)).all()
-        if len(res) > 0:
-            self.db_data = res[0]
-            adbb.log.debug("Found db_data for episode: {}".format(self.db_data))
-            if self.db_data.epno:
-                self._episode_number = self.db_data.epno
-            if not self._anime:
-                self._anime = self.db_data.aid
-        self._close_db_session(sess)
-
-    def _anidb_data_callback(self, res):
         try:
-            sess = self._get_db_session()
-            if res.rescode == "340":
-                adbb.log.warning("No such episode in anidb: {}".format(self))
-                self._illegal_object = True
-                self._updated.set()
-                return
-            einfo = res.datalines[0]
-            new = None
-            for attr, data in einfo.items():
-                if attr == 'epno':
-                    try:
-                        einfo[attr] = str(int(data))
-                    except ValueError:
-                        pass
-                    continue
-                if attr in ('title_eng', 'title_romaji', 'title_kanji'):
-                    continue
-                einfo[attr] = adbb.mapper.episode_map_converters[attr](data)
-
-            if self.db_data:
-                self.db_data = sess.merge(self.db_data)
-                self.db_data.update(**einfo)
-                self.db_data.updated = datetime.datetime.now(self._timezone)
+            if self._eid:
+                res = sess.query(EpisodeTable).filter_by(eid=self._eid).all()
             else:
-                new = EpisodeTable(**einfo)
-                new.updated = datetime.datetime.now(self._timezone)
-                new.last_update_dice = datetime.datetime.now(self._timezone)
-                sess.add(new)
+                res = sess.query(EpisodeTable).filter_by(
+                    aid=self._anime.aid,
+                    epno_normalized=adbb.db.normalize_epno(self.episode_number)).all()
+            if len(res) > 0:
+                self.db_data = res[0]
+                adbb.log.debug("Found db_data for episode: {}".format(self.db_data))
+                if self.db_data.epno:
+                    self._episode_number = self.db_data.epno
+                if not self._anime:
+                    self._anime = self.db_data.aid
+        finally:
+            self._close_db_session(sess)
 
-            if new:
-                self.db_data = new
+    @_scoped
+    def _anidb_data_callback(self, res):
+        if res.rescode == "340":
+            adbb.log.warning("No such episode in anidb: {}".format(self))
+            self._illegal_object = True
+            self._updated.set()
+            return
+        einfo = res.datalines[0]
+        for attr, data in einfo.items():
+            if attr == 'epno':
+                try:
+                    einfo[attr] = str(int(data))
+                except ValueError:
+                    pass
+                continue
+            if attr in ('title_eng', 'title_romaji', 'title_kanji'):
+                continue
+            einfo[attr] = adbb.mapper.episode_map_converters[attr](data)
 
-            self._db_commit(sess)
-            self._close_db_session(sess)
-        except sqlalchemy.exc.OperationalError:
-            adbb.log.error(f"Failed to update {self} in database")
+        einfo['partial'] = False
+        if self.db_data:
+            self.db_data.update(**einfo)
+            self.db_data.updated = datetime.datetime.now(self._timezone)
+        else:
+            new = EpisodeTable(**einfo)
+            new.updated = datetime.datetime.now(self._timezone)
+            new.last_update_dice = datetime.datetime.now(self._timezone)
+            self.db_data = new
+        self._save(self.db_data)
         self._updated.set()
 
-    def _send_anidb_update_req(self, prio=False):
-        self._updated.clear()
+    def _update_requests(self):
         if self._eid:
             req = EpisodeCommand(eid=self._eid)
         else:
             req = EpisodeCommand(aid=self._anime.aid, epno=self.episode_number)
-        self._anidb_link.request(req, self._anidb_data_callback, prio=prio)
-        self._updated.wait()
-        self._updating.release()
+        yield req, self._anidb_data_callback, self._updated
 
     def __eq__(self, other):
         if not isinstance(other, Episode):
@@ -614,6 +770,7 @@ class Episode(AniDBObj):
 
 
 class File(AniDBObj):
+    ttl_policy = adbb.ttl.FileTTLPolicy()
     _anime = None
     _episode = None
     _group = None
@@ -770,6 +927,12 @@ class File(AniDBObj):
             self._ed2khash = self.db_data.ed2khash
         return self._ed2khash
 
+    @classmethod
+    async def resolve(cls, path, **kwargs):
+        """Awaitable lookup of the file at path; hashing and database access is
+        done in a worker thread. Requires adbb.aio.init()."""
+        return await cls.fetch(path=path, **kwargs)
+
     def __init__(
             self,
             path=None,
@@ -797,10 +960,20 @@ class File(AniDBObj):
                 self._path,
                 self.nfs_obj)
             adbb.log.debug("Created File {} - size: {}, mtime: {}".format(self._path, self._size, self._mtime))
+            # not keyed on mtime; touching or copying a file doesn't make
+            # AniDB know about it
+            self._negative_key = ('file', '{}:{}'.format(self._path, self._size))
         if fid:
             self._fid = int(fid)
+            self._negative_key = self._negative_key or ('file', 'fid:{}'.format(self._fid))
         if lid:
             self._lid = int(lid)
+            self._negative_key = self._negative_key or ('file', 'lid:{}'.format(self._lid))
+        if path and adbb.negcache.check(*self._negative_key):
+            # no need to hash files AniDB recently didn't know about
+            adbb.log.info("{} was recently not found in AniDB; ignoring it".format(path))
+            self._illegal_object = True
+            return
         if anime:
             if isinstance(anime, Anime):
                 self._anime = anime
@@ -814,47 +987,90 @@ class File(AniDBObj):
                 self._multiep = [episode]
         self._get_db_data()
 
+    @classmethod
+    def _identity_key(cls, path=None, fid=None, lid=None, anime=None, episode=None,
+                      nfs_obj=None, force_single_episode_series=False, parse_dir=True):
+        if fid:
+            return ('fid', int(fid))
+        if lid:
+            return ('lid', int(lid))
+        if path:
+            return ('path', path, force_single_episode_series, parse_dir)
+        return None
+
+    def _identity_keys(self):
+        keys = []
+        fid = self._fid or (self.db_data and self.db_data.fid)
+        if fid:
+            keys.append(('fid', int(fid)))
+        lid = self._lid or (self.db_data and self.db_data.lid)
+        if lid:
+            keys.append(('lid', int(lid)))
+        if self._path:
+            keys.append(('path', self._path, self.force_single_episode_series, self.parse_dir))
+        return keys
+
+    def _identity_valid(self):
+        # a file object is only reused as long as the file on disk is unchanged
+        if not self._path:
+            return True
+        try:
+            mtime, size = adbb.fileinfo.get_file_stats(self._path, self.nfs_obj)
+        except OSError:
+            return False
+        return (mtime, size) == (self._mtime, self._size)
+
+    @_scoped
     def _get_db_data(self):
         sess = self._get_db_session()
-        res = None
-        if self._fid:
-            res = sess.query(FileTable).filter_by(fid=self._fid).all()
-        elif self._lid:
-            res = sess.query(FileTable).filter_by(lid=self._lid).all()
-        elif self._path:
-            res = sess.query(FileTable).filter_by(path=self._path).all()
-            if res and res[0].size != self._size:
-                sess.delete(res[0])
-                self._db_commit(sess)
-                res = []
-            if not res:
+        try:
+            res = None
+            if self._fid:
+                res = sess.query(FileTable).filter_by(fid=self._fid).all()
+            elif self._lid:
+                res = sess.query(FileTable).filter_by(lid=self._lid).all()
+            elif self._path:
+                res = sess.query(FileTable).filter_by(path=self._path).all()
+                if res and res[0].size != self._size:
+                    old = res[0]
+
+                    def _delete(sess):
+                        sess.delete(sess.merge(old))
+
+                    adbb.writebehind.submit(_delete)
+                    res = []
+                if not res:
+                    res = sess.query(FileTable).filter_by(
+                            size=self._size,
+                            ed2khash=self.ed2khash).all()
+            elif self._episode.eid:
                 res = sess.query(FileTable).filter_by(
-                        size=self._size,
-                        ed2khash=self.ed2khash).all()
-        elif self._episode.eid:
-            res = sess.query(FileTable).filter_by(
-                aid=self._anime.aid,
-                eid=self._episode.eid).all()
+                    aid=self._anime.aid,
+                    eid=self._episode.eid).all()
+                if res and len(res) > 0:
+                    res = [x for x in res if x.lid]
             if res and len(res) > 0:
-                res = [x for x in res if x.lid]
-        if res and len(res) > 0:
-            self.db_data = res[0]
-            if self._path and self._path != self.db_data.path:
-                self.db_data.path = self._path
-            if not self.db_data.aid or not self.db_data.eid:
-                anime, episodes = self._guess_anime_ep_from_file()
-                self.db_data.aid = anime.aid
-                self.db_data.eid = episodes[0].eid
-
-            sess.merge(self.db_data)
-            self._db_commit(sess)
-            adbb.log.debug("Found db_data for file: {}".format(self.db_data))
-            self._is_generic = self.db_data.is_generic
-            self._part = self.db_data.part
-        if not self._anime and self.db_data and self.db_data.aid:
-            self._anime = Anime(self.db_data.aid)
-        self._close_db_session(sess)
+                self.db_data = res[0]
+                changed = False
+                if self._path and self._path != self.db_data.path:
+                    self.db_data.path = self._path
+                    changed = True
+                if not self.db_data.aid or not self.db_data.eid:
+                    anime, episodes = self._guess_anime_ep_from_file()
+                    self.db_data.aid = anime.aid
+                    self.db_data.eid = episodes[0].eid
+                    changed = True
+                if changed:
+                    self._save(self.db_data)
+                adbb.log.debug("Found db_data for file: {}".format(self.db_data))
+                self._is_generic = self.db_data.is_generic
+                self._part = self.db_data.part
+            if not self._anime and self.db_data and self.db_data.aid:
+                self._anime = Anime(self.db_data.aid)
+        finally:
+            self._close_db_session(sess)
 
+    @_scoped
     def _anidb_file_data_callback(self, res):
         new = None
         update_mylist = False
@@ -868,21 +1084,28 @@ class File(AniDBObj):
                     anime, episodes = self._guess_anime_ep_from_file(aid=self._anime.aid)
                 else:
                     anime, episodes = self._guess_anime_ep_from_file()
-                if anime and episodes:
+                guessed = anime is not None and bool(episodes)
+                if guessed:
                     self._multiep = [e.episode_number for e in episodes]
                     self._anime = anime
                     self._episode = episodes[0]
-                try:
-                    finfo['aid'] = anime.aid
-                    finfo['eid'] = episodes[0].eid
-                    finfo['is_generic'] = self._is_generic
-                except (IllegalAnimeObject, IndexError):
+                    try:
+                        finfo['aid'] = anime.aid
+                        finfo['eid'] = episodes[0].eid
+                        finfo['is_generic'] = self._is_generic
+                    except IllegalAnimeObject:
+                        guessed = False
+                if not guessed:
+                    # nothing could be guessed from the filename either
                     self._illegal_object = True
+                    super(AniDBObj, self).__getattribute__('_file_updated').set()
                     return
         else: 
             finfo = res.datalines[0]
             state = None
             adbb.log.debug("{} is in anidb".format(self))
+            epinfo = {adbb.mapper.file_episode_map[x]: finfo.pop(x)
+                      for x in list(finfo) if x in adbb.mapper.file_episode_map}
 
             # if this file previously was generic, the file has probably been
             # added to anidb. We should remove any generic file from mylist and
@@ -923,6 +1146,8 @@ class File(AniDBObj):
             elif state & 0x80:
                 finfo['censored'] = True
 
+            self._save_episode_from_file(finfo, epinfo)
+
         if self._path:
             finfo['path'] = self._path
             finfo['size'] = self._size
@@ -955,25 +1180,16 @@ class File(AniDBObj):
             if not self.db_data.eid and not 'eid' in finfo:
                 finfo['eid'] = episodes[0].eid
 
-        try:
-            sess = self._get_db_session()
-            if self.db_data:
-                self.db_data = sess.merge(self.db_data)
-                adbb.log.debug('{}: update {}'.format(self, finfo))
-                self.db_data.update(**finfo)
-                self.db_data.updated = datetime.datetime.now(self._timezone)
-            else:
-                new = FileTable(**finfo)
-                new.updated = datetime.datetime.now(self._timezone)
-                new.last_update_dice = datetime.datetime.now(self._timezone)
-                sess.add(new)
-
-            if new:
-                self.db_data = new
-            self._db_commit(sess)
-            self._close_db_session(sess)
-        except sqlalchemy.exc.OperationalError:
-            adbb.log.error(f"Failed to update {self} in database")
+        if self.db_data:
+            adbb.log.debug('{}: update {}'.format(self, finfo))
+            self.db_data.update(**finfo)
+            self.db_data.updated = datetime.datetime.now(self._timezone)
+        else:
+            new = FileTable(**finfo)
+            new.updated = datetime.datetime.now(self._timezone)
+            new.last_update_dice = datetime.datetime.now(self._timezone)
+            self.db_data = new
+        self._save(self.db_data)
         self._file_updated.set()
 
         if update_mylist:
@@ -983,6 +1199,75 @@ class File(AniDBObj):
                     source = self.db_data.mylist_source,
                     other = self.db_data.mylist_other)
 
+    def _save_episode_from_file(self, finfo, epinfo):
+        # The FILE response contains most of what the EPISODE command would
+        # return, so save the episode here to avoid another request when it's
+        # accessed. Existing episodes are only updated, since some fields (like
+        # the air date) are not in the FILE response; new episodes are marked
+        # partial so that those are fetched when they're read.
+        if not (finfo.get('aid') and finfo.get('eid') and finfo.get('epno')):
+            return
+        epno = finfo['epno']
+        try:
+            epno = str(int(epno))
+        except ValueError:
+            pass
+        for attr in ('title_eng', 'title_romaji', 'title_kanji'):
+            if attr in epinfo:
+                epinfo[attr] = epinfo[attr] or None
+        for attr in ('rating', 'votes'):
+            if epinfo.get(attr):
+                epinfo[attr] = adbb.mapper.episode_map_converters[attr](epinfo[attr])
+            else:
+                epinfo.pop(attr, None)
+
+        if finfo.get('length_in_seconds'):
+            length = round(finfo['length_in_seconds']/60)
+        else:
+            length = 0
+
+        now = datetime.datetime.now(self._timezone)
+        values = dict(
+                aid=finfo['aid'],
+                eid=finfo['eid'],
+                epno=epno,
+                type=adbb.mapper.episode_prefix_type_map.get(epno[:1].upper(), 'regular'),
+                length=length,
+                votes=0,
+                partial=True,
+                updated=now,
+                last_update_dice=now)
+        values.update(epinfo)
+        values['epno_normalized'] = adbb.db.normalize_epno(epno)
+        update = dict(epno=epno, epno_normalized=values['epno_normalized'], **epinfo)
+
+        def _write(sess):
+            adbb.db.upsert(sess, EpisodeTable.__table__, values, 'eid', update=update)
+            adbb.log.debug("Episode {} saved from FILE response".format(finfo['eid']))
+
+        def _written(_result):
+            self._refresh_live_episode(finfo['aid'], finfo['eid'], epno, update)
+
+        adbb.writebehind.submit(_write, _written)
+
+    @staticmethod
+    def _refresh_live_episode(aid, eid, epno, values):
+        # an Episode object for the saved episode may already exist, with
+        # db_data loaded before the FILE response was saved
+        cache = adbb._object_cache
+        if cache is None:
+            return
+        episode = cache.get(Episode, ('eid', int(eid))) or \
+                cache.get(Episode, ('epno', aid, epno.upper()))
+        if episode is None:
+            return
+        db_data = object.__getattribute__(episode, 'db_data')
+        if db_data:
+            db_data.update(**values)
+        elif not object.__getattribute__(episode, '_updating').locked():
+            episode._get_db_data()
+
+    @_scoped
     def _anidb_mylist_data_callback(self, res):
         new = None
         if res.rescode == '312':
@@ -1001,93 +1286,77 @@ class File(AniDBObj):
         if 'mylist_viewdate' in finfo and finfo['mylist_viewdate']:
             finfo['mylist_viewed'] = True
 
-        try:
-            sess = self._get_db_session()
-            if (self.db_data and self.db_data.is_generic and finfo['gid']) or \
-                    (self.db_data and not self.db_data.is_generic and finfo['fid'] != self.db_data.fid):
-                if finfo['gid']:
-                    finfo['is_generic'] = False
-                else:
-                    finfo['is_generic'] = True
-
-                # there is something in mylist; but it's not us :/
-                res = sess.query(FileTable).filter_by(lid=finfo['lid']).all()
-                if not res:
-                    new = FileTable(**finfo)
-                    new.updated = datetime.datetime.now(self._timezone)
-                    new.last_update_dice = datetime.datetime.now(self._timezone)
-                    sess.add(new)
+        if (self.db_data and self.db_data.is_generic and finfo['gid']) or \
+                (self.db_data and not self.db_data.is_generic and finfo['fid'] != self.db_data.fid):
+            if finfo['gid']:
+                finfo['is_generic'] = False
+            else:
+                finfo['is_generic'] = True
+            now = datetime.datetime.now(self._timezone)
+
+            # there is something in mylist; but it's not us :/
+            def _write(sess):
+                obj = sess.query(FileTable).filter_by(lid=finfo['lid']).first()
+                if not obj:
+                    obj = FileTable(**finfo)
+                    sess.add(obj)
                 else:
-                    obj = res[0]
-                    obj.updated = datetime.datetime.now(self._timezone)
-                    obj.last_update_dice = datetime.datetime.now(self._timezone)
                     obj.update(**finfo)
-                self._db_commit(sess)
-                self._close_db_session(sess)
-                self._mylist_updated.set()
-                return
+                obj.updated = now
+                obj.last_update_dice = now
 
-            if self._path:
-                finfo['path'] = self._path
-                finfo['size'] = self._size
-                finfo['ed2khash'] = self._ed2khash
-                finfo['mtime'] = self._mtime
+            adbb.writebehind.submit(_write)
+            self._mylist_updated.set()
+            return
 
-            finfo['part'] = self._part
+        if self._path:
+            finfo['path'] = self._path
+            finfo['size'] = self._size
+            finfo['ed2khash'] = self._ed2khash
+            finfo['mtime'] = self._mtime
 
-            if finfo['gid']:
-                self._is_generic = False
-            else:
-                self._is_generic = True
-            finfo['is_generic'] = self._is_generic
-            if self.db_data:
-                adbb.log.debug("New mylist info: {}".format(finfo))
-                self.db_data = sess.merge(self.db_data)
-                self.db_data.update(**finfo)
-                self.db_data.updated = datetime.datetime.now(self._timezone)
-            else:
-                new = FileTable(**finfo)
-                new.updated = datetime.datetime.now(self._timezone)
-                new.last_update_dice = datetime.datetime.now(self._timezone)
-                adbb.log.debug("Adding mylist info: {}".format(finfo))
-                sess.add(new)
-
-            if new:
-                self.db_data = new
-            self._db_commit(sess)
-            self._close_db_session(sess)
-        except sqlalchemy.exc.OperationalError:
-            adbb.log.error(f"Failed to update {self} in database")
+        finfo['part'] = self._part
+
+        if finfo['gid']:
+            self._is_generic = False
+        else:
+            self._is_generic = True
+        finfo['is_generic'] = self._is_generic
+        if self.db_data:
+            adbb.log.debug("New mylist info: {}".format(finfo))
+            self.db_data.update(**finfo)
+            self.db_data.updated = datetime.datetime.now(self._timezone)
+        else:
+            new = FileTable(**finfo)
+            new.updated = datetime.datetime.now(self._timezone)
+            new.last_update_dice = datetime.datetime.now(self._timezone)
+            adbb.log.debug("Adding mylist info: {}".format(finfo))
+            self.db_data = new
+        self._save(self.db_data)
         self._mylist_updated.set()
 
-    def _send_anidb_update_req(self, prio=False, req_mylist=False, req_file=True):
+    def _update_requests(self, req_mylist=False, req_file=True):
         adbb.log.debug("updating - fid: {}, size: {}, path: {}".format(
             self._fid,
             self._size,
             self._path))
         if req_file:
             if self._fid:
-                self._file_updated.clear()
                 adbb.log.debug("sending file request with fid")
                 req = FileCommand(
                     fid=self._fid,
                     fmask=adbb.mapper.getFileBitsF(adbb.mapper.file_map_f),
-                    amask=adbb.mapper.getFileBitsA(['epno'])
+                    amask=adbb.mapper.getFileBitsA(['epno'] + list(adbb.mapper.file_episode_map))
                 )
-                self._anidb_link.request(req, self._anidb_file_data_callback,
-                                         prio=prio)
-                self._file_updated.wait()
+                yield req, self._anidb_file_data_callback, self._file_updated
             elif self._size and self._path:
-                self._file_updated.clear()
                 adbb.log.debug("sending file request with size and hash")
                 req = FileCommand(
                     size=self._size,
                     ed2k=self.ed2khash,
                     fmask=adbb.mapper.getFileBitsF(adbb.mapper.file_map_f),
-                    amask=adbb.mapper.getFileBitsA(['epno']))
-                self._anidb_link.request(req, self._anidb_file_data_callback,
-                                         prio=prio)
-                self._file_updated.wait()
+                    amask=adbb.mapper.getFileBitsA(['epno'] + list(adbb.mapper.file_episode_map)))
+                yield req, self._anidb_file_data_callback, self._file_updated
 
         # We want to send a mylist request only if explicitly asked for, or if
         # we didn't get a fid from the File request
@@ -1104,10 +1373,7 @@ class File(AniDBObj):
                     aid=self.anime.aid,
                     epno=self.episode.episode_number)
             adbb.log.debug("sending mylist request")
-            self._anidb_link.request(req, self._anidb_mylist_data_callback,
-                                     prio=prio)
-            self._mylist_updated.wait()
-        self._updating.release()
+            yield req, self._anidb_mylist_data_callback, self._mylist_updated
 
     def __repr__(self):
         db_data = super(AniDBObj, self).__getattribute__('db_data')
@@ -1140,10 +1406,10 @@ class File(AniDBObj):
 
         if self.db_data and self.db_data.fid:
             req = MyListDelCommand(fid=self.db_data.fid)
-            self._anidb_link.request(req, _mylistdel_callback, prio=True)
+            adbb.outbox.send(req, _mylistdel_callback)
         elif self.db_data and self.db_data.lid:
             req = MyListDelCommand(lid=self.db_data.lid)
-            self._anidb_link.request(req, _mylistdel_callback, prio=True)
+            adbb.outbox.send(req, _mylistdel_callback)
         elif self._is_generic:
             if self._multiep:
                 episodes = self._multiep
@@ -1154,15 +1420,14 @@ class File(AniDBObj):
                 req = MyListDelCommand(
                     aid=self._anime.aid,
                     epno=self.episode.episode_number)
-                self._anidb_link.request(req, _mylistdel_callback, prio=True)
+                adbb.outbox.send(req, _mylistdel_callback)
                 wait.wait()
         else:
             req = MyListDelCommand(
                 size=self.size,
                 ed2k=self.ed2khash)
-            self._anidb_link.request(req, _mylistdel_callback, prio=True)
+            adbb.outbox.send(req, _mylistdel_callback)
         self._lid = None
-        sess = self._get_db_session()
         finfo = {
             'mylist_state': None,
             'mylist_filestate': None,
@@ -1173,10 +1438,8 @@ class File(AniDBObj):
             'mylist_other': None,
             'lid': None,
         }
-        self.db_data = sess.merge(self.db_data)
         self.db_data.update(**finfo)
-        self._db_commit(sess)
-        self._close_db_session(sess)
+        self._save(self.db_data)
         wait.wait()
 
     def update_mylist(
@@ -1191,23 +1454,22 @@ class File(AniDBObj):
         edit = False
         req = None
 
+        added = {}
+
         def _mylistadd_callback(res):
-            if res.rescode in ('320', '330', '350', '310', '322', '411'):
+            if res.rescode == '310' and res.datalines and res.datalines[0].get('lid'):
+                # the reply contains the existing mylist entry
+                adbb.log.warning("File {} was already in mylist".format(self))
+                self._anidb_mylist_data_callback(res)
+                added['existing'] = True
+            elif res.rescode in ('320', '330', '350', '310', '322', '411'):
                 adbb.log.warning("Could not add file {} to mylist, anidb says: {}".format(self, res.rescode))
-            elif res.rescode in ('210', '310', '311'):
-                # if 'entrycnt' is > 1 this is actually the lid...
-                # ... which is good I guess, because we want it.
+            elif res.rescode == '210':
+                # when a single file is added 'entrycnt' is actually the
+                # lid of the new entry
                 adbb.log.debug("lines from MYLISTADD command: {}".format(res.datalines))
-                if 'entries' in res.datalines[0]:
-                    res = int(res.datalines[0]['entries'])
-                elif 'entrycnt' in res.datalines[0]:
-                    res = int(res.datalines[0]['entrycnt'])
-                if res > 1:
-                    sess = self._get_db_session()
-                    self.db_data = sess.merge(self.db_data)
-                    self.db_data.update(lid=res)
-                    self._db_commit(sess)
-                    self._close_db_session(sess)
+                if not res.req.parameters.get('generic'):
+                    added['lid'] = int(res.datalines[0]['entrycnt'])
             wait.set()
 
         try:
@@ -1228,9 +1490,10 @@ class File(AniDBObj):
         if not self.lid:
             # avoid a lookup call if we have a file in our database
             sess = self._get_db_session()
-            res = sess.query(FileTable).filter_by(eid=self.episode.eid).all()
-            self._db_commit(sess)
-            self._close_db_session(sess)
+            try:
+                res = sess.query(FileTable).filter_by(eid=self.episode.eid).all()
+            finally:
+                self._close_db_session(sess)
             mylist_entries = [x for x in res if x.lid]
             if mylist_entries:
                 for entry in mylist_entries:
@@ -1283,32 +1546,20 @@ class File(AniDBObj):
                 viewdate=viewdate,
                 source=source,
                 other=other)
-        self._anidb_link.request(req, _mylistadd_callback, prio=True)
-        wait.wait()
+        adbb.outbox.send(req, _mylistadd_callback)
+        if not edit:
+            # edits are not waited for; the outbox makes sure they reach
+            # AniDB, and merges repeated edits of the same entry
+            wait.wait()
         if edit:
-            sess = self._get_db_session()
-            self.db_data = sess.merge(self.db_data)
-            if state:
-                self.db_data.mylist_state = state
-            if watched:
-                self.db_data.mylist_viewed = True
-                if isinstance(watched, datetime.datetime):
-                    self.db_data.mylist_viewdate = watched
-                else:
-                    self.db_data.mylist_viewdate = datetime.datetime.now(self._timezone)
-            else:
-                self.db_data.mylist_viewed = False
-                self.db_data.mylist_viewdate = None
-            if source:
-                self.db_data.mylist_source = source
-            if other:
-                self.db_data.mylist_other = other
-            self._db_commit(sess)
-            self._close_db_session(sess)
-        else:
-            # Oh lord, another slowdown? 
-            # Sorry, since anidb doesn't return our lid and eid when adding we
-            # have to do another request here...
+            self._save_mylist_entry(state, watched, source, other)
+        elif added.get('lid') and self.db_data and self.db_data.eid:
+            # everything else in the new entry is what we just sent
+            self._save_mylist_entry(state, watched, source, other, lid=added['lid'])
+        elif not added.get('existing'):
+            # Generic files are added by anime and episode number, and anidb
+            # only returns the number of entries added; we have to ask for
+            # the new entry.
             locked = self._updating.acquire(False)
             if not locked:
                 self._updating.acquire()
@@ -1317,6 +1568,27 @@ class File(AniDBObj):
             self._send_anidb_update_req(req_file=False, req_mylist=True)
         adbb.log.info("File {} updated in mylist".format(self))
 
+    def _save_mylist_entry(self, state, watched, source, other, lid=None):
+        if lid:
+            self._lid = lid
+            self.db_data.lid = lid
+        if state:
+            self.db_data.mylist_state = state
+        if watched:
+            self.db_data.mylist_viewed = True
+            if isinstance(watched, datetime.datetime):
+                self.db_data.mylist_viewdate = watched
+            else:
+                self.db_data.mylist_viewdate = datetime.datetime.now(self._timezone)
+        else:
+            self.db_data.mylist_viewed = False
+            self.db_data.mylist_viewdate = None
+        if source:
+            self.db_data.mylist_source = source
+        if other:
+            self.db_data.mylist_other = other
+        self._save(self.db_data)
+
     def _guess_anime_ep_from_file(self, aid=None):
         if not self.path:
             return (None, None)
@@ -1465,6 +1737,7 @@ class File(AniDBObj):
         return other.episode_number in self.multiep
 
 class Group(AniDBObj):
+    ttl_policy = adbb.ttl.GroupTTLPolicy()
     _gid = None
     _name = None
 
@@ -1480,107 +1753,91 @@ class Group(AniDBObj):
         self.db_data = None
         self._get_db_data()
 
-    def _anidb_data_callback(self, res):
-        sess = self._get_db_session()
-        if self.db_data:
-            self.db_data = sess.merge(self.db_data)
+    @classmethod
+    def _identity_key(cls, name=None, gid=None):
+        if gid:
+            return ('gid', int(gid))
+        return None
+
+    def _identity_keys(self):
+        gid = self._gid or (self.db_data and self.db_data.gid)
+        if gid:
+            return [('gid', int(gid))]
+        return []
 
+    @_scoped
+    def _anidb_data_callback(self, res):
+        now = datetime.datetime.now(self._timezone)
         if res.rescode == "350":
-            if self.db_data:
-                sess.delete(self.db_data)
+            old = self.db_data
+            new = None
             if self._name:
                 new = GroupTable(
                         name=self._name, 
                         short=self._name,
-                        updated = datetime.datetime.now(self._timezone),
-                        last_update_dice = datetime.datetime.now(self._timezone)
+                        updated=now,
+                        last_update_dice=now
                         )
-                sess.add(new)
-        else:
-            ginfo = res.datalines[0]
-            for attr, data in ginfo.items():
-                if attr == 'relations':
-                    relations = data.split("'")
-                    relations = [
-                            GroupRelationTable(
-                                related_gid = x.split(',')[0],
-                                relation_type = adbb.mapper.group_relation_map[x.split(',')[1]])
-                            for x in relations if ',' in x]
-
-                    if self.db_data:
-                        new_relations = []
-                        for r in relations:
-                            found = False
-                            for sr in self.db_data.relations:
-                                if r.related_gid == sr.related_gid:
-                                    found = True
-                                    sr.relation_type = r.relation_type
-                                    sr.group_pk = self.db_data.pk
-                                    new_relations.append(sr)
-                            if not found:
-                                r.group_pk = self.db_data.pk
-                                new_relations.append(r)
-                        for r in self.db_data.relations:
-                            if r not in new_relations:
-                                sess.delete(r)
-                        relations = new_relations
-
-                    ginfo['relations'] = relations
-                elif attr in adbb.mapper.group_map_converters:
-                    ginfo[attr] = adbb.mapper.group_map_converters[attr](data)
+
+            def _write(sess):
+                if old is not None and old.pk:
+                    sess.delete(sess.merge(old))
+                if new is not None:
+                    sess.add(new)
+
+            adbb.writebehind.submit(_write)
+            self.db_data = new
+            self._updated.set()
+            return
+
+        ginfo = res.datalines[0]
+        relations = []
+        for attr, data in ginfo.items():
+            if attr == 'relations':
+                relations = [
+                        GroupRelationTable(
+                            related_gid = x.split(',')[0],
+                            relation_type = adbb.mapper.group_relation_map[x.split(',')[1]])
+                        for x in data.split("'") if ',' in x]
+            elif attr in adbb.mapper.group_map_converters:
+                ginfo[attr] = adbb.mapper.group_map_converters[attr](data)
+        ginfo.pop('relations', None)
 
         if self.db_data:
             self.db_data.update(**ginfo)
-            self.db_data.updated = datetime.datetime.now(self._timezone)
-            new_relations = []
-            for r in ginfo['relations']:
-                found = False
-                for sr in self.db_data.relations:
-                    if r.related_gid == sr.related_gid:
-                        found = True
-                        sr.relation_type = r.relation_type
-                        sr.group_pk = self.db_data.pk
-                        new_relations.append(sr)
-                if not found:
-                    r.group_pk = self.db_data.pk
-                    new_relations.append(r)
-            for r in self.db_data.relations:
-                if r not in new_relations:
-                    sess.delete(r)
-            self.db_data.relations = new_relations
+            self.db_data.updated = now
+            self._save(self.db_data, relations)
         else:
             new = GroupTable(**ginfo)
-            new.updated = datetime.datetime.now(self._timezone)
-            new.last_update_dice = datetime.datetime.now(self._timezone)
-            sess.add(new)
+            new.updated = now
+            new.last_update_dice = now
             self.db_data = new
-
-        self._db_commit(sess)
-        self._close_db_session(sess)
+            self._save(new, relations)
         self._updated.set()
-                
+
+    @_scoped
     def _get_db_data(self):
         sess = self._get_db_session()
-        if self._gid:
-            res = sess.query(GroupTable).filter_by(gid=self._gid).all()
-        else:
-            res = sess.query(GroupTable).filter(sqlalchemy.or_(
-                GroupTable.name.ilike(self._name), 
-                GroupTable.short.ilike(self._name))).all()
-        if len(res) > 0:
-            self.db_data = res[0]
-            adbb.log.debug("Found db_data for group: {}".format(self.db_data))
-        self._close_db_session(sess)
-
-    def _send_anidb_update_req(self, prio=False):
-        self._updated.clear()
+        try:
+            if self._gid:
+                res = sess.query(GroupTable).filter_by(gid=self._gid).all()
+            else:
+                name = self._name.lower()
+                res = sess.query(GroupTable).filter(sqlalchemy.or_(
+                    sqlalchemy.func.lower(GroupTable.name) == name,
+                    sqlalchemy.func.lower(GroupTable.short) == name)).all()
+            if len(res) > 0:
+                self.db_data = res[0]
+                adbb.log.debug("Found db_data for group: {}".format(self.db_data))
+        finally:
+            self._close_db_session(sess)
+
+    def _update_requests(self):
         if self._gid:
             req = GroupCommand(gid=self._gid)
         else:
             req = GroupCommand(gname=self._name)
-        self._anidb_link.request(req, self._anidb_data_callback, prio=prio)
-        self._updated.wait()
-        self._updating.release()
+        yield req, self._anidb_data_callback, self._updated
 
     def __repr__(self):
         return "Group(gid='{}', name='{}')". \
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import os
+import signal
+import socket
+import threading
+from collections import deque
+
+import adbb
+import adbb.commands
+import adbb.utils
+from adbb.responses import ResponseResolver
+from adbb.workers import WorkerPool
+from adbb.errors import *
+
+DEFAULT_SOCKET = os.path.expanduser('~/.adbb.sock')
+
+# Commands that only the broker itself is allowed to send; the session is
+# owned by the broker.
+RESTRICTED_COMMANDS = ('AUTH', 'ENCRYPT', 'LOGOUT')
+
+# The wire protocol is newline-separated json objects.
+#
+# client -> broker:
+#   {"id": <int>, "command": "<COMMAND>", "parameters": {...}, "prio": <bool>,
+#    "priority": "<priority class>"}
+# broker -> client:
+#   {"id": <int>, "response": "<raw response from AniDB>"}
+#   {"id": <int>, "error": "<reason>"}
+
+
+def _send_message(conn, lock, message):
+    data = json.dumps(message).encode('utf-8') + b'\n'
+    with lock:
+        conn.sendall(data)
+
+
+def _read_messages(conn):
+    buf = b''
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            return
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            if line:
+                yield json.loads(line.decode('utf-8'))
+
+
+class _BrokerClient:
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.send_lock = threading.Lock()
+        self.pending = deque()
+        self.outstanding = 0
+        self.connected = True
+
+    def __repr__(self):
+        return "BrokerClient({})".format(self.name)
+
+
+class AniDBBroker(threading.Thread):
+    """Owns a single AniDBLink and lets other processes on the same host use
+    it through a unix socket. Requests from different clients are handed to
+    the link round-robin, and each client can only have max_outstanding
+    requests in the link queue at a time, so one busy client can not starve
+    the others."""
+
+    def __init__(self, link, socket_path=DEFAULT_SOCKET, max_outstanding=2):
+        super(AniDBBroker, self).__init__()
+        self._link = link
+        self.socket_path = socket_path
+        self.max_outstanding = max_outstanding
+        self._clients = []
+        self._lock = threading.Lock()
+        self._next_client = 0
+        self._client_count = 0
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.sock.listen()
+        self.sock.settimeout(1)
+
+        self.daemon = True
+        self.start()
+
+    def run(self):
+        while self.sock:
+            try:
+                conn, _addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            conn.settimeout(None)
+            self._client_count += 1
+            client = _BrokerClient(conn, self._client_count)
+            with self._lock:
+                self._clients.append(client)
+            adbb.log.debug("Broker client {} connected".format(client.name))
+            thread = threading.Thread(target=self._serve_client, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve_client(self, client):
+        try:
+            for message in _read_messages(client.conn):
+                command = message.get('command')
+                if command in RESTRICTED_COMMANDS:
+                    _send_message(client.conn, client.send_lock, {
+                        'id': message['id'],
+                        'error': 'Command {} is handled by the broker'.format(command)})
+                    continue
+                with self._lock:
+                    client.pending.append(message)
+                self._dispatch()
+        except (OSError, ValueError) as e:
+            adbb.log.warning("Broker client {} failed: {}".format(client.name, e))
+        finally:
+            adbb.log.debug("Broker client {} disconnected".format(client.name))
+            client.connected = False
+            with self._lock:
+                client.pending.clear()
+                if client in self._clients:
+                    self._clients.remove(client)
+            client.conn.close()
+
+    def _dispatch(self):
+        to_send = []
+        with self._lock:
+            progress = True
+            while progress and self._clients:
+                progress = False
+                for i in range(len(self._clients)):
+                    client = self._clients[(self._next_client + i) % len(self._clients)]
+                    if client.pending and client.outstanding < self.max_outstanding:
+                        client.outstanding += 1
+                        to_send.append((client, client.pending.popleft()))
+                        progress = True
+                self._next_client = (self._next_client + 1) % len(self._clients)
+
+        for client, message in to_send:
+            params = {k: v for k, v in message.get('parameters', {}).items() if k not in ('tag', 's')}
+            cmd = adbb.commands.Command(message['command'], **params)
+            self._link.request(
+                    cmd,
+                    self._response_callback(client, message['id']),
+                    prio=message.get('prio', False),
+                    priority=message.get('priority'))
+
+    def _response_callback(self, client, msg_id):
+        def _callback(resp):
+            with self._lock:
+                client.outstanding -= 1
+            if client.connected:
+                try:
+                    _send_message(client.conn, client.send_lock, {
+                        'id': msg_id,
+                        'response': resp.raw})
+                except OSError as e:
+                    adbb.log.warning("Failed to send response to broker client {}: {}".format(
+                        client.name, e))
+            self._dispatch()
+        return _callback
+
+    def stop(self):
+        sock = self.sock
+        self.sock = None
+        if sock:
+            sock.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class BrokerLink:
+    """Drop-in replacement for AniDBLink that sends all commands through an
+    AniDBBroker instead of talking to the API directly."""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, reconnect_interval=5, callback_workers=4):
+        self.socket_path = socket_path
+        self.callbacks = WorkerPool('callback', workers=callback_workers)
+        self.reconnect_interval = reconnect_interval
+        self.rate_limiter = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._next_id = 0
+        self._stop = threading.Event()
+        self._connected = threading.Event()
+        self.sock = None
+        self._connect()
+
+        self._reader = threading.Thread(target=self._read_responses)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.sock = sock
+        self._connected.set()
+        adbb.log.debug("Connected to adbb broker at {}".format(self.socket_path))
+
+    def _reconnect(self):
+        self._connected.clear()
+        while not self._stop.is_set():
+            try:
+                self._connect()
+            except OSError as e:
+                adbb.log.warning("Could not connect to adbb broker: {}; retrying in {} seconds".format(
+                    e, self.reconnect_interval))
+                self._stop.wait(self.reconnect_interval)
+                continue
+            # anything not answered before the connection was lost is sent
+            # again
+            with self._lock:
+                pending = list(self._pending.items())
+            for msg_id, (command, prio, priority) in pending:
+                self._send(msg_id, command, prio, priority)
+            return
+
+    def _send(self, msg_id, command, prio, priority):
+        message = {
+                'id': msg_id,
+                'command': command.command,
+                'parameters': command.parameters,
+                'prio': prio,
+                'priority': priority}
+        try:
+            _send_message(self.sock, self._send_lock, message)
+        except OSError as e:
+            adbb.log.warning("Failed to send {} to adbb broker: {}".format(command.command, e))
+
+    def _read_responses(self):
+        while not self._stop.is_set():
+            try:
+                for message in _read_messages(self.sock):
+                    with self._lock:
+                        command, _prio, _priority = self._pending.pop(message['id'], (None, None, None))
+                    if not command:
+                        continue
+                    if 'error' in message:
+                        adbb.log.error("adbb broker refused {}: {}".format(
+                            command.command, message['error']))
+                        continue
+                    resp = ResponseResolver(message['response'].encode('utf-8')).resolve(command)
+                    resp.parse()
+                    self.callbacks.submit(resp.handle)
+            except (OSError, ValueError) as e:
+                adbb.log.warning("Lost connection to adbb broker: {}".format(e))
+            if not self._stop.is_set():
+                self._reconnect()
+
+    def request(self, command, callback, prio=False, priority=None):
+        command.callback = callback
+        with self._lock:
+            self._next_id += 1
+            msg_id = self._next_id
+            command.tag = msg_id
+            self._pending[msg_id] = (command, prio, priority)
+        adbb.log.debug("Queued command {} at broker with id {}".format(command.command, msg_id))
+        self._connected.wait()
+        self._send(msg_id, command, prio, priority)
+
+    def callback_stats(self):
+        return self.callbacks.stats()
+
+    def is_idle(self):
+        """True if no requests are waiting for an answer from the broker"""
+        with self._lock:
+            return not self._pending
+
+    def stop(self):
+        self._stop.set()
+        if self.sock:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+
+
+def get_broker_args():
+    parser = argparse.ArgumentParser(description="Share a single AniDB UDP session between adbb processes")
+    parser.add_argument(
+            '-d', '--debug',
+            help='show debug information from adbb',
+            action='store_true'
+            )
+    parser.add_argument(
+            '-u', '--username',
+            help='anidb username',
+            )
+    parser.add_argument(
+            '-p', '--password',
+            help='anidb password'
+            )
+    parser.add_argument(
+            '-s', '--sql-url',
+            help='sqlalchemy compatible sql URL',
+            default=f'sqlite:///{os.path.expanduser("~/.adbb.db")}'
+            )
+    parser.add_argument(
+            '-a', '--authfile',
+            help="Authfile (.netrc-file) for credentials"
+            )
+    parser.add_argument(
+            '-b', '--api-key',
+            help="Enable encryption using the given API key as defined in your AniDB profile",
+            default=None
+            )
+    parser.add_argument(
+            '-y', '--use-syslog',
+            help='Silence console output and log to syslog instead.',
+            action="store_true"
+            )
+    parser.add_argument(
+            '-S', '--socket',
+            help="Path to the unix socket clients connect to",
+            default=DEFAULT_SOCKET
+            )
+    parser.add_argument(
+            '-o', '--max-outstanding',
+            help="Max number of queued requests per client",
+            type=int,
+            default=2
+            )
+    parser.add_argument(
+            '--rate-budget-file',
+            help="Share the AniDB request budget with other adbb processes on this host using this file",
+            default=None
+            )
+    parser.add_argument(
+            '--state-file',
+            help="Save the AniDB session and ban state in this file, so the session can be resumed by the next run",
+            default=None
+            )
+    return parser.parse_args()
+
+
+def broker():
+    args = get_broker_args()
+    log = adbb.utils.get_command_logger(debug=args.debug, syslog=args.use_syslog)
+    adbb.init(
+            args.sql_url,
+            api_user=args.username,
+            api_pass=args.password,
+            logger=log,
+            netrc_file=args.authfile,
+            api_key=args.api_key,
+            rate_budget_file=args.rate_budget_file,
+            state_file=args.state_file)
+    srv = AniDBBroker(adbb._anidb, socket_path=args.socket, max_outstanding=args.max_outstanding)
+    log.info(f"adbb broker listening on {args.socket}")
+
+    def _shutdown(signo, _stack_frame):
+        log.info(f"Signal {signo} received, shutting down broker...")
+        srv.stop()
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGHUP, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    srv.join()
+    adbb.close()
+
+
+if __name__ == '__main__':
+    broker()
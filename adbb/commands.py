@@ -16,6 +16,8 @@
 # along with adbb.  If not, see <http://www.gnu.org/licenses/>.
 
 from threading import Lock
+
+import adbb
 from adbb.responses import *
 from adbb.errors import *
 
@@ -33,6 +35,14 @@ class Command:
         self.fresh_cache = False
         self.cached = False
         self.retries = 2
+        # set by the link when the command is first queued
+        self.priority_class = None
+        self.started = None
+        self.first_started = None
+        self.queued = None
+        self.transmissions = 0
+        # callbacks from identical requests coalesced into this one
+        self.extra_callbacks = []
 
     def __repr__(self):
         return "Command(%s,%s) %s\n%s\n" % (repr(self.tag), repr(self.command), repr(self.parameters), self.raw_data())
@@ -45,7 +55,18 @@ class Command:
 
     def handle(self, resp):
         self.resp = resp
-        self.callback(resp)
+        # a failing callback must not keep the waiters of coalesced requests
+        # from being called
+        for callback in [self.callback] + self.extra_callbacks:
+            try:
+                callback(resp)
+            except Exception:
+                adbb.log.exception("Unhandled exception in callback for {}".format(self.command))
+
+    def coalesce_key(self):
+        params = tuple(sorted(
+            (k, str(v)) for k, v in self.parameters.items() if k not in ('tag', 's')))
+        return (self.command, params)
 
     def flatten(self, command, parameters):
         tmp = []
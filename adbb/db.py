@@ -16,22 +16,184 @@
 # along with adbb.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import contextlib
+import threading
+
 from sqlalchemy import *
 from sqlalchemy.orm import *
 from sqlalchemy.ext.declarative import declarative_base
+import sqlalchemy.dialects.mysql
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.sqlite
 
 Base = declarative_base()
 
 
-def init_db(url):
-    engine = create_engine(url, pool_size=10, max_overflow=-1)
-    Base.metadata.create_all(engine)
-    session = sessionmaker(bind=engine, expire_on_commit=False)
+# Connection pool settings per database; anything given as db_pool to
+# adbb.init() overrides these. All writes go through adbb.writebehind, one
+# transaction at a time, so the other SQLite connections only read; they
+# wait for the lock of writers in other processes (instead of failing with
+# "database is locked"). The server databases get a larger pool, and
+# connections are checked and recycled since servers drop idle ones.
+POOL_DEFAULTS = {
+        'sqlite': {
+            'pool_size': 5,
+            'max_overflow': -1,
+            'connect_args': {'timeout': 30},
+            },
+        'postgresql': {
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_pre_ping': True,
+            'pool_recycle': 3600,
+            },
+        'mysql': {
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_pre_ping': True,
+            'pool_recycle': 3600,
+            },
+        }
+
+_local = threading.local()
+
+
+class ScopedSession(Session):
+    """Session that can be shared by everything done in a thread inside
+    session_scope(). close() only closes it when the last user of it is
+    done."""
+
+    def close(self):
+        if getattr(_local, 'session', None) is self:
+            _local.refs -= 1
+            if _local.refs > 0:
+                return
+            _local.session = None
+        super(ScopedSession, self).close()
+
+
+def thread_session(sessionmaker):
+    """The session of the session_scope() active in this thread, or a new
+    session if there is none. Close it when done either way."""
+    sess = getattr(_local, 'session', None)
+    if sess is None:
+        return sessionmaker()
+    _local.refs += 1
+    return sess
+
+
+@contextlib.contextmanager
+def session_scope(sessionmaker):
+    sess = getattr(_local, 'session', None)
+    outermost = sess is None
+    if outermost:
+        sess = _local.session = sessionmaker()
+        _local.refs = 1
+    else:
+        _local.refs += 1
+    try:
+        yield sess
+    finally:
+        if outermost:
+            # the session ends with the outermost scope even if something
+            # got it from thread_session() and never closed it
+            _local.session = None
+            _local.refs = 0
+            Session.close(sess)
+        else:
+            sess.close()
+
+
+def init_db(url, pool=None):
+    url = make_url(url)
+    options = dict(POOL_DEFAULTS.get(url.get_backend_name(), {}))
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # in-memory databases don't use a regular pool
+        options = {}
+    options.update(pool or {})
+    engine = create_engine(url, **options)
+    # imported here since the migrations need the tables defined below
+    import adbb.migrations
+    adbb.migrations.upgrade(engine)
+    session = sessionmaker(bind=engine, expire_on_commit=False, class_=ScopedSession)
     return session
 
 
+def normalize_epno(epno):
+    """Episode number in the form stored in EpisodeTable.epno_normalized:
+    upper case and without leading zeroes ("5", "S1", "C2"...)"""
+    epno = str(epno).strip().upper()
+    try:
+        return str(int(epno))
+    except ValueError:
+        return epno
+
+
+def upsert(sess, table, values, key='pk', update=None):
+    """Insert values into table, or update the row with the same key (a
+    unique column) if there is one, in a single statement on PostgreSQL,
+    SQLite and MySQL. update is the values to set on an existing row and
+    defaults to values. Returns the primary key of the row."""
+    if update is None:
+        update = values
+    update = {k: v for k, v in update.items() if k not in ('pk', key)}
+    dialect = sess.get_bind().dialect
+    if dialect.name in ('postgresql', 'sqlite'):
+        insert_ = getattr(sqlalchemy.dialects, dialect.name).insert
+        stmt = insert_(table).values(**values).on_conflict_do_update(
+                index_elements=[key], set_=update)
+        if getattr(dialect, 'insert_returning', False):
+            return sess.execute(stmt.returning(table.c.pk)).scalar()
+        sess.execute(stmt)
+    elif dialect.name in ('mysql', 'mariadb'):
+        # LAST_INSERT_ID(pk) makes the pk of an updated row available too
+        stmt = sqlalchemy.dialects.mysql.insert(table).values(**values).on_duplicate_key_update(
+                pk=func.last_insert_id(table.c.pk), **update)
+        return sess.execute(stmt).lastrowid
+    else:
+        row = sess.execute(select(table.c.pk).where(table.c[key] == values.get(key))).first()
+        if row:
+            sess.execute(table.update().where(table.c.pk == row.pk).values(**update))
+            return row.pk
+        return sess.execute(table.insert().values(**values)).inserted_primary_key[0]
+    return sess.execute(select(table.c.pk).where(table.c[key] == values[key])).scalar()
+
+
+def upsert_row(sess, row):
+    """Upsert an ORM row without attaching it to sess (so without the SELECT
+    merge() does), keyed on the upsert_key of its table, or on the primary
+    key if the row has one. Returns the primary key of the row."""
+    table = row.__table__
+    values = {c.name: getattr(row, c.key) for c in table.columns}
+    key = getattr(row, 'upsert_key', None)
+    if not key:
+        key = 'pk'
+        if values['pk'] is None:
+            del values['pk']
+            return sess.execute(table.insert().values(**values)).inserted_primary_key[0]
+    else:
+        del values['pk']
+    return upsert(sess, table, values, key)
+
+
+def replace_relations(sess, row_class, pk, relations):
+    """Replace the stored relations of the row_class row with primary key pk
+    with relations (AnimeRelationTable or GroupRelationTable rows)"""
+    prop = row_class.relations.property
+    table = prop.mapper.local_table
+    fk = next(iter(prop.remote_side)).name
+    sess.execute(table.delete().where(table.c[fk] == pk))
+    values = [{c.name: getattr(r, c.key) for c in table.columns if c.name != 'pk'}
+              for r in relations]
+    for v in values:
+        v[fk] = pk
+    if values:
+        sess.execute(table.insert(), values)
+
+
 class AnimeTable(Base):
     __tablename__ = 'anime'
+    upsert_key = 'aid'
 
     pk = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
     aid = Column(BigInteger().with_variant(Integer, "sqlite"), nullable=False, unique=True)
@@ -69,7 +231,7 @@ class AnimeTable(Base):
     # TODO: ANIMEDESC
     # description = Column(Unicode(8194), nullable=True)
 
-    updated = Column(DateTime(timezone=True), nullable=False)
+    updated = Column(DateTime(timezone=True), nullable=False, index=True)
     last_update_dice = Column(DateTime(timezone=True), nullable=False)
 
     relations = relationship("AnimeRelationTable", backref='anime', cascade='all, delete')
@@ -128,6 +290,7 @@ class AnimeRelationTable(Base):
 
 class EpisodeTable(Base):
     __tablename__ = 'episode'
+    upsert_key = 'eid'
 
     pk = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
     aid = Column(BigInteger().with_variant(Integer, "sqlite"), nullable=False, index=True)
@@ -136,6 +299,8 @@ class EpisodeTable(Base):
     rating = Column(Float, nullable=True)
     votes = Column(Integer, nullable=False)
     epno = Column(String(8), nullable=False)
+    # for lookups on (aid, epno); see normalize_epno()
+    epno_normalized = Column(String(8), nullable=True)
     title_eng = Column(String(512), nullable=True)
     title_romaji = Column(String(512), nullable=True)
     title_kanji = Column(Unicode(512), nullable=True)
@@ -151,8 +316,19 @@ class EpisodeTable(Base):
             name='episode_type_enum'),
         nullable=False)
 
-    updated = Column(DateTime(timezone=True), nullable=False)
+    updated = Column(DateTime(timezone=True), nullable=False, index=True)
     last_update_dice = Column(DateTime(timezone=True), nullable=False)
+    # saved from a FILE response, which lacks some of the EPISODE fields
+    partial = Column(Boolean, nullable=True)
+
+    __table_args__ = (
+            Index('ix_episode_aid_epno', 'aid', 'epno_normalized'),
+            )
+
+    @validates('epno')
+    def _set_epno_normalized(self, key, epno):
+        self.epno_normalized = normalize_epno(epno)
+        return epno
 
     def update(self, **kwargs):
         for key, attr in kwargs.items():
@@ -173,7 +349,7 @@ class FileTable(Base):
     __tablename__ = 'file'
 
     pk = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
-    path = Column(Unicode(512), nullable=True)
+    path = Column(Unicode(512), nullable=True, index=True)
     size = Column(BigInteger().with_variant(Integer, "sqlite"), nullable=True)
     ed2khash = Column(String(64), nullable=True)
     mtime = Column(DateTime(timezone=False), nullable=True)
@@ -221,11 +397,15 @@ class FileTable(Base):
     mylist_storage = Column(String(128), nullable=True)
     mylist_source = Column(String(128), nullable=True)
     mylist_other = Column(String(128), nullable=True)
-    lid = Column(BigInteger().with_variant(Integer, "sqlite"), nullable=True)
+    lid = Column(BigInteger().with_variant(Integer, "sqlite"), nullable=True, index=True)
 
-    updated = Column(DateTime(timezone=True), nullable=True)
+    updated = Column(DateTime(timezone=True), nullable=True, index=True)
     last_update_dice = Column(DateTime(timezone=True), nullable=False)
 
+    __table_args__ = (
+            Index('ix_file_ed2khash_size', 'ed2khash', 'size'),
+            )
+
     def update(self, **kwargs):
         for key, attr in kwargs.items():
             setattr(self, key, attr)
@@ -265,9 +445,15 @@ class GroupTable(Base):
 
     relations = relationship("GroupRelationTable", backref='group', cascade='all, delete')
 
-    updated = Column(DateTime(timezone=True), nullable=True)
+    updated = Column(DateTime(timezone=True), nullable=True, index=True)
     last_update_dice = Column(DateTime(timezone=True), nullable=False)
 
+    # groups are looked up by name or short name regardless of case
+    __table_args__ = (
+            Index('ix_group_name_lower', func.lower(name)),
+            Index('ix_group_short_lower', func.lower(short)),
+            )
+
     def update(self, **kwargs):
         for key, attr in kwargs.items():
             setattr(self, key, attr)
@@ -315,3 +501,69 @@ class GroupRelationTable(Base):
                 related=self.related_gid,
                 type=self.relation_type)
 
+
+
+class OutboxTable(Base):
+    __tablename__ = 'outbox'
+
+    pk = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    command = Column(String(16), nullable=False)
+    parameters = Column(Unicode(1024), nullable=False)
+    created = Column(DateTime(timezone=True), nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_attempt = Column(DateTime(timezone=True), nullable=True)
+
+    def __repr__(self):
+        return '<OutboxTable(pk={pk}, command={command}, parameters={parameters}, ' \
+               'attempts={attempts})>'.format(
+                pk=self.pk,
+                command=self.command,
+                parameters=self.parameters,
+                attempts=self.attempts)
+
+
+class NegativeCacheTable(Base):
+    __tablename__ = 'negative_cache'
+
+    pk = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    kind = Column(String(16), nullable=False)
+    key = Column(Unicode(512), nullable=False, index=True)
+    misses = Column(Integer, nullable=False, default=1)
+    created = Column(DateTime(timezone=True), nullable=False)
+    expires = Column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return '<NegativeCacheTable(kind={kind}, key={key}, misses={misses}, ' \
+               'expires={expires})>'.format(
+                kind=self.kind,
+                key=self.key,
+                misses=self.misses,
+                expires=self.expires)
+
+
+class RefreshRequestTable(Base):
+    __tablename__ = 'refresh_request'
+
+    pk = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    # AniDB requests sent by the refresh planner at this time; see
+    # adbb.planner
+    spent = Column(DateTime(timezone=True), nullable=False, index=True)
+    requests = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return '<RefreshRequestTable(spent={spent}, requests={requests})>'.format(
+                spent=self.spent,
+                requests=self.requests)
+
+
+class SchemaVersionTable(Base):
+    __tablename__ = 'schema_version'
+
+    pk = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated = Column(DateTime(timezone=True), nullable=False)
+
+    def __repr__(self):
+        return '<SchemaVersionTable(version={version}, updated={updated})>'.format(
+                version=self.version,
+                updated=self.updated)
@@ -0,0 +1,622 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import hashlib
+import json
+import logging
+import random
+import socket
+import string
+import threading
+import time
+import zlib
+
+import adbb.mapper
+
+from Crypto.Cipher import AES
+
+log = logging.getLogger(__name__)
+
+# Fields in the data lines of the replies, in the order AniDB sends them.
+EPISODE_FIELDS = ('eid', 'aid', 'length', 'rating', 'votes', 'epno', 'title_eng',
+                  'title_romaji', 'title_kanji', 'aired', 'type')
+GROUP_FIELDS = ('gid', 'rating', 'votes', 'acount', 'fcount', 'name', 'short',
+                'irc_channel', 'irc_server', 'url', 'picname', 'founded',
+                'disbanded', 'dateflag', 'last_release', 'last_activity',
+                'relations')
+MYLIST_FIELDS = ('lid', 'fid', 'eid', 'aid', 'gid', 'date', 'mylist_state',
+                 'mylist_viewdate', 'mylist_storage', 'mylist_source',
+                 'mylist_other')
+
+# Fields of FILE responses that are numbers; AniDB sends 0 for those that
+# don't apply (like the mylist fields of files that aren't in mylist)
+_FILE_NUMERIC = ('aid', 'eid', 'gid', 'lid', 'is_deprecated', 'state', 'size',
+                 'length_in_seconds', 'aired_date', 'mylist_state', 'mylist_filestate',
+                 'mylist_viewed', 'mylist_viewdate')
+
+# File amask fields that can be looked up from other fixtures if they are not
+# given for the file itself.
+_FILE_A_FROM_EPISODE = {
+        'epno': 'epno',
+        'ep_name': 'title_eng',
+        'ep_romaji_name': 'title_romaji',
+        'ep_kanji_name': 'title_kanji',
+        'episode_rating': 'rating',
+        'episode_vote_count': 'votes',
+        }
+_FILE_A_FROM_GROUP = {
+        'group_name': 'name',
+        'group_short_name': 'short',
+        }
+
+# Commands that can be sent without a session
+_NO_SESSION_COMMANDS = ('AUTH', 'ENCRYPT', 'PING')
+
+
+def load_fixtures(path):
+    """Load fixture data for FakeAniDBServer from a json file. The file
+    contains a dict with the keys anime, episodes, files, groups and mylist,
+    each a list of dicts using the field names from adbb.mapper (or the
+    response classes for episodes, groups and mylist). Values should be in
+    the format AniDB sends them; dates as unix timestamps, ratings as
+    integers (rating*100) and so on."""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _escape(value):
+    if value is None:
+        return ''
+    return str(value).replace('&', '&amp;').replace('\n', '<br />').replace('|', '/')
+
+
+def _parse_request(data):
+    command, _sep, params = data.partition(' ')
+    parameters = {}
+    for pair in params.split('&'):
+        if not pair:
+            continue
+        key, _sep, value = pair.partition('=')
+        parameters[key] = value.replace('&amp;', '&')
+    return command, parameters
+
+
+class _Client:
+    def __init__(self, address):
+        self.address = address
+        self.cipher = None
+        self.session = None
+        self.user = None
+        self.nat = False
+        self.compress = False
+        self.last_packet = 0
+        self.banned_until = 0
+
+
+class FakeAniDBServer(threading.Thread):
+    """A local stand-in for api.anidb.net, implementing the part of the UDP
+    API that adbb uses. Data is served from fixtures (see load_fixtures()),
+    and mylist changes are kept in memory.
+
+    To test error handling and performance the server can delay replies
+    (latency, jitter), drop requests or replies (loss), compress replies
+    (compress, as a probability) and reply with a ban or server error code
+    (ban_code, ban_probability). With min_interval set, clients sending
+    packets more often than that are banned for ban_time seconds, like the
+    real API does with clients ignoring the flood protection."""
+
+    def __init__(
+            self,
+            fixtures=None,
+            host='127.0.0.1',
+            port=9000,
+            users=None,
+            latency=0,
+            jitter=0,
+            loss=0,
+            compress=0,
+            ban_code=555,
+            ban_probability=0,
+            min_interval=0,
+            ban_time=60):
+        super(FakeAniDBServer, self).__init__()
+        fixtures = fixtures or {}
+        self.anime = {int(x['aid']): x for x in fixtures.get('anime', [])}
+        self.episodes = {int(x['eid']): x for x in fixtures.get('episodes', [])}
+        self.files = {int(x['fid']): x for x in fixtures.get('files', [])}
+        self.groups = {int(x['gid']): x for x in fixtures.get('groups', [])}
+        self.mylist = {int(x['lid']): dict(x) for x in fixtures.get('mylist', [])}
+        # username -> {'password': ..., 'api_key': ...}; if no users are
+        # given any user/password is accepted
+        self.users = {k.lower(): v for k, v in (users or {}).items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.compress = compress
+        self.ban_code = ban_code
+        self.ban_probability = ban_probability
+        self.min_interval = min_interval
+        self.ban_time = ban_time
+
+        self.started = time.time()
+        self.requests = 0
+        self.replies = 0
+        self.dropped = 0
+        self._clients = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.daemon = True
+
+    def stop(self):
+        sock = self.sock
+        self.sock = None
+        if sock:
+            sock.close()
+
+    def run(self):
+        log.info("Fake AniDB server listening on {}:{}".format(*self.address))
+        while self.sock:
+            try:
+                data, address = self.sock.recvfrom(8192)
+            except OSError:
+                break
+            with self._lock:
+                client = self._clients.setdefault(address, _Client(address))
+                self.requests += 1
+                try:
+                    reply = self._handle_packet(client, data)
+                except Exception as e:
+                    log.exception("Failed to handle request from {}: {}".format(address, e))
+                    reply = None
+            if reply is not None:
+                self._send_later(client, reply)
+
+    def _decode(self, client, data):
+        if client.cipher and len(data) % 16 == 0:
+            try:
+                plain = client.cipher.decrypt(data)
+                plain = plain[:-plain[-1]].decode('utf-8')
+                if plain[:1].isupper():
+                    return plain
+            except (ValueError, IndexError, UnicodeDecodeError):
+                pass
+        return data.decode('utf-8')
+
+    def _encode(self, client, reply, cipher):
+        data = reply.encode('utf-8')
+        if client.compress and self.compress and random.random() < self.compress:
+            data = b'\x00\x00' + zlib.compress(data)
+        if cipher:
+            pad_len = 16 - len(data) % 16
+            data = cipher.encrypt(data + bytes([pad_len])*pad_len)
+        return data
+
+    def _send_later(self, client, reply):
+        # the cipher is captured now; LOGOUT and ENCRYPT change it after the
+        # reply is created
+        reply, cipher = reply
+        if random.random() < self.loss:
+            self.dropped += 1
+            log.debug("Dropping reply to {}".format(client.address))
+            return
+        data = self._encode(client, reply, cipher)
+        delay = self.latency + random.uniform(0, self.jitter)
+
+        def _send():
+            sock = self.sock
+            if sock:
+                self.replies += 1
+                sock.sendto(data, client.address)
+        if delay > 0:
+            timer = threading.Timer(delay, _send)
+            timer.daemon = True
+            timer.start()
+        else:
+            _send()
+
+    def _handle_packet(self, client, data):
+        now = time.time()
+        cipher = client.cipher
+        request = self._decode(client, data)
+        command, params = _parse_request(request)
+        tag = params.get('tag')
+        log.debug("{} > {} {}".format(client.address, command,
+                  {k: v for k, v in params.items() if k != 'pass'}))
+
+        if random.random() < self.loss:
+            self.dropped += 1
+            log.debug("Dropping request from {}".format(client.address))
+            return None
+
+        interval = now - client.last_packet
+        client.last_packet = now
+        if client.banned_until > now:
+            return (self._reply(tag, '555 BANNED', ['flooding']), cipher)
+        if self.min_interval and interval < self.min_interval:
+            client.banned_until = now + self.ban_time
+            log.info("Banning {} for {}s; {:.2f}s between packets".format(
+                client.address, self.ban_time, interval))
+            return (self._reply(tag, '555 BANNED', ['flooding']), cipher)
+        if self.ban_probability and random.random() < self.ban_probability:
+            return (self._error_reply(tag, self.ban_code), cipher)
+
+        if command not in _NO_SESSION_COMMANDS:
+            session = params.get('s')
+            if not session:
+                return (self._reply(tag, '501 LOGIN FIRST'), cipher)
+            if self._sessions.get(session) is not client:
+                return (self._reply(tag, '506 INVALID SESSION'), cipher)
+
+        handler = getattr(self, '_cmd_{}'.format(command.lower()), None)
+        if not handler:
+            return (self._reply(tag, '598 UNKNOWN COMMAND'), cipher)
+        reply = handler(client, params)
+        if command == 'ENCRYPT':
+            # the reply to ENCRYPT itself is not encrypted
+            return (self._reply(tag, reply[0], reply[1]), None)
+        return (self._reply(tag, *reply), cipher)
+
+    def _reply(self, tag, status, lines=()):
+        reply = status
+        if tag:
+            reply = "{} {}".format(tag, reply)
+        return reply + '\n' + ''.join(line + '\n' for line in lines)
+
+    def _error_reply(self, tag, code):
+        texts = {
+                555: 'BANNED',
+                600: 'INTERNAL SERVER ERROR',
+                601: 'ANIDB OUT OF SERVICE - TRY AGAIN LATER',
+                602: 'SERVER BUSY - TRY AGAIN LATER',
+                604: 'TIMEOUT - DELAY AND RESUBMIT',
+                }
+        status = '{} {}'.format(code, texts.get(code, 'ERROR'))
+        if code == 555:
+            return self._reply(tag, status, ['fake server ban'])
+        # server errors are sent without tag
+        return self._reply(None, status)
+
+    @staticmethod
+    def _line(fields):
+        return '|'.join(_escape(x) for x in fields)
+
+    # session commands
+
+    def _cmd_encrypt(self, client, params):
+        user = self.users.get(params.get('user', '').lower(), {})
+        api_key = user.get('api_key')
+        if not api_key:
+            return ('309 API PASSWORD NOT DEFINED', [])
+        salt = ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(16))
+        key = hashlib.md5(bytes(api_key + salt, 'utf-8')).digest()
+        client.cipher = AES.new(key, AES.MODE_ECB)
+        return ('209 {} ENCRYPTION ENABLED'.format(salt), [])
+
+    def _cmd_auth(self, client, params):
+        user = params.get('user', '').lower()
+        if self.users and (user not in self.users
+                           or self.users[user].get('password') != params.get('pass')):
+            return ('500 LOGIN FAILED', [])
+        if client.session:
+            self._sessions.pop(client.session, None)
+        client.session = ''.join(random.choice(string.ascii_letters) for _ in range(5))
+        client.user = user
+        client.nat = params.get('nat') == '1'
+        client.compress = params.get('comp') == '1'
+        self._sessions[client.session] = client
+        status = '200 {}'.format(client.session)
+        if client.nat:
+            status += ' {}:{}'.format(*client.address)
+        return (status + ' LOGIN ACCEPTED', [])
+
+    def _cmd_logout(self, client, params):
+        self._sessions.pop(client.session, None)
+        client.session = None
+        client.cipher = None
+        return ('203 LOGGED OUT', [])
+
+    def _cmd_ping(self, client, params):
+        if params.get('nat') == '1':
+            return ('300 PONG', [str(client.address[1])])
+        return ('300 PONG', [])
+
+    def _cmd_uptime(self, client, params):
+        return ('208 UPTIME', [str(int((time.time()-self.started)*1000))])
+
+    # data commands
+
+    def _cmd_anime(self, client, params):
+        anime = None
+        if params.get('aid'):
+            anime = self.anime.get(int(params['aid']))
+        elif params.get('aname'):
+            name = params['aname'].lower()
+            anime = next((x for x in self.anime.values()
+                          if name in [str(x.get(k, '')).lower() for k in ('name', 'romaji_name', 'english_name')]), None)
+        if not anime:
+            return ('330 NO SUCH ANIME', [])
+        fields = adbb.mapper.getAnimeCodesA(params.get('amask', '0'*14))
+        return ('230 ANIME', [self._line(anime.get(x) for x in fields)])
+
+    def _find_episode(self, eid=None, aid=None, epno=None):
+        if eid:
+            return self.episodes.get(int(eid))
+        for ep in self.episodes.values():
+            if str(ep.get('aid')) == str(aid) and str(ep.get('epno')) == str(epno):
+                return ep
+        return None
+
+    def _cmd_episode(self, client, params):
+        ep = self._find_episode(params.get('eid'), params.get('aid'), params.get('epno'))
+        if not ep:
+            return ('340 NO SUCH EPISODE', [])
+        return ('240 EPISODE', [self._line(ep.get(x) for x in EPISODE_FIELDS)])
+
+    def _find_file(self, params):
+        if params.get('fid'):
+            return self.files.get(int(params['fid']))
+        if params.get('size') and params.get('ed2k'):
+            for f in self.files.values():
+                if str(f.get('size')) == params['size'] and \
+                        str(f.get('ed2khash', '')).lower() == params['ed2k'].lower():
+                    return f
+        return None
+
+    def _mylist_for_file(self, fid):
+        return next((x for x in self.mylist.values() if str(x.get('fid')) == str(fid)), None)
+
+    def _file_value(self, f, field):
+        if field in f:
+            return f[field]
+        if field.startswith('mylist_') or field == 'lid':
+            entry = self._mylist_for_file(f['fid'])
+            if entry and entry.get(field) is not None:
+                return entry[field]
+            return 0 if field in _FILE_NUMERIC else None
+        if field in _FILE_A_FROM_EPISODE:
+            ep = self.episodes.get(int(f.get('eid') or 0), {})
+            return ep.get(_FILE_A_FROM_EPISODE[field])
+        if field in _FILE_A_FROM_GROUP:
+            group = self.groups.get(int(f.get('gid') or 0), {})
+            return group.get(_FILE_A_FROM_GROUP[field])
+        return 0 if field in _FILE_NUMERIC else None
+
+    def _cmd_file(self, client, params):
+        f = self._find_file(params)
+        if not f:
+            return ('320 NO SUCH FILE', [])
+        fields = ['fid']
+        fields += adbb.mapper.getFileCodesF(params.get('fmask', '0'*10))
+        fields += adbb.mapper.getFileCodesA(params.get('amask', '0'*8))
+        return ('220 FILE', [self._line(self._file_value(f, x) for x in fields)])
+
+    def _cmd_group(self, client, params):
+        group = None
+        if params.get('gid'):
+            group = self.groups.get(int(params['gid']))
+        elif params.get('gname'):
+            name = params['gname'].lower()
+            group = next((x for x in self.groups.values()
+                          if name in (str(x.get('name', '')).lower(), str(x.get('short', '')).lower())), None)
+        if not group:
+            return ('350 NO SUCH GROUP', [])
+        return ('250 GROUP', [self._line(group.get(x) for x in GROUP_FIELDS)])
+
+    # mylist commands
+
+    def _find_mylist(self, params):
+        if params.get('lid'):
+            return [self.mylist[int(params['lid'])]] if int(params['lid']) in self.mylist else []
+        if params.get('fid') or params.get('size'):
+            f = self._find_file(params)
+            entry = self._mylist_for_file(f['fid']) if f else None
+            return [entry] if entry else []
+        if params.get('aid'):
+            return [x for x in self.mylist.values()
+                    if str(x.get('aid')) == params['aid'] and
+                    (not params.get('epno') or
+                     str(self.episodes.get(int(x.get('eid') or 0), {}).get('epno')) == params['epno'])]
+        return []
+
+    def _cmd_mylist(self, client, params):
+        entries = self._find_mylist(params)
+        if not entries:
+            return ('321 NO SUCH ENTRY', [])
+        return ('221 MYLIST', [self._line(entries[0].get(x) for x in MYLIST_FIELDS)])
+
+    def _mylist_values(self, params):
+        values = {}
+        for param, field in (('state', 'mylist_state'), ('viewdate', 'mylist_viewdate'),
+                             ('source', 'mylist_source'), ('storage', 'mylist_storage'),
+                             ('other', 'mylist_other')):
+            if param in params:
+                values[field] = params[param]
+        if params.get('viewed') == '1' and not params.get('viewdate'):
+            values['mylist_viewdate'] = str(int(time.time()))
+        elif params.get('viewed') == '0':
+            values['mylist_viewdate'] = '0'
+        return values
+
+    def _cmd_mylistadd(self, client, params):
+        if params.get('edit') == '1':
+            entries = self._find_mylist(params)
+            if not entries:
+                return ('411 NO SUCH MYLIST ENTRY', [])
+            for entry in entries:
+                entry.update(self._mylist_values(params))
+            return ('311 MYLIST ENTRY EDITED', [str(len(entries))])
+
+        if params.get('generic') == '1':
+            ep = self._find_episode(aid=params.get('aid'), epno=params.get('epno'))
+            if not ep:
+                return ('340 NO SUCH EPISODE', [])
+            f = {'fid': 0, 'eid': ep['eid'], 'aid': ep['aid'], 'gid': 0}
+        else:
+            f = self._find_file(params)
+            if not f:
+                return ('320 NO SUCH FILE', [])
+            existing = self._mylist_for_file(f['fid'])
+            if existing:
+                return ('310 FILE ALREADY IN MYLIST',
+                        [self._line(existing.get(x) for x in MYLIST_FIELDS)])
+        lid = max(list(self.mylist) + [0]) + 1
+        entry = {
+                'lid': lid,
+                'fid': f['fid'],
+                'eid': f.get('eid'),
+                'aid': f.get('aid'),
+                'gid': f.get('gid'),
+                'date': int(time.time())}
+        entry.update(self._mylist_values(params))
+        self.mylist[lid] = entry
+        return ('210 MYLIST ENTRY ADDED', [str(lid)])
+
+    def _cmd_mylistdel(self, client, params):
+        entries = self._find_mylist(params)
+        if not entries:
+            return ('411 NO SUCH MYLIST ENTRY', [])
+        for entry in entries:
+            del self.mylist[int(entry['lid'])]
+        return ('211 MYLIST ENTRY DELETED', [str(len(entries))])
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Fake AniDB UDP API server for testing adbb")
+    parser.add_argument(
+            'fixtures',
+            help="json file with anime, episodes, files, groups and mylist data",
+            nargs='?'
+            )
+    parser.add_argument(
+            '-d', '--debug',
+            help='log all requests',
+            action='store_true'
+            )
+    parser.add_argument(
+            '-H', '--host',
+            help="Address to listen on",
+            default='127.0.0.1'
+            )
+    parser.add_argument(
+            '-P', '--port',
+            help="UDP port to listen on",
+            type=int,
+            default=9000
+            )
+    parser.add_argument(
+            '-u', '--username',
+            help="Only accept this user (any user is accepted if not set)"
+            )
+    parser.add_argument(
+            '-p', '--password',
+            help="Password for --username"
+            )
+    parser.add_argument(
+            '-b', '--api-key',
+            help="API key for --username; needed for encrypted sessions"
+            )
+    parser.add_argument(
+            '--latency',
+            help="Seconds to wait before replying",
+            type=float,
+            default=0
+            )
+    parser.add_argument(
+            '--jitter',
+            help="Random extra delay (0 to JITTER seconds) for replies",
+            type=float,
+            default=0
+            )
+    parser.add_argument(
+            '--loss',
+            help="Probability for dropping a request or reply",
+            type=float,
+            default=0
+            )
+    parser.add_argument(
+            '--compress',
+            help="Probability for compressing a reply, if the client asked for compression",
+            type=float,
+            default=0
+            )
+    parser.add_argument(
+            '--ban-code',
+            help="Reply code to use for random errors; 555 or 600-604",
+            type=int,
+            default=555
+            )
+    parser.add_argument(
+            '--ban-probability',
+            help="Probability for replying with --ban-code instead of the real reply",
+            type=float,
+            default=0
+            )
+    parser.add_argument(
+            '--min-interval',
+            help="Ban clients that send packets more often than this (seconds)",
+            type=float,
+            default=0
+            )
+    parser.add_argument(
+            '--ban-time',
+            help="Length of flood bans in seconds",
+            type=int,
+            default=60
+            )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(
+            level=logging.DEBUG if args.debug else logging.INFO,
+            format='%(asctime)s %(levelname)s - %(message)s')
+    fixtures = load_fixtures(args.fixtures) if args.fixtures else None
+    users = None
+    if args.username:
+        users = {args.username.lower(): {'password': args.password, 'api_key': args.api_key}}
+    srv = FakeAniDBServer(
+            fixtures,
+            host=args.host,
+            port=args.port,
+            users=users,
+            latency=args.latency,
+            jitter=args.jitter,
+            loss=args.loss,
+            compress=args.compress,
+            ban_code=args.ban_code,
+            ban_probability=args.ban_probability,
+            min_interval=args.min_interval,
+            ban_time=args.ban_time)
+    srv.start()
+    try:
+        while srv.is_alive():
+            srv.join(1)
+    except KeyboardInterrupt:
+        pass
+    srv.stop()
+    log.info("{} requests, {} replies, {} dropped".format(srv.requests, srv.replies, srv.dropped))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+import weakref
+
+
+class IdentityMap:
+    """Maps identifying keys (aid, eid, fid, lid, path, gid...) to the live
+    Anime, Episode, File and Group objects created for them, so that the
+    same entity is only built once as long as someone holds a reference to
+    it. If lru_size is set, that many of the most recently used objects are
+    also kept alive when nobody else references them."""
+
+    def __init__(self, lru_size=0):
+        self.lru_size = lru_size
+        self._objects = weakref.WeakValueDictionary()
+        self._lru = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _touch(self, obj):
+        if not self.lru_size:
+            return
+        self._lru[id(obj)] = obj
+        self._lru.move_to_end(id(obj))
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, cls, key):
+        """Live object of type cls registered under key, or None"""
+        with self._lock:
+            obj = self._objects.get((cls.__name__, key))
+            if obj is None or object.__getattribute__(obj, '_illegal_object'):
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._touch(obj)
+            return obj
+
+    def add(self, obj):
+        """Register obj under all its current keys. If one of the keys already
+        belongs to another live object, that object is kept, registered under
+        the remaining keys as well, and returned instead of obj."""
+        if object.__getattribute__(obj, '_illegal_object'):
+            return obj
+        keys = [(type(obj).__name__, k) for k in obj._identity_keys()]
+        with self._lock:
+            for key in keys:
+                existing = self._objects.get(key)
+                if existing is not None and existing is not obj and \
+                        not object.__getattribute__(existing, '_illegal_object'):
+                    obj = existing
+                    break
+            for key in keys:
+                self._objects[key] = obj
+            self._touch(obj)
+        return obj
+
+    def discard(self, obj):
+        """Forget obj, for example when it no longer matches the file or
+        entry it was created for."""
+        with self._lock:
+            for key, value in list(self._objects.items()):
+                if value is obj:
+                    del self._objects[key]
+            self._lru.pop(id(obj), None)
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+            self._lru.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                    'objects': len(set(id(x) for x in self._objects.values())),
+                    'lru': len(self._lru),
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    }
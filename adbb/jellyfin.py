@@ -517,6 +517,31 @@ def get_jellyfin_anime_sync_args():
             help="Enable encryption using the given API key as defined in your AniDB profile",
             default=None
             )
+    parser.add_argument(
+            '--rate-budget-file',
+            help="Share the AniDB request budget with other adbb processes on this host using this file",
+            default=None
+            )
+    parser.add_argument(
+            '--broker-socket',
+            help="Send AniDB requests through an adbb_broker listening on this unix socket",
+            default=None
+            )
+    parser.add_argument(
+            '--state-file',
+            help="Save the AniDB session and ban state in this file, so the session can be resumed by the next run",
+            default=None
+            )
+    parser.add_argument(
+            '--record-file',
+            help="Record all AniDB requests and responses to this file",
+            default=None
+            )
+    parser.add_argument(
+            '--replay-file',
+            help="Answer AniDB requests from a file written with --record-file instead of asking AniDB",
+            default=None
+            )
     parser.add_argument(
             '-o', '--collection-path',
             help="Path to jellyfin collection library, see JELLYFIN.md for details about creating collections",
@@ -678,7 +703,7 @@ def jellyfin_anime_sync():
                 user, password = (args.jellyfin_user, args.jellyfin_password)
 
             if reinit_adbb:
-                adbb.init(args.sql_url, api_user=args.username, api_pass=args.password, logger=log, netrc_file=args.authfile, api_key=args.api_key)
+                adbb.init(args.sql_url, api_user=args.username, api_pass=args.password, logger=log, netrc_file=args.authfile, api_key=args.api_key, rate_budget_file=args.rate_budget_file, broker_socket=args.broker_socket, state_file=args.state_file, record_file=args.record_file, replay_file=args.replay_file)
                 reinit_adbb=False
             adbb.update_anilist()
             adbb.update_animetitles()
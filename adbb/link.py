@@ -17,17 +17,70 @@
 
 import datetime
 import hashlib
-import socket, sys, zlib
+import heapq
+import socket, sys
 import threading
 from time import time, sleep
-from collections import deque
 
 from adbb.responses import ResponseResolver
+from adbb.ratelimit import RateLimiter
+from adbb.workers import WorkerPool
+from adbb.scheduler import RequestScheduler
+from adbb.transport import UDPTransport
+import adbb.state
 from adbb.errors import *
 import adbb.commands
 
 from Crypto.Cipher import AES
 
+# Read-only commands; if one of these is requested while an identical command
+# is still waiting for its response the new request is attached to the one
+# already queued instead of being sent again.
+COALESCABLE_COMMANDS = ('ANIME', 'EPISODE', 'FILE', 'GROUP', 'GROUPSTATUS',
+                        'PRODUCER', 'MYLIST', 'MYLISTSTATS', 'USER')
+
+# Seconds between writes of the state file when only the time of the last
+# packet and the rate budget have changed
+STATE_SAVE_INTERVAL = 30
+
+class RttEstimator:
+    """Retransmission timeout calculation as described in RFC 6298. Until the
+    first round trip has been measured the timeout is initial_rto. Only
+    responses to commands that were sent once are used as samples (Karn's
+    algorithm), and the timeout is doubled every time a command times out
+    until a new sample is available."""
+
+    def __init__(self, initial_rto=20, min_rto=2, max_rto=60):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self._rto = initial_rto
+        self._lock = threading.Lock()
+
+    @property
+    def rto(self):
+        return self._rto
+
+    def sample(self, rtt):
+        with self._lock:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt/2
+            else:
+                self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt-rtt)
+                self.srtt = 0.875*self.srtt + 0.125*rtt
+            self._rto = min(self.max_rto, max(self.min_rto, self.srtt + 4*self.rttvar))
+
+    def backoff(self):
+        with self._lock:
+            self._rto = min(self.max_rto, self._rto*2)
+
+    def __repr__(self):
+        return "RttEstimator(srtt={}, rttvar={}, rto={})".format(
+                self.srtt, self.rttvar, self._rto)
+
+
 class AniDBLink(threading.Thread):
     def __init__(self,
                     user,
@@ -38,22 +91,40 @@ class AniDBLink(threading.Thread):
                     myport=9876,
                     nat_ping_interval=600,
                     timeout=20,
-                    api_key=None):
+                    api_key=None,
+                    rate_limiter=None,
+                    callback_workers=4,
+                    aging_interval=300,
+                    state_file=None,
+                    session_timeout=1800,
+                    transport=None):
         super(AniDBLink, self).__init__()
         self._user = user
         self._pwd = pwd
         self._server = (host, port)
-        self._queue = deque()
+        self._queue = RequestScheduler(aging_interval=aging_interval)
 
         self._last_packet = 0
-        self._counter = 0
         self._banned = 0
+        self._ban_until = 0
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.rate_limiter = rate_limiter
 
         self._current_tag = 0
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self.coalesced = 0
         self._myport = myport
         self._nat_ping_interval = nat_ping_interval
         self._do_ping = False
-        self._listener = AniDBListener(self, myport=myport,timeout=timeout)
+        if transport is None:
+            transport = UDPTransport(self._server, myport=myport)
+        self._listener = AniDBListener(
+                self,
+                transport,
+                timeout=timeout,
+                callback_workers=callback_workers)
 
         self.timeout = timeout
         self._stop = threading.Event()
@@ -61,9 +132,18 @@ class AniDBLink(threading.Thread):
         self._authenticating = threading.Event()
         self._auth_lock = threading.Lock()
         self._session = None
+        self._session_key = None
 
         self._api_key=api_key
 
+        self._state_file = state_file
+        self._state_lock = threading.Lock()
+        self._saved_state = None
+        self._state_timer = None
+        self.session_timeout = session_timeout
+        if self._state_file:
+            self._load_state()
+
         self.daemon = True
         self.start()
 
@@ -122,6 +202,83 @@ class AniDBLink(threading.Thread):
             self._authed.set()
             self._authenticating.clear()
         adbb.log.info(f"Logged in to AniDB with session {self._session}")
+        self._save_state()
+
+    def _state_id(self):
+        # a saved session can only be reused by the same user, talking to the
+        # same server from the same port
+        if self._api_key:
+            api_key = hashlib.md5(self._api_key.encode('utf-8')).hexdigest()
+        else:
+            api_key = None
+        return {
+                'user': self._user,
+                'server': list(self._server),
+                'myport': self._myport,
+                'api_key': api_key}
+
+    def _save_state(self, force=False):
+        """Write the state file. It's written at once when the session or
+        ban state has changed (or force is set); otherwise, as only the
+        packet time and rate budget have changed, at most once every
+        STATE_SAVE_INTERVAL seconds."""
+        if not self._state_file:
+            return
+        state = self._state_id()
+        state.update({
+                'session': self._session if self._authed.is_set() else None,
+                'session_key': self._session_key.hex() if self._session_key and self._listener._cipher else None,
+                'nat': self._do_ping,
+                'last_packet': self._last_packet,
+                'banned': self._banned,
+                'ban_until': self._ban_until,
+                'rate_limits': self.rate_limiter.limits,
+                'rate_state': self.rate_limiter.get_state()})
+        changes = {k: state[k] for k in ('session', 'session_key', 'nat', 'banned', 'ban_until')}
+        with self._state_lock:
+            if not force and changes == self._saved_state:
+                if not self._state_timer:
+                    self._state_timer = threading.Timer(
+                            STATE_SAVE_INTERVAL, self._save_state, kwargs={'force': True})
+                    self._state_timer.daemon = True
+                    self._state_timer.start()
+                return
+            if self._state_timer:
+                self._state_timer.cancel()
+                self._state_timer = None
+            self._saved_state = changes
+            adbb.state.save_state(self._state_file, state)
+
+    def _load_state(self):
+        state = adbb.state.load_state(self._state_file)
+        if not state:
+            return
+        if any(state.get(k) != v for k, v in self._state_id().items()):
+            adbb.log.info("State file {} was saved for another user, server or port; ignoring it".format(
+                    self._state_file))
+            return
+        now = time()
+        self._banned = state.get('banned', 0)
+        self._ban_until = state.get('ban_until', 0)
+        if self._ban_until > now:
+            adbb.log.warning("AniDB ban still in effect for {:.0f} minutes".format(
+                    (self._ban_until-now)/60))
+        if state.get('rate_state'):
+            self.rate_limiter.restore_state(state['rate_limits'], state['rate_state'])
+        self._last_packet = state.get('last_packet', 0)
+
+        session = state.get('session')
+        if not session or now - self._last_packet > self.session_timeout:
+            return
+        if self._api_key:
+            if not state.get('session_key'):
+                return
+            self._session_key = bytes.fromhex(state['session_key'])
+            self._listener._cipher = AES.new(self._session_key, AES.MODE_ECB)
+        self._session = session
+        self._do_ping = state.get('nat', False)
+        self._authed.set()
+        adbb.log.info(f"Resuming AniDB session {self._session} from {self._state_file}")
 
     def _new_tag(self):
         if self._current_tag >= 999:
@@ -133,19 +290,11 @@ class AniDBLink(threading.Thread):
         return newtag
 
     def _do_delay(self):
-        if self._banned > 0:
-            delay = 1800*self._banned
-            adbb.log.warning(f"API not available, will wait for {delay/60} minutes")
+        delay = self._ban_until - time()
+        if delay > 0:
+            adbb.log.warning(f"API not available, will wait for {delay/60:.0f} minutes")
             sleep(delay)
-        age = time() - self._last_packet
-        if age > 600:
-            self._counter = 0
-            delay = 0
-        elif self._counter < 5:
-            delay = 2
-        else:
-            delay = 4
-        delay = delay-age
+        delay = self.rate_limiter.reserve()
         if delay > 0:
             adbb.log.debug("Delaying request with {} seconds".format(delay))
             sleep(delay)
@@ -196,27 +345,56 @@ class AniDBLink(threading.Thread):
             adbb.log.warning('Attempted double encrypt command; ignoring')
             return
         command.authorize(self._session)
-        self._counter += 1
         self._last_packet = time()
+        self._save_state()
         command.started = time()
+        if not command.first_started:
+            command.first_started = command.started
+        command.transmissions += 1
         data = command.raw_data().encode('utf-8')
-        if self._listener._cipher:
-            data = self._listener.encrypt(data)
-        
-        if command.command == 'AUTH':
-            adbb.log.debug("NetIO > AUTH data is not logged!")
-        else:
-            adbb.log.debug("NetIO > %s" % repr(data))
 
         try:
-            self._listener.sock.sendto(data, self._server)
+            self._listener.transport.send(command, data)
+            self._listener.track(command)
         except socket.gaierror as e:
             adbb.log.warning(f'Failed to send command {command.command}: {e}')
             if command.command not in ('AUTH', 'PING', 'ENCRYPT'):
-                self._queue.append(command)
+                self._queue.push_front(command, command.priority_class, command.queued)
             self.set_banned(code=999, reason=b'Network unavailable')
 
-    def request(self, command, callback, prio=False):
+    def _coalesce(self, command, callback):
+        if command.command not in COALESCABLE_COMMANDS:
+            return False
+        key = command.coalesce_key()
+        with self._inflight_lock:
+            existing = self._inflight.get(key)
+            if existing is None or existing is command:
+                # requeued commands (timeouts, reauth) end up here as well
+                self._inflight[key] = command
+                return False
+            existing.extra_callbacks.append(callback)
+            self.coalesced += 1
+        adbb.log.debug("Coalesced command {} with already queued tag {}".format(
+                command.command, existing.tag))
+        return True
+
+    def request_done(self, command):
+        """Called by the listener when a response for command has arrived; no
+        more requests can be attached to it after this"""
+        if command.command not in COALESCABLE_COMMANDS:
+            return
+        key = command.coalesce_key()
+        with self._inflight_lock:
+            if self._inflight.get(key) is command:
+                del self._inflight[key]
+
+    def request(self, command, callback, prio=False, priority=None):
+        """Queue command to be sent to AniDB; callback is called with the
+        response. priority is one of the classes in
+        adbb.scheduler.PRIORITY_CLASSES; prio=True is the same as
+        priority='interactive'."""
+        if self._coalesce(command, callback):
+            return
         command.started = None
         command.callback = callback
         command.tag = self._new_tag()
@@ -225,10 +403,28 @@ class AniDBLink(threading.Thread):
         if command.command in ('ENCRYPT', 'AUTH', 'PING'):
             self._send_command(command)
             return
-        if prio:
-            self._queue.append(command)
-        else:
-            self._queue.appendleft(command)
+        if command.priority_class:
+            # command is sent again; don't put it behind newer requests
+            self._queue.push_front(command, command.priority_class, command.queued)
+            return
+        if not priority:
+            priority = 'interactive' if prio else 'normal'
+        command.priority_class = priority
+        command.queued = time()
+        self._queue.push(command, priority, command.queued)
+
+    def promote(self, command, priority='interactive'):
+        """Move a queued command to a more important priority class, for
+        when someone starts waiting for it"""
+        if self._queue.promote(command, priority):
+            adbb.log.debug("Promoted {} to {}".format(command.command, priority))
+
+    def callback_stats(self):
+        return self._listener.callbacks.stats()
+
+    def is_idle(self):
+        """True if no requests are queued or waiting for an answer"""
+        return len(self._queue) == 0 and not self._listener.cmd_queue
 
     def set_session(self, session):
         self._session = session
@@ -240,7 +436,11 @@ class AniDBLink(threading.Thread):
         self._reauthenticate()
 
     def stop(self):
-        if self._authed.is_set():
+        if self._state_file:
+            # keep the session alive so the next process can resume it
+            self._save_state(force=True)
+            self._listener.stop()
+        elif self._authed.is_set():
             adbb.log.debug("Logging out from AniDB")
             req = adbb.commands.LogoutCommand()
             self.request(req, self._logout_handler)
@@ -254,6 +454,8 @@ class AniDBLink(threading.Thread):
             self._banned = 1
         else:
             self._banned *= 2
+        self._ban_until = time() + 1800*self._banned
+        self._save_state()
         with self._auth_lock:
             self._authenticating.clear()
         self.reauthenticate()
@@ -263,73 +465,71 @@ class AniDBListener(threading.Thread):
     def __init__(
             self, 
             sender,
-            myport=9876, 
-            timeout=20):
+            transport,
+            timeout=20,
+            callback_workers=4):
         super(AniDBListener, self).__init__()
 
         self.timeout = timeout
-        self.sock = self._connect_socket(myport, self.timeout)
+        self.callbacks = WorkerPool('callback', workers=callback_workers)
+        self.transport = transport
         self._sender = sender
-        self._cipher = None
         self._last_receive = time()
 
         self.cmd_queue = {}
+        # (deadline, seq, tag, command, started) for every sent command;
+        # entries for commands that have been answered or sent again are
+        # skipped when they reach the top of the heap.
+        self.rtt = RttEstimator(initial_rto=timeout, max_rto=max(timeout, 60))
+        self._deadlines = []
+        self._deadline_seq = 0
+        self._deadline_lock = threading.Lock()
 
         self.daemon = True
         self.start()
 
-    def _connect_socket(self, myport, timeout):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(timeout)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('', myport))
-        return sock
-
-    def _disconnect_socket(self):
-        if self.sock:
-            self.sock.close()
-            self.sock = None
-
-    def encrypt(self, data):
-        pad_len = 16-len(data) % 16
-        padding = (chr(pad_len)*pad_len).encode('utf-8')
-        data = data + padding
-        return self._cipher.encrypt(data)
-
-    def decrypt(self, data):
-        data = self._cipher.decrypt(data)
-        pad_len = data[-1]
-        return data[:-pad_len]
+    @property
+    def _cipher(self):
+        return self.transport.cipher
 
+    @_cipher.setter
+    def _cipher(self, cipher):
+        self.transport.cipher = cipher
 
     def stop(self):
         adbb.log.debug("Closing listening socket")
-        self._disconnect_socket()
+        self.transport.close()
+
+    def track(self, command):
+        """Start the response timer for a command that was just sent"""
+        with self._deadline_lock:
+            self._deadline_seq += 1
+            heapq.heappush(self._deadlines, (
+                    command.started + self.rtt.rto,
+                    self._deadline_seq,
+                    command.tag,
+                    command,
+                    command.started))
+
+    def _socket_timeout(self):
+        # wake up at least once a second, so commands tracked while we're
+        # waiting are not checked too late
+        with self._deadline_lock:
+            if not self._deadlines:
+                return 1
+            return min(1, max(0.01, self._deadlines[0][0] - time()))
 
     def run(self):
-        while self.sock:
-            self.sock.settimeout(self.timeout)
+        while not self.transport.closed:
             try:
-                adbb.log.debug("Listening on socket with {}s timeout".format(self.sock.gettimeout()))
-                data = self.sock.recv(8192)
+                data = self.transport.recv(self._socket_timeout())
             except socket.timeout:
                 self._handle_timeouts()
                 continue
             except OSError:
                 continue
-            adbb.log.debug("NetIO < %s" % repr(data))
-            if self._cipher:
-                try:
-                    data = self.decrypt(data)
-                except ValueError:
-                    pass
-            for i in range(2):
-                tmp = data
-                resp = None
-                if tmp[:2] == b'\x00\x00':
-                    tmp = zlib.decompressobj().decompress(tmp[2:])
-                    adbb.log.debug("UnZip | %s" % repr(tmp))
-                resp = ResponseResolver(tmp)
+            self._handle_timeouts()
+            resp = ResponseResolver(data)
             if not resp:
                 adbb.log.warning(f"Invalid response: {data}")
                 continue
@@ -362,6 +562,9 @@ class AniDBListener(threading.Thread):
                     sys.exit(2)
                 self._last_receive = time()
                 continue
+            if cmd.transmissions == 1 and cmd.started:
+                self.rtt.sample(time() - cmd.started)
+            self._sender.request_done(cmd)
             resp = resp.resolve(cmd)
             resp.parse()
             if resp.rescode in ('200', '201'):
@@ -379,27 +582,32 @@ class AniDBListener(threading.Thread):
                 self.stop()
 
             self._last_receive = time()
-            resp_thread = threading.Thread(target=resp.handle)
-            resp_thread.daemon = True
-            resp_thread.start()
+            self.callbacks.submit(resp.handle)
+
+    def _expired_commands(self):
+        now = time()
+        expired = []
+        with self._deadline_lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _deadline, _seq, tag, cmd, started = heapq.heappop(self._deadlines)
+                if self.cmd_queue.get(tag) is not cmd or cmd.started != started:
+                    # answered, or already sent again with a new tag
+                    continue
+                self.cmd_queue.pop(tag)
+                expired.append((tag, cmd))
+        return expired
 
     def _handle_timeouts(self):
-        willpop = []
-        cmd = None
         now = time()
-        for tag, cmd in self.cmd_queue.items():
-            if not tag:
-                continue
-            if cmd.started:
-                adbb.log.debug("Command {} started at {} (now {})".format(
-                        tag, cmd.started, time()))
-                if now - cmd.started > self.timeout:
-                    willpop.append(tag)
-
-        for tag in willpop:
-            cmd = self.cmd_queue.pop(tag)
-            if cmd.started < self._last_receive:
-                # API isn't dead yet, probably reauthenticating
+        for tag, cmd in self._expired_commands():
+            self.rtt.backoff()
+            if cmd.started < self._last_receive or now - cmd.first_started < self.timeout:
+                # API isn't dead yet (probably reauthenticating), or we
+                # haven't waited the full timeout yet; send it again. The
+                # retransmission goes through the rate limiter like any
+                # other command.
+                adbb.log.debug("No response to {} within {:.1f}s; resending".format(
+                        tag, now - cmd.started))
                 self._sender.request(cmd, cmd.callback, prio=True)
             else:
                 adbb.log.warning("Command {} timed out".format(tag))
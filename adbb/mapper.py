@@ -95,6 +95,24 @@ episode_type_map = {
     '6': 'other'
 }
 
+# episode number prefix for non-regular episodes
+episode_prefix_type_map = {
+    'S': 'special',
+    'C': 'credit',
+    'T': 'trailer',
+    'P': 'parody',
+    'O': 'other'
+}
+
+# amask fields in FILE responses that are also in the episode table
+file_episode_map = {
+    'ep_name': 'title_eng',
+    'ep_romaji_name': 'title_romaji',
+    'ep_kanji_name': 'title_kanji',
+    'episode_rating': 'rating',
+    'episode_vote_count': 'votes'
+}
+
 episode_map_converters = {
     'eid': int,
     'aid': int,
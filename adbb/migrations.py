@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import warnings
+
+import sqlalchemy
+
+import adbb
+from adbb.db import Base, AnimeTable, EpisodeTable, FileTable, GroupTable, SchemaVersionTable
+
+
+def _add_column(conn, column):
+    table = column.table
+    if column.name in [c['name'] for c in sqlalchemy.inspect(conn).get_columns(table.name)]:
+        return
+    preparer = conn.dialect.identifier_preparer
+    conn.execute(sqlalchemy.text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        preparer.format_table(table),
+        preparer.format_column(column),
+        column.type.compile(dialect=conn.dialect))))
+
+
+def _create_indexes(conn):
+    # every index defined in adbb.db that the database doesn't have yet
+    with warnings.catch_warnings():
+        # sqlalchemy can't reflect the expression indexes when checking
+        # which indexes exist, but it does find them by name
+        warnings.simplefilter('ignore', sqlalchemy.exc.SAWarning)
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def _updated_indexes(conn):
+    # the expression indexes created by _create_indexes() aren't found by
+    # checkfirst on all databases, so only create these
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', sqlalchemy.exc.SAWarning)
+        for table in (AnimeTable, EpisodeTable, FileTable, GroupTable):
+            for index in table.__table__.indexes:
+                if [c.name for c in index.columns] == ['updated']:
+                    index.create(conn, checkfirst=True)
+
+
+def _epno_normalized(conn):
+    table = EpisodeTable.__table__
+    _add_column(conn, table.c.epno_normalized)
+    # numeric episode numbers are already stored without leading zeroes
+    conn.execute(table.update().values(epno_normalized=sqlalchemy.func.upper(table.c.epno)))
+
+
+def _episode_partial(conn):
+    _add_column(conn, EpisodeTable.__table__.c.partial)
+
+
+# (version, description, function) for every schema change, in order. The
+# function is called with a connection in a transaction. New databases are
+# created with the current schema and don't run any of them.
+MIGRATIONS = [
+        (1, "add normalized episode numbers", _epno_normalized),
+        (2, "add indexes for file, group and episode lookups", _create_indexes),
+        (3, "add indexes for the refresh planner", _updated_indexes),
+        (4, "mark episodes saved from FILE responses", _episode_partial),
+        ]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def version(conn):
+    """Schema version of the database; 0 for databases created before
+    versions were recorded"""
+    if not sqlalchemy.inspect(conn).has_table(SchemaVersionTable.__tablename__):
+        return 0
+    row = conn.execute(sqlalchemy.select(SchemaVersionTable.version)).first()
+    return row.version if row else 0
+
+
+def _set_version(conn, version):
+    table = SchemaVersionTable.__table__
+    conn.execute(table.delete())
+    conn.execute(table.insert().values(
+        version=version,
+        updated=datetime.datetime.now(datetime.timezone.utc)))
+
+
+def upgrade(engine):
+    """Create missing tables and bring an existing database up to
+    SCHEMA_VERSION, one migration at a time"""
+    with engine.connect() as conn:
+        new = not sqlalchemy.inspect(conn).has_table(AnimeTable.__tablename__)
+        current = version(conn)
+    Base.metadata.create_all(engine)
+
+    if new:
+        with engine.begin() as conn:
+            _set_version(conn, SCHEMA_VERSION)
+        return
+    if current > SCHEMA_VERSION:
+        adbb.log.warning("Database schema version {} is newer than this version of adbb ({})".format(
+            current, SCHEMA_VERSION))
+        return
+    for migration, description, func in MIGRATIONS:
+        if migration <= current:
+            continue
+        adbb.log.info("Upgrading database schema to version {}: {}".format(migration, description))
+        with engine.begin() as conn:
+            func(conn)
+            _set_version(conn, migration)
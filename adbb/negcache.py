@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+import adbb
+import adbb.writebehind
+from adbb.db import NegativeCacheTable
+
+# How long AniDB is not asked again about something it didn't know about.
+# The time is doubled for every time in a row AniDB still doesn't know, up
+# to MAX_TTL; new anime, episodes and files are added to AniDB all the time
+# so it's worth asking again eventually.
+TTL = datetime.timedelta(days=1)
+MAX_TTL = datetime.timedelta(days=30)
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _aware(dt):
+    if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
+        return dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
+
+
+def _find(sess, kind, key):
+    return sess.query(NegativeCacheTable).filter_by(kind=kind, key=str(key)).first()
+
+
+def check(kind, key):
+    """True if AniDB recently didn't know about key (an aid, eid, path...)
+    and should not be asked again yet"""
+    sess = adbb.get_session()
+    try:
+        row = _find(sess, kind, key)
+        return bool(row) and _aware(row.expires) > _now()
+    finally:
+        sess.close()
+
+
+def add(kind, key):
+    """Remember that AniDB doesn't know about key"""
+    def _write(sess):
+        row = _find(sess, kind, key)
+        if row:
+            row.misses += 1
+        else:
+            row = NegativeCacheTable(kind=kind, key=str(key), misses=1, created=_now())
+            sess.add(row)
+        row.expires = _now() + min(TTL * 2**(row.misses-1), MAX_TTL)
+        adbb.log.debug("Added {} {} to negative cache until {}".format(kind, key, row.expires))
+
+    adbb.writebehind.submit(_write)
+
+
+def remove(kind, key):
+    """Forget about key, so that AniDB is asked about it on next use"""
+    def _write(sess):
+        # look before deleting; this is called after every successful update
+        # and most objects were never in the cache
+        row = _find(sess, kind, key)
+        if row:
+            sess.delete(row)
+
+    adbb.writebehind.submit(_write)
+
+
+def purge(kind=None):
+    """Remove expired entries, or all entries of kind if given. Returns the
+    number of removed entries."""
+    def _write(sess):
+        query = sess.query(NegativeCacheTable)
+        if kind:
+            query = query.filter_by(kind=kind)
+        else:
+            # keep entries for a while after they expire, so that backoff
+            # continues if AniDB still doesn't know about them
+            query = query.filter(NegativeCacheTable.expires < _now() - MAX_TTL)
+        return query.delete()
+
+    return adbb.writebehind.write(_write)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import json
+import threading
+
+import sqlalchemy
+
+import adbb
+import adbb.writebehind
+from adbb.commands import MyListAddCommand, MyListDelCommand
+from adbb.db import OutboxTable
+from adbb.errors import AniDBError
+
+# Commands changing data at AniDB; these are stored in the outbox table until
+# AniDB has answered them, so they survive restarts and bans.
+OUTBOX_COMMANDS = {
+        'MYLISTADD': MyListAddCommand,
+        'MYLISTDEL': MyListDelCommand,
+        }
+
+# Responses after which the command may not have been applied; the command is
+# kept in the outbox and sent again retry_interval seconds later. Timeouts and
+# server errors (600-604) never reach the callback; the link sends the command
+# again by itself.
+_RETRY_CODES = ('555',)
+# Responses meaning that the change was already made, by an earlier attempt
+# of the same command.
+_APPLIED_CODES = ('310', '411')
+
+# Mylist edits of the same entry sent within this many seconds are merged
+# into a single command; set from init()
+merge_window = 2
+
+# Seconds until commands AniDB didn't accept are sent again
+retry_interval = 1800
+
+_inflight = set()
+_buffered = {}
+_lock = threading.Lock()
+_retry_timer = None
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _parameters(command):
+    return json.dumps({k: v for k, v in command.parameters.items()
+                       if v is not None and k not in ('tag', 's')})
+
+
+def _store(command):
+    def _write(sess):
+        row = OutboxTable(
+                command=command.command,
+                parameters=_parameters(command),
+                created=_now(),
+                attempts=1,
+                last_attempt=_now())
+        sess.add(row)
+        sess.flush()
+        return row.pk
+
+    try:
+        # written right away; the command must not be sent before it's stored
+        pk = adbb.writebehind.write(_write)
+    except sqlalchemy.exc.DBAPIError as e:
+        adbb.log.warning("Failed to store {} in outbox; sending it anyway: {}".format(
+            command.command, e))
+        return None
+    with _lock:
+        _inflight.add(pk)
+    return pk
+
+
+def _update_row(pk, command):
+    if pk is None:
+        return
+    parameters = _parameters(command)
+
+    def _write(sess):
+        sess.query(OutboxTable).filter_by(pk=pk).update({'parameters': parameters})
+
+    try:
+        adbb.writebehind.write(_write)
+    except sqlalchemy.exc.DBAPIError as e:
+        adbb.log.warning("Failed to update outbox entry for {}: {}".format(command.command, e))
+
+
+def _target(command):
+    for key in ('lid', 'fid'):
+        if command.parameters.get(key):
+            return (key, str(command.parameters[key]))
+    return None
+
+
+def _discard(pk):
+    with _lock:
+        _inflight.discard(pk)
+
+
+def _delivered(pk, command, resp):
+    if resp.rescode in _RETRY_CODES:
+        _discard(pk)
+        adbb.log.warning("{} not accepted by AniDB ({} {}); keeping it in the outbox".format(
+            command.command, resp.rescode, resp.resstr))
+        _schedule_retry()
+        return
+    if pk is None:
+        return
+
+    def _write(sess):
+        sess.query(OutboxTable).filter_by(pk=pk).delete()
+
+    # the entry stays in flight until it's gone from the database, so that
+    # drain() doesn't send it again
+    adbb.writebehind.submit(_write, lambda _result: _discard(pk))
+
+
+def _request(pk, command, callback):
+    def _outbox_callback(resp):
+        try:
+            if callback:
+                callback(resp)
+        finally:
+            _delivered(pk, command, resp)
+
+    adbb._anidb.request(command, _outbox_callback, priority='mylist')
+
+
+def _flush(target):
+    with _lock:
+        entry = _buffered.pop(target, None)
+    if not entry:
+        return
+    pk, command, callbacks = entry
+
+    def _merged_callback(resp):
+        for callback in callbacks:
+            if callback:
+                callback(resp)
+
+    _request(pk, command, _merged_callback)
+
+
+def flush():
+    """Send all buffered mylist edits now"""
+    with _lock:
+        targets = list(_buffered)
+    for target in targets:
+        _flush(target)
+
+
+def send(command, callback=None):
+    """Store command in the outbox and send it to AniDB. The command is
+    removed from the outbox once AniDB has answered it; if the process exits
+    before that it is sent again by drain() in the next process.
+
+    Mylist edits (MYLISTADD with edit=1) are held back for merge_window
+    seconds. Further edits of the same lid or fid in that time are merged
+    into the held command, with later values replacing earlier ones, and
+    callback is called for each of them when the merged command is answered."""
+    if command.command not in OUTBOX_COMMANDS:
+        raise AniDBError("{} can not be sent through the outbox".format(command.command))
+    if not adbb._anidb:
+        raise AniDBError("No AniDB link available; init() was called with db_only")
+    target = _target(command)
+    if merge_window and target and command.command == 'MYLISTADD' and command.parameters.get('edit'):
+        with _lock:
+            entry = _buffered.get(target)
+            if entry:
+                pk, buffered, callbacks = entry
+                buffered.parameters.update(
+                        {k: v for k, v in command.parameters.items() if v is not None})
+                callbacks.append(callback)
+        if entry:
+            adbb.log.debug("Merged mylist edit of {} {}".format(*target))
+            _update_row(pk, buffered)
+            return
+        pk = _store(command)
+        with _lock:
+            _buffered[target] = (pk, command, [callback])
+        timer = threading.Timer(merge_window, _flush, args=(target,))
+        timer.daemon = True
+        timer.start()
+        return
+
+    if target:
+        # keep the order of changes to the same entry
+        _flush(target)
+    pk = _store(command)
+    _request(pk, command, callback)
+
+
+def _retry():
+    global _retry_timer
+    with _lock:
+        _retry_timer = None
+    if adbb._anidb:
+        drain()
+
+
+def _schedule_retry():
+    global _retry_timer
+    with _lock:
+        if _retry_timer:
+            return
+        _retry_timer = threading.Timer(retry_interval, _retry)
+        _retry_timer.daemon = True
+        _retry_timer.start()
+
+
+def stop():
+    """Cancel a scheduled resend of commands AniDB didn't accept; they are
+    left in the outbox for the next process"""
+    global _retry_timer
+    with _lock:
+        if _retry_timer:
+            _retry_timer.cancel()
+            _retry_timer = None
+
+
+def _replay_callback(resp):
+    if resp.rescode in _APPLIED_CODES:
+        adbb.log.debug("Outbox command {} was already applied".format(resp.req.command))
+    elif resp.rescode not in _RETRY_CODES:
+        adbb.log.info("Outbox command {} {} answered: {} {}".format(
+            resp.req.command, resp.req.parameters, resp.rescode, resp.resstr))
+
+
+def drain():
+    """Send every command left in the outbox (by earlier processes, or
+    because AniDB didn't accept it) again. Commands may already have been
+    applied by AniDB if the answer was lost; a repeated add or removal is
+    answered with FILE ALREADY IN MYLIST or NO SUCH MYLIST ENTRY, which are
+    treated as success. A repeated add doesn't change an entry that was
+    edited at AniDB in between, and a repeated removal removes an entry
+    that was added again in between."""
+    sess = adbb.get_session()
+    try:
+        rows = sess.query(OutboxTable).order_by(OutboxTable.pk).all()
+    finally:
+        sess.close()
+    with _lock:
+        held = set(x[0] for x in _buffered.values())
+        rows = [x for x in rows if x.pk not in _inflight and x.pk not in held]
+        _inflight.update(x.pk for x in rows)
+    resend = []
+    invalid = []
+    for row in rows:
+        try:
+            command = OUTBOX_COMMANDS[row.command](**json.loads(row.parameters))
+        except (KeyError, ValueError, TypeError, AniDBError) as e:
+            adbb.log.warning("Dropping invalid outbox entry {}: {}".format(row, e))
+            invalid.append(row.pk)
+            continue
+        resend.append((row.pk, command))
+
+    def _write(sess):
+        if invalid:
+            sess.query(OutboxTable).filter(OutboxTable.pk.in_(invalid)).delete(
+                    synchronize_session=False)
+        if resend:
+            sess.query(OutboxTable).filter(OutboxTable.pk.in_([x[0] for x in resend])).update(
+                    {'attempts': OutboxTable.attempts + 1, 'last_attempt': _now()},
+                    synchronize_session=False)
+
+    def _written(_result):
+        with _lock:
+            _inflight.difference_update(invalid)
+
+    adbb.writebehind.submit(_write, _written)
+
+    if resend:
+        adbb.log.info("Resending {} commands from outbox".format(len(resend)))
+    for pk, command in resend:
+        _request(pk, command, _replay_callback)
+    return len(resend)
+
+
+def pending():
+    """Number of commands in the outbox"""
+    sess = adbb.get_session()
+    try:
+        return sess.query(OutboxTable).count()
+    finally:
+        sess.close()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import heapq
+import threading
+import time
+
+import sqlalchemy
+
+import adbb
+import adbb.writebehind
+from adbb.db import AnimeTable, EpisodeTable, FileTable, GroupTable, RefreshRequestTable
+from adbb.errors import AniDBError
+
+DEFAULT_DAILY_BUDGET = 200
+
+# Nothing is refreshed more than once a day
+MIN_AGE = datetime.timedelta(days=1)
+
+# How much staleness (age in proportion to the TTL of the object) counts for
+# each kind of object, when the budget doesn't cover everything that's stale
+KIND_WEIGHTS = {
+        'anime': 1.0,
+        'episode': 0.5,
+        'file': 0.25,
+        'group': 0.25,
+        }
+
+# Rows of each kind scored when planning, as a multiple of the daily budget;
+# the least recently updated rows are taken
+CANDIDATES = 10
+
+_utc = datetime.timezone.utc
+
+
+def _aware(dt):
+    if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
+        return dt.replace(tzinfo=_utc)
+    return dt
+
+
+def score(kind, row, now=None):
+    """Refresh score for a database row, higher means more in need of a
+    refresh. None if the row was updated too recently to be refreshed."""
+    if now is None:
+        now = datetime.datetime.now(_utc)
+    if row.updated and now - _aware(row.updated) < MIN_AGE:
+        return None
+    cls = {'anime': adbb.Anime, 'episode': adbb.Episode,
+           'file': adbb.File, 'group': adbb.Group}[kind]
+    staleness = cls.ttl_policy.staleness(row, now)
+    return min(staleness, 1000) * KIND_WEIGHTS[kind]
+
+
+def _cost(kind, key):
+    # AniDB requests expected for a refresh; files only known by lid are
+    # looked up with MYLIST before FILE
+    if kind == 'file' and key[0] == 'lid':
+        return 2
+    return 1
+
+
+def _sent(obj):
+    return object.__getattribute__(obj, '_sent_requests')
+
+
+class RefreshPlanner:
+    """Refreshes the objects in the database that are most in need of it,
+    using at most daily_budget AniDB requests per 24 hours. Objects are scored
+    by their age in proportion to the TTL given by the ttl_policy of their
+    type (see adbb.ttl). The requests sent are stored in the database, so the
+    budget is shared by all processes using it.
+
+    Use run() to refresh a batch at once (the adbb_cache refresh command), or
+    start() to refresh one object at a time whenever the link is idle, spread
+    out over the day."""
+
+    def __init__(self, daily_budget=DEFAULT_DAILY_BUDGET):
+        self.daily_budget = daily_budget
+        self._stop = threading.Event()
+        self._thread = None
+        self._plan = []
+        self._planned = 0
+
+    @staticmethod
+    def _candidates(sess, table, cutoff, limit, *criteria):
+        # never updated rows first, then the least recently updated ones
+        query = sess.query(table).filter(*criteria)
+        rows = query.filter(table.updated == None).limit(limit).all()
+        return rows + query.filter(table.updated < cutoff).order_by(
+                table.updated).limit(limit - len(rows)).all()
+
+    def _rows(self, now):
+        cutoff = now - MIN_AGE
+        limit = max(self.daily_budget, 1) * CANDIDATES
+        sess = adbb.get_session()
+        try:
+            yield from (('anime', x.aid, x) for x in self._candidates(
+                sess, AnimeTable, cutoff, limit))
+            yield from (('episode', x.eid, x) for x in self._candidates(
+                sess, EpisodeTable, cutoff, limit))
+            for x in self._candidates(sess, FileTable, cutoff, limit,
+                    sqlalchemy.or_(FileTable.fid != None, FileTable.lid != None)):
+                if x.fid:
+                    yield 'file', ('fid', x.fid), x
+                else:
+                    yield 'file', ('lid', x.lid), x
+            yield from (('group', x.gid, x) for x in self._candidates(
+                sess, GroupTable, cutoff, limit, GroupTable.gid != None))
+        finally:
+            sess.close()
+
+    def plan(self):
+        """Heap of (-score, kind, key) for all objects due for a refresh"""
+        now = datetime.datetime.now(_utc)
+        heap = []
+        for kind, key, row in self._rows(now):
+            s = score(kind, row, now)
+            if s is not None:
+                heap.append((-s, kind, key))
+        heapq.heapify(heap)
+        return heap
+
+    def remaining(self):
+        """Requests left of the budget for the last 24 hours"""
+        since = datetime.datetime.now(_utc) - datetime.timedelta(days=1)
+        sess = adbb.get_session()
+        try:
+            spent = sess.query(sqlalchemy.func.sum(RefreshRequestTable.requests)).filter(
+                    RefreshRequestTable.spent > since).scalar()
+        finally:
+            sess.close()
+        return max(self.daily_budget - (spent or 0), 0)
+
+    def _spend(self, count):
+        if not count:
+            return
+        now = datetime.datetime.now(_utc)
+
+        def _write(sess):
+            sess.query(RefreshRequestTable).filter(
+                    RefreshRequestTable.spent < now - datetime.timedelta(days=1)).delete()
+            sess.add(RefreshRequestTable(spent=now, requests=count))
+
+        adbb.writebehind.submit(_write)
+
+    @staticmethod
+    def _object(kind, key):
+        if kind == 'anime':
+            return adbb.Anime(key)
+        if kind == 'episode':
+            return adbb.Episode(eid=key)
+        if kind == 'file':
+            return adbb.File(**{key[0]: key[1]})
+        return adbb.Group(gid=key)
+
+    def _take(self, budget, limit=None):
+        plan = self.plan()
+        objs = []
+        while plan and (limit is None or len(objs) < limit):
+            _score, kind, key = heapq.heappop(plan)
+            if _cost(kind, key) > budget:
+                break
+            try:
+                objs.append(self._object(kind, key))
+            except AniDBError as e:
+                adbb.log.warning("Can't refresh {} {}: {}".format(kind, key, e))
+                continue
+            budget -= _cost(kind, key)
+        return objs
+
+    def run(self, limit=None):
+        """Refresh the highest scored objects, as many as the budget (and
+        limit, if given) allows. Returns the refreshed objects."""
+        remaining = self.remaining()
+        objs = self._take(remaining, limit)
+        adbb.log.info("Refreshing {} objects, {} requests left of the daily budget".format(
+            len(objs), remaining))
+        sent = [_sent(x) for x in objs]
+        try:
+            return list(adbb.wait_all(adbb.update_many(objs, priority='background')))
+        finally:
+            self._spend(sum(_sent(x) - y for x, y in zip(objs, sent)))
+
+    def _idle(self):
+        is_idle = getattr(adbb._anidb, 'is_idle', None)
+        return is_idle() if is_idle else True
+
+    def _next(self):
+        # the plan is rebuilt every hour, or when it runs out
+        if not self._plan or time.time() - self._planned > 3600:
+            self._plan = self.plan()
+            self._planned = time.time()
+        while self._plan:
+            _score, kind, key = heapq.heappop(self._plan)
+            try:
+                return self._object(kind, key)
+            except AniDBError as e:
+                adbb.log.warning("Can't refresh {} {}: {}".format(kind, key, e))
+        return None
+
+    def _run_idle(self):
+        interval = 86400 / max(self.daily_budget, 1)
+        while not self._stop.wait(interval):
+            while not self._idle() or not self.remaining():
+                if self._stop.wait(10):
+                    return
+            try:
+                obj = self._next()
+            except Exception as e:
+                adbb.log.warning("Failed to plan cache refresh: {}".format(e))
+                continue
+            if obj is None:
+                continue
+            adbb.log.debug("Planned refresh of {}".format(obj))
+            sent = _sent(obj)
+            future = obj.update(priority='background')
+            future.add_done_callback(
+                    lambda _future, obj=obj, sent=sent: self._spend(_sent(obj) - sent))
+
+    def start(self):
+        """Refresh objects in the background while the link is idle, evenly
+        spread out so that the daily budget lasts the whole day"""
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run_idle, name='refresh-planner')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
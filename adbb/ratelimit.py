@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sqlite3
+import threading
+from time import time, sleep
+
+# The UDP API defines two limits:
+#   * short term: no more than one packet every two seconds
+#   * long term: no more than one packet every four seconds "over an extended
+#     amount of time"
+# Each limit is described as (seconds per packet, burst). The burst is how
+# many packets can be sent back-to-back (at the next shorter limit) after the
+# link has been idle long enough to refill the bucket.
+DEFAULT_LIMITS = (
+        (2, 1),
+        (4, 5),
+        )
+
+
+class TokenBucket:
+    def __init__(self, interval, burst):
+        self.interval = interval
+        self.rate = 1/interval
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time()
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now-self.stamp)*self.rate)
+            self.stamp = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available in this bucket"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1-self.tokens)/self.rate
+
+    def consume(self, now):
+        """Take a token from the bucket. Tokens can go negative, which is how
+        a reservation of a future slot is represented."""
+        self._refill(now)
+        self.tokens -= 1
+
+    def __repr__(self):
+        return "TokenBucket(interval={}, burst={}, tokens={:.2f})".format(
+                self.interval, self.burst, self.tokens)
+
+
+class RateLimiter:
+    """Keeps track of the AniDB request budget using one token bucket per
+    time window. A packet may only be sent when all buckets have a token
+    available."""
+
+    def __init__(self, limits=DEFAULT_LIMITS):
+        self._lock = threading.Lock()
+        self._buckets = [TokenBucket(interval, burst) for interval, burst in limits]
+
+    @property
+    def limits(self):
+        return tuple((b.interval, b.burst) for b in self._buckets)
+
+    def _transaction(self, fn):
+        """Call fn(now, buckets) with exclusive access to the buckets"""
+        with self._lock:
+            return fn(time(), self._buckets)
+
+    def time_until_next_slot(self):
+        """Seconds until the next packet can be sent, without reserving it"""
+        def _wait(now, buckets):
+            return max([b.wait_time(now) for b in buckets] + [0])
+        return self._transaction(_wait)
+
+    def reserve(self):
+        """Reserve the next free slot and return the number of seconds the
+        caller has to wait before it may send its packet."""
+        def _reserve(now, buckets):
+            delay = max([b.wait_time(now) for b in buckets] + [0])
+            for b in buckets:
+                b.consume(now)
+            return delay
+        return self._transaction(_reserve)
+
+    def acquire(self):
+        """Block until a slot is available; returns the time spent waiting"""
+        delay = self.reserve()
+        if delay > 0:
+            sleep(delay)
+        return delay
+
+    def get_state(self):
+        """Bucket state as a list of (tokens, stamp) tuples"""
+        def _get(now, buckets):
+            for b in buckets:
+                b._refill(now)
+            return [(b.tokens, b.stamp) for b in buckets]
+        return self._transaction(_get)
+
+    def restore_state(self, limits, state):
+        """Restore bucket state from get_state(), if it was saved with the
+        same limits; used to keep the budget across restarts"""
+        if [tuple(x) for x in limits] != [tuple(x) for x in self.limits]:
+            return
+        def _restore(now, buckets):
+            for b, (tokens, stamp) in zip(buckets, state):
+                if stamp <= now:
+                    b.tokens = min(b.tokens, tokens)
+                    b.stamp = stamp
+        self._transaction(_restore)
+
+    def __repr__(self):
+        return "RateLimiter({})".format(self._buckets)
+
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter where the bucket state is stored in a sqlite database, so
+    that several processes on the same host can share the same request
+    budget. All processes using the same file should use the same limits;
+    if they differ the stored state is reset to the limits of the last
+    process that started."""
+
+    def __init__(self, path, limits=DEFAULT_LIMITS):
+        super(SharedRateLimiter, self).__init__(limits)
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                    'CREATE TABLE IF NOT EXISTS bucket ('
+                    'idx INTEGER PRIMARY KEY, '
+                    'interval REAL NOT NULL, '
+                    'burst REAL NOT NULL, '
+                    'tokens REAL NOT NULL, '
+                    'stamp REAL NOT NULL)')
+            stored = conn.execute(
+                    'SELECT interval, burst FROM bucket ORDER BY idx').fetchall()
+            if [tuple(x) for x in stored] != [(float(b.interval), float(b.burst)) for b in self._buckets]:
+                conn.execute('DELETE FROM bucket')
+                self._save(conn, self._buckets)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return conn
+
+    def _save(self, conn, buckets):
+        conn.executemany(
+                'INSERT OR REPLACE INTO bucket (idx, interval, burst, tokens, stamp) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(i, b.interval, b.burst, b.tokens, b.stamp) for i, b in enumerate(buckets)])
+
+    def _transaction(self, fn):
+        with self._lock:
+            conn = self._connect()
+            try:
+                # BEGIN IMMEDIATE takes the write lock at once, so the
+                # read-modify-write of the buckets is atomic between processes
+                conn.execute('BEGIN IMMEDIATE')
+                rows = conn.execute(
+                        'SELECT tokens, stamp FROM bucket ORDER BY idx').fetchall()
+                for b, (tokens, stamp) in zip(self._buckets, rows):
+                    b.tokens = tokens
+                    b.stamp = stamp
+                ret = fn(time(), self._buckets)
+                self._save(conn, self._buckets)
+                conn.execute('COMMIT')
+            except sqlite3.Error:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            finally:
+                conn.close()
+            return ret
+
+    def restore_state(self, limits, state):
+        # the shared state is already persisted in the database
+        pass
+
+    def __repr__(self):
+        return "SharedRateLimiter(path='{}', {})".format(self.path, self._buckets)
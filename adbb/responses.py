@@ -22,6 +22,7 @@ from types import FunctionType
 class ResponseResolver:
     def __init__(self, data):
         data = data.decode('utf-8')
+        self.raw = data
         restag, rescode, resstr, datalines = self.parse(data)
 
         self.restag = restag
@@ -47,7 +48,9 @@ class ResponseResolver:
         return restag, rescode, resstr, datalines
 
     def resolve(self, cmd):
-        return responses[self.rescode](cmd, self.restag, self.rescode, self.resstr, self.datalines)
+        resp = responses[self.rescode](cmd, self.restag, self.rescode, self.resstr, self.datalines)
+        resp.raw = self.raw
+        return resp
 
 
 class Response:
@@ -1137,7 +1140,19 @@ class FileAlreadyInMylistResponse(Response):
         Response.__init__(self, cmd, restag, rescode, resstr, datalines)
         self.codestr = 'FILE_ALREADY_IN_MYLIST'
         self.codehead = ()
-        self.codetail = ()
+        # the existing entry, in the same format as the MYLIST response
+        self.codetail = (
+            'lid',
+            'fid',
+            'eid',
+            'aid',
+            'gid',
+            'date',
+            'mylist_state',
+            'mylist_viewdate',
+            'mylist_storage',
+            'mylist_source',
+            'mylist_other')
         self.coderep = ()
 
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import deque
+from time import time
+
+# Priority classes, most important first.
+#   interactive - someone is blocking on the answer
+#   mylist      - changes to the users mylist
+#   normal      - everything else
+#   background  - opportunistic cache refreshes
+PRIORITY_CLASSES = ('interactive', 'mylist', 'normal', 'background')
+
+
+class RequestScheduler:
+    """Queue of commands waiting to be sent, split in named priority classes.
+
+    Commands are sent in FIFO order within each class, and the class with the
+    most important head is sent first. To make sure low priority work is not
+    starved forever, a command is treated as one class more important for
+    every aging_interval seconds it has been waiting. Commands from classes
+    below aging_limit climb no higher than aging_limit, so waiting background
+    work does not get ahead of interactive and mylist commands; commands
+    from aging_limit and above climb at most one class."""
+
+    def __init__(self, classes=PRIORITY_CLASSES, aging_interval=300, aging_limit='normal'):
+        self.classes = tuple(classes)
+        self.aging_interval = aging_interval
+        if aging_limit in self.classes:
+            self.aging_limit = self.classes.index(aging_limit)
+        else:
+            self.aging_limit = len(self.classes) - 1
+        self._queues = {c: deque() for c in self.classes}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _check_class(self, priority):
+        if priority not in self._queues:
+            raise ValueError("Unknown priority class '{}'".format(priority))
+
+    def push(self, command, priority='normal', queued=None):
+        """Queue command; queued is the time it was first queued, if it's
+        not now"""
+        self._check_class(priority)
+        with self._lock:
+            self._queues[priority].append((queued or time(), command))
+
+    def push_front(self, command, priority='normal', queued=None):
+        """Put command first in its class; used when a command has to be
+        sent again. Pass the time it was first queued as queued to keep its
+        age."""
+        self._check_class(priority)
+        with self._lock:
+            self._queues[priority].appendleft((queued or time(), command))
+
+    def _floor(self, rank):
+        # most important rank a command of class rank can age to
+        if rank > self.aging_limit:
+            return self.aging_limit
+        return max(rank - 1, 0)
+
+    def promote(self, command, priority='interactive'):
+        """Move a waiting command to the more important class priority,
+        keeping its place in time; used when someone starts waiting for a
+        command queued as background work. Returns False if command isn't
+        waiting (it may already have been sent)."""
+        self._check_class(priority)
+        with self._lock:
+            for current, queue in self._queues.items():
+                entry = next((x for x in queue if x[1] is command), None)
+                if entry is None:
+                    continue
+                if self.classes.index(current) <= self.classes.index(priority):
+                    return True
+                queue.remove(entry)
+                target = self._queues[priority]
+                # keep the class in order of queueing time
+                index = len(target)
+                while index and target[index-1][0] > entry[0]:
+                    index -= 1
+                target.insert(index, entry)
+                command.priority_class = priority
+                return True
+        return False
+
+    def pop(self):
+        """Return the next command to send, or None if the queue is empty"""
+        now = time()
+        with self._lock:
+            best = None
+            best_score = None
+            for rank, priority in enumerate(self.classes):
+                queue = self._queues[priority]
+                if not queue:
+                    continue
+                queued, _command = queue[0]
+                # whole classes, so that aged commands are ordered by age
+                # among the commands of the class they have reached
+                score = max(rank - int((now - queued) // self.aging_interval), self._floor(rank))
+                # on equal score the command that has waited longest goes first
+                if best is None or (score, queued) < best_score:
+                    best = queue
+                    best_score = (score, queued)
+            if best is None:
+                return None
+            return best.popleft()[1]
+
+    def stats(self):
+        with self._lock:
+            return {c: len(q) for c, q in self._queues.items()}
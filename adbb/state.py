@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+import adbb
+
+# Bump if the content of the state file changes in an incompatible way; state
+# files with another version are ignored.
+STATE_VERSION = 1
+
+
+def load_state(path):
+    """Read link state saved by save_state(). Returns None if there is no
+    usable state in path."""
+    path = os.path.expanduser(path)
+    try:
+        with open(path, 'r') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        adbb.log.warning("Could not read state file {}: {}".format(path, e))
+        return None
+    if not isinstance(state, dict) or state.get('version') != STATE_VERSION:
+        adbb.log.warning("Ignoring state file {} with unknown format".format(path))
+        return None
+    return state
+
+
+def save_state(path, state):
+    """Atomically write state to path. The file contains the session key, so
+    it is only readable by the owner."""
+    path = os.path.expanduser(path)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    state = dict(state, version=STATE_VERSION)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        adbb.log.warning("Could not save state file {}: {}".format(path, e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import queue
+import socket
+import threading
+import zlib
+from collections import deque
+
+import adbb
+
+# Parameters that differ between otherwise identical commands, and are left
+# out when commands are recorded and matched during replay.
+_VOLATILE_PARAMETERS = ('tag', 's')
+# Parameters never written to a recording
+_SECRET_PARAMETERS = ('pass',)
+
+
+def _journal_key(command, parameters):
+    if command == 'AUTH':
+        # credentials are not recorded, so any AUTH matches
+        return (command,)
+    return (command, tuple(sorted(
+        (k, str(v)) for k, v in parameters.items() if k not in _VOLATILE_PARAMETERS)))
+
+
+def _split_tag(data):
+    """Split the tag from a decoded response; returns (tag, rest)"""
+    if data[:1] == b'T':
+        tag, _sep, rest = data.partition(b' ')
+        return tag.decode('utf-8'), rest
+    return None, data
+
+
+def encrypt(cipher, data):
+    pad_len = 16-len(data) % 16
+    padding = (chr(pad_len)*pad_len).encode('utf-8')
+    data = data + padding
+    return cipher.encrypt(data)
+
+
+def decrypt(cipher, data):
+    data = cipher.decrypt(data)
+    pad_len = data[-1]
+    return data[:-pad_len]
+
+
+def decode(cipher, data):
+    """Decrypt and decompress a packet received from AniDB"""
+    adbb.log.debug("NetIO < %s" % repr(data))
+    if cipher:
+        try:
+            data = decrypt(cipher, data)
+        except ValueError:
+            pass
+    if data[:2] == b'\x00\x00':
+        data = zlib.decompressobj().decompress(data[2:])
+        adbb.log.debug("UnZip | %s" % repr(data))
+    return data
+
+
+def encode(cipher, command, data):
+    """Encrypt (if a cipher is given) the raw data for command"""
+    if cipher:
+        data = encrypt(cipher, data)
+    if command.command == 'AUTH':
+        adbb.log.debug("NetIO > AUTH data is not logged!")
+    else:
+        adbb.log.debug("NetIO > %s" % repr(data))
+    return data
+
+
+class UDPTransport:
+    """Sends commands to and receives responses from the AniDB UDP API.
+    Handles encryption and decompression, so that recv() always returns the
+    plain response."""
+
+    def __init__(self, server, myport=9876):
+        self.server = server
+        self.cipher = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', myport))
+
+    @property
+    def closed(self):
+        return self.sock is None
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, command, data):
+        """Send the raw (unencrypted) data for command"""
+        self.sock.sendto(encode(self.cipher, command, data), self.server)
+
+    def recv(self, timeout):
+        """Wait at most timeout seconds for a response; raises socket.timeout
+        if nothing arrives"""
+        sock = self.sock
+        if not sock:
+            raise OSError("Transport is closed")
+        sock.settimeout(timeout)
+        return decode(self.cipher, sock.recv(8192))
+
+
+class RecordingTransport:
+    """Wraps another transport and writes every command and its response
+    to a journal, one json object per line:
+
+        {"command": "ANIME", "parameters": {...}, "response": "230 ANIME\\n..."}
+
+    Tags and session keys are left out, and so is the password in AUTH. The
+    journal can be used with ReplayTransport."""
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = os.path.expanduser(path)
+        self._journal = open(self.path, 'a', encoding='utf-8')
+        self._sent = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cipher(self):
+        return self.transport.cipher
+
+    @cipher.setter
+    def cipher(self, cipher):
+        self.transport.cipher = cipher
+
+    @property
+    def closed(self):
+        return self.transport.closed
+
+    def close(self):
+        self.transport.close()
+        with self._lock:
+            if not self._journal.closed:
+                self._journal.close()
+
+    def send(self, command, data):
+        parameters = {k: v for k, v in command.parameters.items()
+                      if k not in _VOLATILE_PARAMETERS + _SECRET_PARAMETERS and v is not None}
+        with self._lock:
+            self._sent[command.tag] = (command.command, parameters)
+        self.transport.send(command, data)
+
+    def recv(self, timeout):
+        data = self.transport.recv(timeout)
+        tag, rest = _split_tag(data)
+        with self._lock:
+            sent = self._sent.pop(tag, None)
+            if sent and not self._journal.closed:
+                command, parameters = sent
+                self._journal.write(json.dumps({
+                    'command': command,
+                    'parameters': parameters,
+                    'response': rest.decode('utf-8')}) + '\n')
+                self._journal.flush()
+        return data
+
+
+class ReplayTransport:
+    """Answers commands from a journal written by RecordingTransport,
+    without any network traffic. Responses to identical commands are
+    returned in the order they were recorded; when they run out the last
+    one is repeated. Commands missing from the journal get a 598 UNKNOWN
+    COMMAND response."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.cipher = None
+        self._responses = {}
+        self._queue = queue.Queue()
+        self._closed = False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = _journal_key(entry['command'], entry.get('parameters', {}))
+                self._responses.setdefault(key, deque()).append(entry['response'])
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+    def send(self, command, data):
+        key = _journal_key(command.command, {
+            k: v for k, v in command.parameters.items() if v is not None})
+        responses = self._responses.get(key)
+        if not responses:
+            adbb.log.warning("No recorded response for {} {}".format(
+                command.command, command.parameters))
+            response = '598 UNKNOWN COMMAND\n'
+        elif len(responses) > 1:
+            response = responses.popleft()
+        else:
+            response = responses[0]
+        self._queue.put('{} {}'.format(command.tag, response).encode('utf-8'))
+
+    def recv(self, timeout):
+        if self._closed:
+            raise OSError("Transport is closed")
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout()
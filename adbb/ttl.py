@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import abc
+import datetime
+
+_utc = datetime.timezone.utc
+
+# Anime ending, and episodes airing, within this time are still likely to
+# change at AniDB (titles, ratings, episode counts...)
+RECENT = datetime.timedelta(weeks=4)
+
+
+def _aware(dt):
+    if dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None:
+        return dt.replace(tzinfo=_utc)
+    return dt
+
+
+def _jitter(row):
+    # spread out refreshes of objects fetched at the same time; up to +-10%
+    # depending on the row, but always the same for the same row
+    pk = getattr(row, 'pk', None) or 0
+    return 1 + ((pk * 2654435761) % 201 - 100) / 1000
+
+
+class TTLPolicy(abc.ABC):
+    """Decides for how long cached data for one type of object is fresh.
+    Policies are given the database row (db_data) of the object; set the
+    ttl_policy attribute of Anime, Episode, File or Group to replace the
+    default policy for that type."""
+
+    @abc.abstractmethod
+    def ttl(self, row, now):
+        """timedelta after which row should be refreshed"""
+
+    def staleness(self, row, now=None):
+        """Age of row in proportion to its TTL; 1 or more means it should be
+        refreshed"""
+        if now is None:
+            now = datetime.datetime.now(_utc)
+        if not row.updated:
+            return float('inf')
+        age = now - _aware(row.updated)
+        return age / (self.ttl(row, now) * _jitter(row))
+
+    def is_stale(self, row, now=None):
+        return self.staleness(row, now) >= 1
+
+
+class FixedTTLPolicy(TTLPolicy):
+    """Same TTL for everything"""
+
+    def __init__(self, days):
+        self.days = days
+
+    def ttl(self, row, now):
+        return datetime.timedelta(days=self.days)
+
+
+class AnimeTTLPolicy(TTLPolicy):
+    """Finished anime are refreshed rarely, upcoming and airing anime often,
+    and airing anime once more as soon as a new episode is expected to have
+    aired (assuming weekly episodes)."""
+
+    finished_ttl = datetime.timedelta(days=365)
+    recent_ttl = datetime.timedelta(days=14)
+    airing_ttl = datetime.timedelta(days=7)
+    upcoming_ttl = datetime.timedelta(days=7)
+    unknown_ttl = datetime.timedelta(days=30)
+
+    def ttl(self, row, now):
+        today = now.date()
+        if row.end_date and row.end_date + RECENT < today:
+            ttl = self.finished_ttl
+        elif row.end_date and row.end_date <= today:
+            ttl = self.recent_ttl
+        elif row.air_date and row.air_date > today:
+            # no need to wait longer than the first airing
+            ttl = min(self.upcoming_ttl, max(
+                datetime.timedelta(days=1),
+                row.air_date - _aware(row.updated).date()))
+        elif row.air_date:
+            ttl = self.airing_ttl
+        else:
+            ttl = self.unknown_ttl
+        # anime AniDB changed shortly before we fetched it are likely to have
+        # changed again since
+        if row.anidb_updated and ttl > self.airing_ttl and \
+                _aware(row.updated) - _aware(row.anidb_updated) < RECENT:
+            ttl = ttl / 2
+        return ttl
+
+    def expected_episode(self, row, now):
+        """Date of the first episode expected to have aired since row was
+        updated, or None"""
+        today = now.date()
+        if not row.air_date or row.air_date > today or \
+                (row.end_date and row.end_date < _aware(row.updated).date()):
+            return None
+        updated = _aware(row.updated).date()
+        weeks = max((updated - row.air_date).days // 7 + 1, 0)
+        expected = row.air_date + datetime.timedelta(weeks=weeks)
+        if expected <= today:
+            return expected
+        return None
+
+    def staleness(self, row, now=None):
+        if now is None:
+            now = datetime.datetime.now(_utc)
+        staleness = super(AnimeTTLPolicy, self).staleness(row, now)
+        if row.updated and self.expected_episode(row, now):
+            return max(staleness, 1)
+        return staleness
+
+
+class EpisodeTTLPolicy(TTLPolicy):
+    """Episodes are refreshed often around their airing, when titles and
+    ratings are added, and rarely after that."""
+
+    unaired_ttl = datetime.timedelta(days=7)
+    recent_ttl = datetime.timedelta(days=7)
+    old_ttl = datetime.timedelta(days=180)
+    unknown_ttl = datetime.timedelta(days=30)
+
+    def ttl(self, row, now):
+        today = now.date()
+        if not row.aired:
+            return self.unknown_ttl
+        if row.aired > today:
+            return min(self.unaired_ttl, max(
+                datetime.timedelta(days=1),
+                row.aired - _aware(row.updated).date()))
+        if row.aired + RECENT >= today:
+            return self.recent_ttl
+        return self.old_ttl
+
+
+class FileTTLPolicy(TTLPolicy):
+    """Files hardly change once released; files in mylist are refreshed more
+    often than files that aren't, or that are marked deleted."""
+
+    mylist_ttl = datetime.timedelta(days=90)
+    default_ttl = datetime.timedelta(days=180)
+    deleted_ttl = datetime.timedelta(days=365)
+
+    def ttl(self, row, now):
+        if row.mylist_state == 'deleted':
+            return self.deleted_ttl
+        if row.lid:
+            return self.mylist_ttl
+        return self.default_ttl
+
+
+class GroupTTLPolicy(TTLPolicy):
+    """Active groups get new releases (and ratings); disbanded groups don't"""
+
+    active_ttl = datetime.timedelta(days=30)
+    disbanded_ttl = datetime.timedelta(days=365)
+
+    def ttl(self, row, now):
+        if row.disbanded:
+            return self.disbanded_ttl
+        return self.active_ttl
@@ -1,6 +1,7 @@
 #!/bin/env python3
 import argparse
 import datetime
+import heapq
 import logging
 import os
 import re
@@ -12,12 +13,13 @@ import time
 import adbb
 import adbb.anames
 import adbb.fileinfo
+import adbb.negcache
+import adbb.planner
 from adbb.errors import *
 from adbb.db import *
 import sqlalchemy.exc
 
 status_msg=None
-ignorelist=set()
 
 # These extensions are considered video types
 SUPPORTED_FILETYPES = [
@@ -152,6 +154,31 @@ def arrange_anime_args():
             help="Enable encryption using the given API key as defined in your AniDB profile",
             default=None
             )
+    parser.add_argument(
+            '--rate-budget-file',
+            help="Share the AniDB request budget with other adbb processes on this host using this file",
+            default=None
+            )
+    parser.add_argument(
+            '--broker-socket',
+            help="Send AniDB requests through an adbb_broker listening on this unix socket",
+            default=None
+            )
+    parser.add_argument(
+            '--state-file',
+            help="Save the AniDB session and ban state in this file, so the session can be resumed by the next run",
+            default=None
+            )
+    parser.add_argument(
+            '--record-file',
+            help="Record all AniDB requests and responses to this file",
+            default=None
+            )
+    parser.add_argument(
+            '--replay-file',
+            help="Answer AniDB requests from a file written with --record-file instead of asking AniDB",
+            default=None
+            )
     return parser.parse_args()
 
 def create_filelist(paths, recurse=True, ignore_dirs=EXTRAS_DIRS):
@@ -326,9 +353,8 @@ def arrange_files(
         disable_mylist=False,
         callback=None,
         ):
-    global ignorelist
     log = logging.getLogger(__name__)
-    for f in [i for i in filelist if not i in ignorelist]:
+    for f in filelist:
         try:
             epfile = adbb.File(path=f)
             if epfile.group:
@@ -348,8 +374,9 @@ def arrange_files(
                 else:
                     group = "unknown"
         except IllegalAnimeObject:
+            # remembered in the negative cache, so it's not hashed again for
+            # a while
             log.error(f"Ignoring file '{f}': unknown Anime/Episode")
-            ignorelist.add(f)
             continue
 
         # how many characters in an episode number? will probably return 1 (<10
@@ -485,7 +512,7 @@ def arrange_anime():
     if not filelist:
         sys.exit(0)
     log = get_command_logger(debug=args.debug)
-    adbb.init(args.sql_url, api_user=args.username, api_pass=args.password, logger=log, netrc_file=args.authfile, api_key=args.api_key)
+    adbb.init(args.sql_url, api_user=args.username, api_pass=args.password, logger=log, netrc_file=args.authfile, api_key=args.api_key, rate_budget_file=args.rate_budget_file, broker_socket=args.broker_socket, state_file=args.state_file, record_file=args.record_file, replay_file=args.replay_file)
     arrange_files(
             filelist,
             target_dir=args.target_dir,
@@ -539,6 +566,31 @@ def get_cache_cleaner_args():
             help="Enable encryption using the given API key as defined in your AniDB profile",
             default=None
             )
+    parser.add_argument(
+            '--rate-budget-file',
+            help="Share the AniDB request budget with other adbb processes on this host using this file",
+            default=None
+            )
+    parser.add_argument(
+            '--broker-socket',
+            help="Send AniDB requests through an adbb_broker listening on this unix socket",
+            default=None
+            )
+    parser.add_argument(
+            '--state-file',
+            help="Save the AniDB session and ban state in this file, so the session can be resumed by the next run",
+            default=None
+            )
+    parser.add_argument(
+            '--record-file',
+            help="Record all AniDB requests and responses to this file",
+            default=None
+            )
+    parser.add_argument(
+            '--replay-file',
+            help="Answer AniDB requests from a file written with --record-file instead of asking AniDB",
+            default=None
+            )
     subparsers=parser.add_subparsers(dest='operation', help='Type of cache cleaning')
 
     parser_old=subparsers.add_parser('old', help='Remove old stuff that has not been accessed in a long time')
@@ -548,6 +600,13 @@ def get_cache_cleaner_args():
             type=int,
             default=90)
 
+    parser_negative=subparsers.add_parser('negative', help='Forget about things AniDB did not know about, so that they are looked up again')
+    parser_negative.add_argument(
+            '-k', '--kind',
+            help='Only forget this kind of entries',
+            choices=['anime', 'episode', 'file'],
+            default=None)
+
     parser_anime=subparsers.add_parser('anime', help='Remove anime entries')
     parser_anime.add_argument(
             'ids',
@@ -570,6 +629,18 @@ def get_cache_cleaner_args():
             help='Episode ID:s, or episode numbers if --anime-flag is used, to remove',
             nargs='+')
 
+    parser_refresh=subparsers.add_parser('refresh', help='Refresh the entries most in need of it from AniDB, requires UDP API credentials to be set')
+    parser_refresh.add_argument(
+            '--budget',
+            help='Maximum number of AniDB requests to use per day',
+            type=int,
+            default=adbb.planner.DEFAULT_DAILY_BUDGET)
+    parser_refresh.add_argument(
+            '-l', '--limit',
+            help='Maximum number of entries to refresh in this run',
+            type=int,
+            default=None)
+
     parser_file=subparsers.add_parser('file', help='Remove file entries')
     parser_file.add_argument(
             '-m', '--remove-from-mylist',
@@ -611,6 +682,17 @@ def cache_cleaner():
                     sess.delete(obj)
         sess.commit()
         adbb.close_session(sess)
+        if not args.dry_run:
+            count = adbb.negcache.purge()
+            log.info(f'Removed {count} expired negative cache entries')
+
+    elif args.operation == 'negative':
+        kinds = [args.kind] if args.kind else ['anime', 'episode', 'file']
+        for kind in kinds:
+            if args.dry_run:
+                continue
+            count = adbb.negcache.purge(kind)
+            log.info(f'Removed {count} {kind} entries from negative cache')
 
     elif args.operation == 'anime':
         aids = set()
@@ -660,7 +742,7 @@ def cache_cleaner():
                 aid = int(args.anime)
             except ValueError:
                 aid, _titles, _score, _title = get_titles(name=i, max_results=1)[0]
-            res = sess.query(EpisodeTable).filter(EpisodeTable.aid == aid, EpisodeTable.epno.in_(args.ids)).all()
+            res = sess.query(EpisodeTable).filter(EpisodeTable.aid == aid, EpisodeTable.epno_normalized.in_([normalize_epno(x) for x in args.ids])).all()
         else:
             ids = [int(x) for x in args.ids]
             res = sess.query(EpisodeTable).filter(EpisodeTable.eid.in_(ids)).all()
@@ -671,6 +753,26 @@ def cache_cleaner():
         sess.commit()
         adbb.close_session(sess)
 
+    elif args.operation == 'refresh':
+        planner = adbb.planner.RefreshPlanner(daily_budget=args.budget)
+        if args.dry_run:
+            plan = planner.plan()
+            for score, kind, key in heapq.nsmallest(args.limit or args.budget, plan):
+                log.info(f'Would refresh {kind} {key} (score {-score:.1f})')
+        else:
+            adbb.close()
+            adbb.init(
+                    args.sql_url,
+                    api_user=args.username,
+                    api_pass=args.password,
+                    logger=log,
+                    netrc_file=args.authfile,
+                    api_key=args.api_key,
+                    db_only=False,
+                    rate_budget_file=args.rate_budget_file, broker_socket=args.broker_socket, state_file=args.state_file, record_file=args.record_file, replay_file=args.replay_file)
+            for obj in planner.run(limit=args.limit):
+                log.info(f'Refreshed {obj}')
+
     elif args.operation == 'file':
         if args.remove_from_mylist:
             adbb.close()
@@ -681,7 +783,8 @@ def cache_cleaner():
                     logger=log,
                     netrc_file=args.authfile,
                     api_key=args.api_key,
-                    db_only=False)
+                    db_only=False,
+                    rate_budget_file=args.rate_budget_file, broker_socket=args.broker_socket, state_file=args.state_file, record_file=args.record_file, replay_file=args.replay_file)
         files = set()
         ids = set()
         for file in args.files:
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import time
+
+import adbb
+
+
+class WorkerPool:
+    """A bounded pool of reusable worker threads.
+
+    Some jobs (response callbacks creating new objects, for example) may
+    themselves wait for other AniDB responses. If all workers are busy and
+    the oldest queued job has waited for more than stall_timeout seconds, a
+    temporary extra worker is started so the pool can't deadlock on itself.
+    The temporary worker exits as soon as the queue is empty."""
+
+    def __init__(self, name, workers=4, stall_timeout=5, stats_interval=300):
+        self.name = name
+        self.size = max(1, workers)
+        self.stall_timeout = stall_timeout
+        self.stats_interval = stats_interval
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._workers = 0
+        self._extra_workers = 0
+        self._running = 0
+        self._stopped = threading.Event()
+
+        self._handled = 0
+        self._total_wait = 0
+        self._total_latency = 0
+        self._max_latency = 0
+        self._max_depth = 0
+        self._stalls = 0
+        self._last_stats = time()
+
+        self._supervisor = threading.Thread(target=self._supervise)
+        self._supervisor.daemon = True
+        self._supervisor.start()
+
+    def _start_worker(self, temporary=False):
+        thread = threading.Thread(target=self._work, kwargs={'temporary': temporary})
+        thread.daemon = True
+        if temporary:
+            self._extra_workers += 1
+        else:
+            self._workers += 1
+        thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs); returns a concurrent.futures.Future for
+        the result"""
+        future = Future()
+        with self._cond:
+            if self._stopped.is_set():
+                raise RuntimeError("{} pool is stopped".format(self.name))
+            self._queue.append((time(), future, fn, args, kwargs))
+            self._max_depth = max(self._max_depth, len(self._queue))
+            if self._workers < self.size and self._running + len(self._queue) > self._workers:
+                self._start_worker()
+            self._cond.notify()
+        return future
+
+    def _work(self, temporary=False):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    if temporary:
+                        self._extra_workers -= 1
+                        return
+                    if self._stopped.is_set():
+                        self._workers -= 1
+                        return
+                    self._cond.wait()
+                queued, future, fn, args, kwargs = self._queue.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._running += 1
+            start = time()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                adbb.log.exception("Unhandled exception in {} worker: {}".format(self.name, e))
+                future.set_exception(e)
+            finally:
+                latency = time() - start
+                with self._cond:
+                    self._running -= 1
+                    self._handled += 1
+                    self._total_wait += start - queued
+                    self._total_latency += latency
+                    self._max_latency = max(self._max_latency, latency)
+
+    def _supervise(self):
+        while not self._stopped.wait(1):
+            with self._cond:
+                now = time()
+                if self._queue and \
+                        self._running >= self._workers + self._extra_workers and \
+                        now - self._queue[0][0] > self.stall_timeout:
+                    self._stalls += 1
+                    adbb.log.warning("All {} workers busy for more than {}s ({} queued); starting extra worker".format(
+                        self.name, self.stall_timeout, len(self._queue)))
+                    self._start_worker(temporary=True)
+            if now - self._last_stats > self.stats_interval:
+                self._last_stats = now
+                stats = self.stats()
+                if stats['handled']:
+                    adbb.log.debug("{} pool: {}".format(self.name, stats))
+
+    def stop(self):
+        """Stop accepting jobs; workers exit once the queued jobs are done"""
+        with self._cond:
+            self._stopped.set()
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return queue depth and handler latency metrics for this pool"""
+        with self._cond:
+            handled = self._handled
+            return {
+                    'queue_depth': len(self._queue),
+                    'max_queue_depth': self._max_depth,
+                    'running': self._running,
+                    'workers': self._workers,
+                    'extra_workers': self._extra_workers,
+                    'stalls': self._stalls,
+                    'handled': handled,
+                    'avg_wait': self._total_wait/handled if handled else 0,
+                    'avg_latency': self._total_latency/handled if handled else 0,
+                    'max_latency': self._max_latency,
+                    }
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+import adbb
+
+# Queued writes are flushed when there are this many of them, or this many
+# seconds after the first one was queued; set from init(). With interval 0
+# every write is done immediately.
+batch_size = 100
+interval = 1.0
+
+_pending = []
+_lock = threading.Lock()
+# held by whoever writes to the database, so that adbb only ever has one
+# transaction writing at a time
+_flush_lock = threading.RLock()
+_timer = None
+
+
+def pending():
+    """Number of queued writes"""
+    with _lock:
+        return len(_pending)
+
+
+def submit(fn, callback=None):
+    """Queue fn(session) to be run in a later transaction together with other
+    queued writes. callback, if given, is called with the return value of fn
+    once the transaction is committed."""
+    global _timer
+    with _lock:
+        _pending.append((fn, callback))
+        full = not interval or len(_pending) >= batch_size
+        if not full and _timer is None:
+            _timer = threading.Timer(interval, flush)
+            _timer.daemon = True
+            _timer.start()
+    if full:
+        flush()
+
+
+def _run(sess, units):
+    results = []
+    for fn, callback in units:
+        results.append((callback, fn(sess)))
+    sess.commit()
+    return results
+
+
+def flush():
+    """Write everything queued to the database, in a single transaction if
+    possible. Returns the number of writes done."""
+    global _timer
+    with _flush_lock:
+        with _lock:
+            units = list(_pending)
+            _pending.clear()
+            if _timer:
+                _timer.cancel()
+                _timer = None
+        if not units:
+            return 0
+
+        results = []
+        done = len(units)
+        sess = adbb._sessionmaker()
+        try:
+            results = _run(sess, units)
+        except Exception as e:
+            sess.rollback()
+            adbb.log.warning("Failed to write {} queued changes at once ({}); writing them one at a time".format(
+                len(units), e))
+            # don't lose every change because of a single bad one
+            for unit in units:
+                try:
+                    results.extend(_run(sess, [unit]))
+                except Exception as e:
+                    sess.rollback()
+                    done -= 1
+                    adbb.log.warning("Failed to update db: {}".format(e))
+        finally:
+            sess.close()
+        adbb.log.debug("Wrote {} queued changes to database".format(done))
+
+    for callback, result in results:
+        if callback:
+            callback(result)
+    return done
+
+
+def write(fn):
+    """Run fn(session) and commit it right away, after everything already
+    queued, and return its result. For writes that must be in the database
+    before going on; database errors are raised to the caller."""
+    with _flush_lock:
+        flush()
+        sess = adbb._sessionmaker()
+        try:
+            result = fn(sess)
+            sess.commit()
+            return result
+        except Exception:
+            sess.rollback()
+            raise
+        finally:
+            sess.close()
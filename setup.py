@@ -32,7 +32,8 @@ setup(
             'console_scripts': [
                 'arrange_anime=adbb.utils:arrange_anime',
                 'jellyfin_anime_sync=adbb.jellyfin:jellyfin_anime_sync',
-                'adbb_cache=adbb.utils:cache_cleaner'
+                'adbb_cache=adbb.utils:cache_cleaner',
+                'adbb_broker=adbb.broker:broker'
                 ]
             },
         install_requires=[
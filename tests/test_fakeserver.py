@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# This file is part of adbb.
+#
+# adbb is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# adbb is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with adbb.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import socket
+import tempfile
+import unittest
+
+import adbb
+from adbb.fakeserver import FakeAniDBServer
+
+FIXTURES = {
+        'anime': [{'aid': 1, 'year': '1999-1999', 'type': 'TV Series',
+                   'nr_of_episodes': 13, 'highest_episode_number': 13}],
+        'episodes': [{'eid': 10, 'aid': 1, 'length': 25, 'epno': '1',
+                      'title_eng': 'First', 'aired': 915148800, 'type': '1'}],
+        'groups': [{'gid': 5, 'name': 'Group', 'short': 'grp'}],
+        # not in mylist; the fixture has no lid or mylist fields
+        'files': [{'fid': 100, 'aid': 1, 'eid': 10, 'gid': 5, 'size': 1234,
+                   'ed2khash': 'abcdef', 'length_in_seconds': 1500}],
+        }
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeServerTest(unittest.TestCase):
+    def setUp(self):
+        port = _free_port()
+        self.server = FakeAniDBServer(FIXTURES, port=port, users={'user': {'password': 'pass'}})
+        self.server.start()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        adbb.init(
+                'sqlite:///{}'.format(os.path.join(self.tmpdir.name, 'adbb.db')),
+                api_user='user',
+                api_pass='pass',
+                api_host='127.0.0.1',
+                api_port=port,
+                outgoing_udp_port=_free_port(),
+                rate_limits=((0.1, 100),),
+                loglevel='warning')
+
+    def tearDown(self):
+        adbb.close()
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def test_file_not_in_mylist(self):
+        f = adbb.File(fid=100)
+        self.assertIs(f.update().result(timeout=10), f)
+        self.assertEqual(f.episode.eid, 10)
+        self.assertFalse(f.lid)
+        self.assertFalse(f.in_mylist)
+
+
+if __name__ == '__main__':
+    unittest.main()